@@ -1,13 +1,25 @@
+import os
 import argparse
-from .subsample import subsample_genomes
-from .simulate import simulate_genomes
+from .subsample import QUOTA_POLICIES, subsample_genomes
+from .simulate import SIMULATION_MODELS, simulate_genomes
 from .split import split_files
+from .split_policy import POLICY_OPTIONS, resolve_policy
 from .upload import upload_dataset
-from .merge import merge_datasets
-from .genome_downloader import reformat_and_download_genome_ids
+from .stream_upload import COMPRESS_LEVEL, DEFAULT_PART_SIZE_MB, DEFAULT_UPLOAD_WORKERS
+from .merge import CONFLICT_POLICIES, DATASET_PROCESSES, DEFAULT_MERGE_WORKERS, format_merge_stats, merge_datasets, merge_directories
+from .materialize import MATERIALIZE_MODES
+from .sketch import DEFAULT_SKETCH_KMER, DEFAULT_SKETCH_SIZE
+from .download_engine import DEFAULT_PER_HOST, DEFAULT_WORKERS
+from .download_state import print_status
+from .fasta_normalize import DEFAULT_LINE_WIDTH
+from .genome_downloader import ENA_URL_TEMPLATE, PATRIC_URL_TEMPLATE, reformat_and_download_genome_ids
+from .genome_downloader import output_dir as DOWNLOAD_DIR
+from .utils import generate_output_directory
 from .kmer_profiling import process_kmer_profiles
 from .model_trainer import process_model_training
-from .kmer_harmonization import harmonize_kmer_headers
+from .model_backends import MODEL_BACKENDS
+from .model_predictor import PREDICT_BATCH_ROWS, predict_files
+from .kmer_harmonization import CHUNK_ROWS, harmonize_kmer_headers
 
 def main():
     parser = argparse.ArgumentParser(description='GenomeNet Helper')
@@ -25,10 +37,34 @@ def main():
     parser_subsample = subparsers.add_parser('subsample', parents=[multi_input_argument])
     parser_subsample.add_argument('--fragment_length', type=int, default=4000)
     parser_subsample.add_argument('--n_fragments', type=int, default=2500)
+    parser_subsample.add_argument('--seed', type=int, default=None, help='Seed for random number generation')
+    parser_subsample.add_argument('--workers', type=int, default=1, help='Number of genomes to subsample in parallel')
+    parser_subsample.add_argument('--output_dir', type=str, default=None,
+                                  help='Output directory (single input only); reusing it resumes an interrupted run')
+    parser_subsample.add_argument('--output_mode', type=str, choices=['files', 'shards'], default='files',
+                                  help="'files' writes one FASTA file per fragment, 'shards' packs fragments into indexed multi-record FASTA shards")
+    parser_subsample.add_argument('--shard_size_mb', type=float, default=256, help='Target size of each shard in MB')
+    parser_subsample.add_argument('--compress', action='store_true', help='Write BGZF-compressed shards')
+    parser_subsample.add_argument('--stride', type=int, default=None,
+                                  help='Distance between candidate fragment starts (default: fragment_length; smaller values allow overlap)')
+    parser_subsample.add_argument('--max_n_fraction', type=float, default=1.0,
+                                  help='Reject fragments with a larger fraction of N/ambiguous bases (default: no filtering)')
+    parser_subsample.add_argument('--quota', type=str, choices=QUOTA_POLICIES, default='fixed',
+                                  help="Fragments per genome: 'fixed' (n_fragments each), 'proportional' to genome length, or 'balanced' across genomes")
+    parser_subsample.add_argument('--total_fragments', type=int, default=None,
+                                  help="Global fragment target for the 'proportional' and 'balanced' quotas (default: n_fragments per genome)")
 
     # Simulate command
     parser_simulate = subparsers.add_parser('simulate', parents=[multi_input_argument])
     parser_simulate.add_argument('--sim_size_kb', type=int, default=100)
+    parser_simulate.add_argument('--kmer_length', type=int, default=3, help='Length of k-mers to consider')
+    parser_simulate.add_argument('--randomness', type=float, default=0.0, help='Amount of randomness to add to the k-mer frequencies')
+    parser_simulate.add_argument('--seed', type=int, default=None, help='Seed for random number generation')
+    parser_simulate.add_argument('--model', type=str, choices=SIMULATION_MODELS, default='kmer',
+                                 help="'kmer' concatenates independently drawn k-mers, 'markov' uses an order-(k-1) Markov chain")
+    parser_simulate.add_argument('--workers', type=int, default=1, help='Number of genomes to simulate in parallel')
+    parser_simulate.add_argument('--output_dir', type=str, default=None,
+                                 help='Output directory (single input only); reusing it resumes an interrupted run')
 
     # Split command
     parser_split = subparsers.add_parser('split', parents=[split_input_argument])
@@ -36,21 +72,66 @@ def main():
                             help="Fractions for train, validation, and test datasets respectively (must sum up to 100)")
     parser_split.add_argument('--by-size', action='store_true',
                             help="Split files based on size rather than count")
+    parser_split.add_argument('--workers', type=int, default=1, help='Number of files scanned in parallel')
+    parser_split.add_argument('--materialize', type=str, choices=MATERIALIZE_MODES, default='copy',
+                              help='How files are placed in the split folders; files that need cleaning are always rewritten')
+    parser_split.add_argument('--cluster_distance', type=float, default=None,
+                              help='Keep genomes within this Mash distance (e.g. 0.05) in the same split, using MinHash sketches')
+    parser_split.add_argument('--sketch_kmer', type=int, default=DEFAULT_SKETCH_KMER, help='k-mer size of the MinHash sketches')
+    parser_split.add_argument('--sketch_size', type=int, default=DEFAULT_SKETCH_SIZE, help='Number of MinHash bins per genome (power of two)')
+    parser_split.add_argument('--metadata', type=str, default=None, help='Tab-separated file with a `file` column and per-file metadata')
+    parser_split.add_argument('--stratify', type=str, default=None, help='Metadata column (e.g. a class label) whose values are each split by the fractions')
+    parser_split.add_argument('--group', type=str, default=None, help='Metadata column whose values are never split across train, validation and test')
+    parser_split.add_argument('--batch', action='store_true', help='Never prompt: unset policy settings use the batch defaults and a JSON report is written')
+    parser_split.add_argument('--policy', type=str, default=None, help='JSON or YAML file with the split policy (see README); flags below override it')
+    parser_split.add_argument('--report', type=str, default=None, help='Write a JSON report of every action and statistic to this file')
+    parser_split.add_argument('--seed', type=int, default=None, help='Seed for the random assignment of files to the splits')
+    parser_split.add_argument('--rename_fna', type=str, choices=POLICY_OPTIONS['rename_fna'], default=None, help='Rename .fna input files to .fasta')
+    parser_split.add_argument('--non_acgt', type=str, choices=POLICY_OPTIONS['non_acgt'], default=None, help='Files with non-ACGT characters')
+    parser_split.add_argument('--empty_files', type=str, choices=POLICY_OPTIONS['empty_files'], default=None, help='Files without sequence')
+    parser_split.add_argument('--duplicates', type=str, choices=POLICY_OPTIONS['duplicates'], default=None, help='Files with identical content')
+    parser_split.add_argument('--outliers', type=str, choices=POLICY_OPTIONS['outliers'], default=None, help='Files more than 2 SDs from the mean size')
+    parser_split.add_argument('--originals', type=str, choices=POLICY_OPTIONS['originals'], default=None, help='Input files after the split')
 
     # Upload command
     parser_upload = subparsers.add_parser('upload')
     parser_upload.add_argument('--train', type=str, required=True, help="Path to the training data folder")
     parser_upload.add_argument('--test', type=str, required=True, help="Path to the test data folder")
     parser_upload.add_argument('--validation', type=str, required=True, help="Path to the validation data folder")
+    parser_upload.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of threads compressing the archive')
+    parser_upload.add_argument('--upload_workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help='Number of parts uploaded concurrently')
+    parser_upload.add_argument('--part_size_mb', type=float, default=DEFAULT_PART_SIZE_MB, help='Size of the uploaded parts in MB (at least 5)')
+    parser_upload.add_argument('--level', type=int, default=COMPRESS_LEVEL, help='gzip compression level (1-9)')
+    parser_upload.add_argument('--realm', type=str, default=None, help='B2 realm or URL of a B2-compatible server (default: production)')
+    parser_upload.add_argument('--bucket', type=str, default=None, help='B2 bucket name (default: B2_BUCKET or the config file)')
+    parser_upload.add_argument('--incremental', action='store_true', help='Upload content-addressed files and a dataset manifest; only new contents are sent')
+    parser_upload.add_argument('--dataset', type=str, default=None, help='Dataset name for --incremental (default: the folder prefix)')
 
     # Merge command
     parser_merge = subparsers.add_parser('merge')
-    parser_merge.add_argument('--input', type=str, required=True, help='The base name for input directories.')
-    parser_merge.add_argument('--date', type=str, required=True, help='The date suffix for the directories.')
+    parser_merge.add_argument('--input', type=str, default=None, help='The base name for input directories.')
+    parser_merge.add_argument('--date', type=str, default=None, help='The date suffix for the directories.')
+    parser_merge.add_argument('--processes', type=str, nargs='+', default=DATASET_PROCESSES,
+                              help='Dataset variants merged per split, e.g. $input_train_$process_$date (default: subsampled simulated)')
+    parser_merge.add_argument('--sources', type=str, nargs='+', default=None, help='Arbitrary directories to merge into --output (instead of --input/--date)')
+    parser_merge.add_argument('--output', type=str, default=None, help='Destination directory for --sources')
+    parser_merge.add_argument('--materialize', type=str, choices=MATERIALIZE_MODES, default='copy',
+                              help='How files are placed in the merged folders')
+    parser_merge.add_argument('--workers', type=int, default=DEFAULT_MERGE_WORKERS, help='Number of threads placing files')
+    parser_merge.add_argument('--on_conflict', type=str, choices=CONFLICT_POLICIES, default='namespace',
+                              help='How files with the same name but different content are kept apart')
 
     # Add a new subparser for the genome_download command
     parser_genome_download = subparsers.add_parser('genome_download')
-    parser_genome_download.add_argument('--input', type=str, required=True, help='Path to the file containing the list of genome IDs.')
+    parser_genome_download.add_argument('--input', type=str, help='Path to the file containing the list of genome IDs.')
+    parser_genome_download.add_argument('--status', action='store_true', help='Print a summary of the download state in genome_downloads and exit (no network access)')
+    parser_genome_download.add_argument('--line_width', type=int, default=DEFAULT_LINE_WIDTH, help='Line width of the normalized NCBI genomes')
+    parser_genome_download.add_argument('--bgzip', action='store_true', help='Keep the NCBI genomes BGZF-compressed (.fasta.gz)')
+    parser_genome_download.add_argument('--verify', action='store_true', help='Re-hash completed downloads instead of only checking their size before skipping them')
+    parser_genome_download.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of concurrent downloads')
+    parser_genome_download.add_argument('--per_host', type=int, default=DEFAULT_PER_HOST, help='Maximum number of concurrent downloads from one server')
+    parser_genome_download.add_argument('--ena_url', type=str, default=ENA_URL_TEMPLATE, help='ENA download URL; {id} is replaced by the accession')
+    parser_genome_download.add_argument('--patric_url', type=str, default=PATRIC_URL_TEMPLATE, help='PATRIC download URL (http or ftp); {id} is replaced by the genome ID')
 
      # K-mer profiling command
     parser_kmer = subparsers.add_parser('kmer')
@@ -60,38 +141,101 @@ def main():
     parser_kmer.add_argument('--subsequence_size', type=int, default=2000, help='Size of each subsequence to be processed')
     parser_kmer.add_argument('--random_mode', action='store_true', help='Enable random mode to randomly select subsequences')
     parser_kmer.add_argument('--label', type=str, default="", help='Label for the output data')
+    parser_kmer.add_argument('--backend', type=str, choices=['auto', 'numpy', 'jellyfish'], default='auto', help='K-mer counting backend (auto uses numpy up to k=12 and jellyfish above)')
+    parser_kmer.add_argument('--canonical', action='store_true', help='Count canonical k-mers (a k-mer and its reverse complement are merged)')
+    parser_kmer.add_argument('--csv', action='store_true', help='Also export the profile store as a wide CSV file')
+    parser_kmer.add_argument('--workers', type=int, default=1, help='Number of genomes to profile in parallel')
+    parser_kmer.add_argument('--seed', type=int, default=None, help='Seed for the random subsequence selection')
 
     # K-mer Harmonize command
     parser_kmer_harmonize = subparsers.add_parser('kmer-harmonize')
     parser_kmer_harmonize.add_argument('files', nargs='+', help='Paths to the CSV files to harmonize')
+    parser_kmer_harmonize.add_argument('--workers', type=int, default=1, help='Number of files rewritten in parallel')
+    parser_kmer_harmonize.add_argument('--chunk_rows', type=int, default=CHUNK_ROWS, help='Number of rows read and written at a time')
+    parser_kmer_harmonize.add_argument('--npz', type=str, default=None, help='Also write all harmonized profiles to this profile store (.npz)')
+    parser_kmer_harmonize.add_argument('--canonical', action='store_true', help='The profiles count canonical k-mers (recorded in the --npz store)')
+    parser_kmer_harmonize.add_argument('--max_subseqs', type=int, default=None, help='Subsequences per record used for the profiles (recorded in the --npz store)')
+    parser_kmer_harmonize.add_argument('--subsequence_size', type=int, default=None, help='Subsequence size used for the profiles (recorded in the --npz store)')
 
     # Add a new subparser for the model training command
     parser_model_train = subparsers.add_parser('train_model')
-    parser_model_train.add_argument('--input_train', type=str, nargs='+', required=True, help='CSV files for training')
-    parser_model_train.add_argument('--input_test', type=str, nargs='+', required=True, help='CSV files for testing')
+    parser_model_train.add_argument('--input_train', type=str, nargs='+', required=True, help='CSV files or k-mer profile stores (.npz) for training')
+    parser_model_train.add_argument('--input_test', type=str, nargs='+', required=True, help='CSV files or k-mer profile stores (.npz) for testing')
     parser_model_train.add_argument('--output', type=str, default="combined_report.pdf", help='Output path for the report')
+    parser_model_train.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of cores shared by the parallel training fraction fits')
+    parser_model_train.add_argument('--model', type=str, choices=list(MODEL_BACKENDS), default='random_forest', help='Classifier backend')
+    parser_model_train.add_argument('--n_estimators', type=int, default=50, help='Number of trees (random_forest) or boosting iterations (hist_gradient_boosting)')
+    parser_model_train.add_argument('--model_output', type=str, default=None, help='Where to save the model of the largest training fraction (default: the report path with .joblib)')
+    parser_model_train.add_argument('--canonical', action='store_true', default=None, help='The training profiles count canonical k-mers (default: as recorded in the profile stores)')
+    parser_model_train.add_argument('--max_subseqs', type=int, default=None, help='Subsequences per record used for the training profiles, saved with the model for predict (default: as recorded in the profile stores)')
+    parser_model_train.add_argument('--subsequence_size', type=int, default=None, help='Subsequence size used for the training profiles, saved with the model for predict (default: as recorded in the profile stores)')
+
+    # Prediction command
+    parser_predict = subparsers.add_parser('predict')
+    parser_predict.add_argument('--model', type=str, required=True, help='Model saved by train_model (.joblib)')
+    parser_predict.add_argument('--input', type=str, nargs='+', required=True, help='FASTA files, folders of FASTA files, CSV files or k-mer profile stores (.npz)')
+    parser_predict.add_argument('--output', type=str, default="predictions.tsv", help='Output TSV file with one prediction per profile')
+    parser_predict.add_argument('--workers', type=int, default=1, help='Number of FASTA files profiled in parallel')
+    parser_predict.add_argument('--batch_size', type=int, default=PREDICT_BATCH_ROWS, help='Number of profiles predicted and written at a time')
+    parser_predict.add_argument('--max_subseqs', type=int, default=None, help='Subsequences profiled per FASTA record (default: as recorded in the model)')
+    parser_predict.add_argument('--subsequence_size', type=int, default=None, help='Size of the profiled subsequences (default: as recorded in the model)')
 
     args = parser.parse_args()
+    if args.command == 'merge' and not ((args.sources and args.output) or (args.input and args.date)):
+        parser.error('merge needs --input and --date, or --sources and --output')
+    if args.command in ('kmer-harmonize', 'train_model') and (args.max_subseqs is None) != (args.subsequence_size is None):
+        parser.error('--max_subseqs and --subsequence_size have to be given together')
+    if args.command in ('subsample', 'simulate') and args.output_dir and len(args.input) > 1:
+        parser.error('--output_dir can only be used with a single input directory')
     if args.command == 'subsample':
         for input_dir in args.input:
-            subsample_genomes(input_dir, args.fragment_length, args.n_fragments)
+            subsample_genomes(input_dir, args.fragment_length, args.n_fragments, args.seed, args.workers, args.output_dir,
+                              args.output_mode, args.shard_size_mb, args.compress, args.stride, args.max_n_fraction,
+                              args.quota, args.total_fragments)
     elif args.command == 'simulate':
         for input_dir in args.input:
-            simulate_genomes(input_dir, args.sim_size_kb, monitor_kmers=["ATG", "TTT", "GCA", "CGT", "AAC"])
+            simulate_genomes(input_dir, args.sim_size_kb, args.kmer_length, args.seed, args.randomness,
+                             monitor_kmers=["ATG", "TTT", "GCA", "CGT", "AAC"], model=args.model,
+                             workers=args.workers, output_dir=args.output_dir)
     elif args.command == 'split':
-        split_files(args.input, args.fraction, args.by_size)
+        policy = resolve_policy(args.policy, args.batch, seed=args.seed,
+                                **{setting: getattr(args, setting) for setting in POLICY_OPTIONS})
+        report = args.report
+        if args.batch and report is None:
+            report = generate_output_directory(args.input, 'split_report') + '.json'
+        split_files(args.input, args.fraction, args.by_size, args.workers, args.materialize,
+                    args.cluster_distance, args.sketch_kmer, args.sketch_size, args.metadata, args.stratify, args.group,
+                    policy, report)
     elif args.command == 'upload':
-        upload_dataset(args.train, args.test, args.validation)
+        upload_dataset(args.train, args.test, args.validation, args.workers, args.upload_workers, args.part_size_mb,
+                       args.level, args.realm, args.bucket, args.incremental, args.dataset)
     elif args.command == 'merge':
-        merge_datasets(args.input, args.date)
+        if args.sources:
+            stats = merge_directories(args.sources, args.output, args.materialize, args.workers, args.on_conflict)
+            print(f"{args.output}: {format_merge_stats(stats)}")
+        else:
+            merge_datasets(args.input, args.date, args.materialize, args.processes, args.workers, args.on_conflict)
     elif args.command == 'kmer':
-        process_kmer_profiles(args.input, args.kmer_size, args.max_subseqs, args.subsequence_size, args.random_mode, args.label)
+        process_kmer_profiles(args.input, args.kmer_size, args.max_subseqs, args.subsequence_size, args.random_mode, args.label, args.backend, args.canonical, args.csv, args.workers, args.seed)
     elif args.command == 'train_model':
-        process_model_training(args.input_train, args.input_test, args.output)
+        model_output = args.model_output or os.path.splitext(args.output)[0] + '.joblib'
+        process_model_training(args.input_train, args.input_test, args.output, args.workers, args.model, args.n_estimators,
+                               model_output, args.canonical, args.max_subseqs, args.subsequence_size)
+    elif args.command == 'predict':
+        written = predict_files(args.model, args.input, args.output, args.workers, args.batch_size, args.max_subseqs,
+                                args.subsequence_size)
+        print(f"Wrote {written} predictions to {args.output}")
     elif args.command == 'kmer-harmonize':
-        harmonize_kmer_headers(*args.files)
+        harmonize_kmer_headers(*args.files, workers=args.workers, chunk_rows=args.chunk_rows, store_path=args.npz, canonical=args.canonical,
+                               max_subseqs=args.max_subseqs, subsequence_size=args.subsequence_size)
     elif args.command == 'genome_download':
-        reformat_and_download_genome_ids(args.input)
+        if args.status:
+            print_status(DOWNLOAD_DIR)
+        elif args.input:
+            reformat_and_download_genome_ids(args.input, args.workers, args.per_host, args.ena_url, args.patric_url, args.verify,
+                                             args.line_width, args.bgzip)
+        else:
+            parser_genome_download.error("--input is required unless --status is given")
     else:
         parser.print_help()
 
@@ -0,0 +1,180 @@
+import os
+import time
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ftplib import FTP, error_perm
+from urllib.parse import urlparse, unquote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1 << 20
+HTTP_TIMEOUT = (30, 300)  # connect, read
+FTP_TIMEOUT = 300
+
+DEFAULT_WORKERS = 16
+DEFAULT_PER_HOST = 4
+DEFAULT_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# HTTP statuses that are worth retrying; anything else >= 400 fails immediately.
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+class PermanentDownloadError(Exception):
+    """
+    A failure that retrying cannot fix, e.g. a missing accession.
+    """
+
+class FtpPool:
+    """
+    Keeps logged-in FTP control connections per server so that consecutive files reuse them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+
+    def acquire(self, host, port, user, password):
+        key = (host, port, user)
+        with self.lock:
+            if self.idle[key]:
+                return self.idle[key].pop()
+        ftp = FTP(timeout=FTP_TIMEOUT)
+        ftp.connect(host, port)
+        ftp.login(user, password)
+        return ftp
+
+    def release(self, ftp, host, port, user):
+        with self.lock:
+            self.idle[(host, port, user)].append(ftp)
+
+    def close(self):
+        with self.lock:
+            connections = [ftp for idle in self.idle.values() for ftp in idle]
+            self.idle.clear()
+        for ftp in connections:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+class Downloader:
+    """
+    Downloads many files concurrently over HTTP(S) and FTP.
+    A thread pool of `workers` threads runs the downloads, with at most `per_host` of them talking to
+    the same server. HTTP requests share a keep-alive session; FTP logins are pooled per server.
+    Every file is streamed in chunks to `<path>.part` and renamed into place when complete, so a
+    file at the final path is always complete. Transient failures are retried with exponential backoff.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, retries=DEFAULT_RETRIES, backoff=BACKOFF_SECONDS):
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=max(workers, per_host))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.ftp_pool = FtpPool()
+        self.host_lock = threading.Lock()
+        self.host_slots = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+        self.ftp_pool.close()
+
+    def _host_slot(self, host):
+        with self.host_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_slots[host]
+
+    def _fetch_http(self, url, out):
+        with self.session.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if response.status_code >= 400 and response.status_code not in RETRY_STATUSES:
+                raise PermanentDownloadError(f"HTTP {response.status_code}")
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                out.write(chunk)
+
+    def _fetch_ftp(self, parsed, out):
+        host, port = parsed.hostname, parsed.port or 21
+        user = unquote(parsed.username) if parsed.username else 'anonymous'
+        password = unquote(parsed.password) if parsed.password else ''
+        ftp = self.ftp_pool.acquire(host, port, user, password)
+        try:
+            ftp.retrbinary(f"RETR {unquote(parsed.path)}", out.write, blocksize=CHUNK_SIZE)
+        except error_perm as e:
+            # 5xx replies (e.g. 550 file not found) leave the control connection usable
+            self.ftp_pool.release(ftp, host, port, user)
+            raise PermanentDownloadError(str(e))
+        except BaseException:
+            ftp.close()  # the connection state is unknown after a transfer error
+            raise
+        self.ftp_pool.release(ftp, host, port, user)
+
+    def fetch(self, url, path):
+        """
+        Downloads url to path with retries. Returns the number of bytes written.
+        Raises PermanentDownloadError, or the last transient error once the retries are used up.
+        """
+        parsed = urlparse(url)
+        part_path = path + '.part'
+        for attempt in range(self.retries + 1):
+            try:
+                with self._host_slot(parsed.hostname):
+                    with open(part_path, 'wb') as out:
+                        if parsed.scheme == 'ftp':
+                            self._fetch_ftp(parsed, out)
+                        elif parsed.scheme in ('http', 'https'):
+                            self._fetch_http(url, out)
+                        else:
+                            raise PermanentDownloadError(f"Unsupported URL scheme: {url}")
+                size = os.path.getsize(part_path)
+                if size == 0:
+                    raise PermanentDownloadError("empty file")
+                os.replace(part_path, path)
+                return size
+            except PermanentDownloadError:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            except Exception:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                if attempt == self.retries:
+                    raise
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def download_all(self, jobs, skip_existing=True):
+        """
+        Downloads (key, url, path) jobs concurrently. Files that already exist are skipped unless
+        skip_existing is False. Yields (key, path, error) in completion order; error is None on success.
+        """
+        def run(job):
+            key, url, path = job
+            if skip_existing and os.path.exists(path) and os.path.getsize(path) > 0:
+                return key, path, None
+            try:
+                self.fetch(url, path)
+                return key, path, None
+            except PermanentDownloadError as e:
+                return key, path, str(e)
+            except Exception as e:
+                return key, path, f"{type(e).__name__}: {e}"
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(run, job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
@@ -0,0 +1,111 @@
+import os
+import time
+import sqlite3
+
+from .fasta_cache import content_hash
+
+# Hidden, so that the download directory still only lists FASTA files (see split).
+STATE_FILE = '.download_state.sqlite'
+
+def state_path(output_dir):
+    return os.path.join(output_dir, STATE_FILE)
+
+def open_state(output_dir):
+    """
+    Opens the download state store of output_dir: one row per accession with its source, status,
+    file, size, checksum, number of attempts and last error.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    connection = sqlite3.connect(state_path(output_dir), timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS downloads (accession TEXT PRIMARY KEY, source TEXT, status TEXT, '
+                       'file TEXT, bytes INTEGER, checksum TEXT, attempts INTEGER, error TEXT, updated REAL)')
+    return connection
+
+def get_entries(connection, source=None):
+    """
+    Returns the state rows as dicts keyed by accession, optionally for one source.
+    """
+    query = 'SELECT accession, source, status, file, bytes, checksum, attempts, error FROM downloads'
+    rows = connection.execute(query + ' WHERE source = ?', (source,)) if source else connection.execute(query)
+    columns = ['accession', 'source', 'status', 'file', 'bytes', 'checksum', 'attempts', 'error']
+    return {row[0]: dict(zip(columns, row)) for row in rows}
+
+def record_done(connection, accession, source, path, checksum=None):
+    """
+    Marks an accession as downloaded, storing the size and content checksum of its file
+    (computed here unless it is passed in).
+    """
+    with connection:
+        connection.execute(
+            'INSERT INTO downloads VALUES (?, ?, ?, ?, ?, ?, 1, NULL, ?) ON CONFLICT(accession) DO UPDATE SET '
+            'source = excluded.source, status = excluded.status, file = excluded.file, bytes = excluded.bytes, '
+            'checksum = excluded.checksum, attempts = attempts + 1, error = NULL, updated = excluded.updated',
+            (accession, source, 'done', os.path.basename(path), os.path.getsize(path), checksum or content_hash(path), time.time()))
+
+def record_failed(connection, accession, source, error):
+    with connection:
+        connection.execute(
+            'INSERT INTO downloads VALUES (?, ?, ?, NULL, NULL, NULL, 1, ?, ?) ON CONFLICT(accession) DO UPDATE SET '
+            'source = excluded.source, status = excluded.status, file = NULL, bytes = NULL, checksum = NULL, '
+            'attempts = attempts + 1, error = excluded.error, updated = excluded.updated',
+            (accession, source, 'failed', error, time.time()))
+
+def is_verified(entry, output_dir, verify_checksum=False):
+    """
+    Checks that a completed download is still present with the recorded size
+    (and, with verify_checksum, the recorded content checksum).
+    """
+    if entry is None or entry['status'] != 'done':
+        return False
+    path = os.path.join(output_dir, entry['file'])
+    if not os.path.exists(path) or os.path.getsize(path) != entry['bytes']:
+        return False
+    return not verify_checksum or content_hash(path) == entry['checksum']
+
+def pending_accessions(connection, accessions, source, output_dir, verify_checksum=False):
+    """
+    Returns the accessions that still need to be downloaded: everything without a verified completed download.
+    Files of completed downloads that fail verification are removed so that they are fetched again.
+    """
+    entries = get_entries(connection, source)
+    pending = set()
+    for accession in accessions:
+        entry = entries.get(accession)
+        if is_verified(entry, output_dir, verify_checksum):
+            continue
+        if entry is not None and entry['file'] and os.path.exists(os.path.join(output_dir, entry['file'])):
+            print(f"Warning: {entry['file']} does not match the recorded download, downloading it again.")
+            os.remove(os.path.join(output_dir, entry['file']))
+        pending.add(accession)
+    return pending
+
+def print_status(output_dir):
+    """
+    Prints a summary of the download state store without any network access.
+    """
+    if not os.path.exists(state_path(output_dir)):
+        print(f"No download state found in {output_dir}.")
+        return
+    connection = open_state(output_dir)
+    try:
+        entries = get_entries(connection)
+    finally:
+        connection.close()
+
+    print(f"Download state in {output_dir}: {len(entries)} accessions")
+    for source in sorted({entry['source'] for entry in entries.values()}):
+        source_entries = [entry for entry in entries.values() if entry['source'] == source]
+        done = [entry for entry in source_entries if entry['status'] == 'done']
+        missing = [entry for entry in done if not is_verified(entry, output_dir)]
+        failed = [entry for entry in source_entries if entry['status'] == 'failed']
+        size_gb = sum(entry['bytes'] for entry in done) / (1024 ** 3)
+        print(f"  {source}: {len(done)} done ({size_gb:.2f} GB), {len(failed)} failed, {len(missing)} done but missing or changed on disk")
+
+    failed = sorted((entry for entry in entries.values() if entry['status'] == 'failed'), key=lambda entry: entry['accession'])
+    if failed:
+        print("Failed accessions (attempts, last error):")
+        for entry in failed[:20]:
+            print(f"  {entry['accession']} ({entry['source']}, {entry['attempts']}): {entry['error']}")
+        if len(failed) > 20:
+            print(f"  ... and {len(failed) - 20} more")
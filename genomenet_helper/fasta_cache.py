@@ -0,0 +1,189 @@
+import os
+import gzip
+import json
+import sqlite3
+import hashlib
+
+import numpy as np
+from appdirs import user_cache_dir
+
+from .fasta_reader import BLOCK_SIZE, FastaRecord, record_name
+from .utils import ordered_map
+
+# The cache lives outside the genome directories, which must only contain FASTA files (see split).
+CACHE_DIR_ENV = 'GENOMENET_HELPER_CACHE_DIR'
+CACHE_FILE = 'fasta_index.sqlite'
+
+NUCLEOTIDES = 'ACGTN'
+
+def cache_path():
+    cache_dir = os.environ.get(CACHE_DIR_ENV) or user_cache_dir('genomenet_helper')
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, CACHE_FILE)
+
+def open_cache():
+    connection = sqlite3.connect(cache_path(), timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS fasta_stats (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, stats TEXT)')
+    return connection
+
+def _open_blocks(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            yield block
+
+def content_hash(path):
+    """
+    BLAKE2b digest of the raw file content.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def scan_fasta(path):
+    """
+    Computes the index and statistics of a FASTA file in a single pass over large blocks:
+    record offsets and lengths, base composition, non-ACGT counts and the content hash.
+    Offsets refer to the uncompressed content; for gzip files they cannot be used for memory mapping.
+    """
+    is_gzip = path.endswith('.gz')
+    hasher = hashlib.blake2b(digest_size=20)
+    histogram = np.zeros(256, dtype=np.int64)
+    records = []
+    header = None
+    offset = 0
+    line_start = True
+
+    for block in _open_blocks(path):
+        if not is_gzip:
+            hasher.update(block)
+        position = 0
+        while position < len(block):
+            if header is not None:
+                # Inside a header line, which may continue into the next block
+                header_end = block.find(b'\n', position)
+                if header_end < 0:
+                    header += block[position:]
+                    break
+                header += block[position:header_end]
+                records.append([record_name(header.rstrip()), header_offset, offset + header_end + 1, None, 0])
+                header = None
+                position = header_end + 1
+                line_start = True
+                continue
+            if line_start and block[position:position + 1] == b'>':
+                if records:
+                    records[-1][3] = offset + position
+                header_offset = offset + position
+                header = b'>'
+                position += 1
+                continue
+            next_header = block.find(b'\n>', position)
+            stop = len(block) if next_header < 0 else next_header + 1
+            if records:
+                counts = np.bincount(np.frombuffer(block, dtype=np.uint8, count=stop - position, offset=position), minlength=256)
+                histogram += counts
+                records[-1][4] += stop - position - int(counts[10] + counts[13])
+            line_start = block[stop - 1:stop] == b'\n'
+            position = stop
+        offset += len(block)
+
+    if header is not None:
+        records.append([record_name(header.rstrip()), header_offset, offset, None, 0])
+    if records:
+        records[-1][3] = offset
+
+    base_counts = {base: int(histogram[ord(base)] + histogram[ord(base.lower())]) for base in NUCLEOTIDES}
+    length = sum(record[4] for record in records)
+    invalid_characters = sorted(chr(c) for c in np.flatnonzero(histogram) if chr(c) not in 'ACGTNacgtn\r\n')
+    return {
+        'hash': content_hash(path) if is_gzip else hasher.hexdigest(),
+        'records': records,
+        'length': length,
+        'base_counts': base_counts,
+        'gc_content': (base_counts['G'] + base_counts['C']) / length if length else 0.0,
+        'n_count': base_counts['N'],
+        'non_acgt_count': length - sum(base_counts[base] for base in 'ACGT'),
+        'invalid_characters': invalid_characters,
+    }
+
+def get_fasta_stats(path, connection=None):
+    """
+    Returns the statistics of scan_fasta for path, reading them from the index cache when the file's
+    mtime and size are unchanged. The file is only scanned (and the cache updated) on a miss.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    own_connection = connection is None
+    if own_connection:
+        connection = open_cache()
+    try:
+        row = connection.execute('SELECT mtime_ns, size, stats FROM fasta_stats WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            stats = json.loads(row[2])
+        else:
+            stats = scan_fasta(path)
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO fasta_stats VALUES (?, ?, ?, ?)',
+                                   (path, stat.st_mtime_ns, stat.st_size, json.dumps(stats)))
+    finally:
+        if own_connection:
+            connection.close()
+    stats['size'] = stat.st_size
+    return stats
+
+def store_fasta_stats(path, stats, connection=None):
+    """
+    Caches statistics that were computed while writing path (see fasta_normalize), so the file is never scanned.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    own_connection = connection is None
+    if own_connection:
+        connection = open_cache()
+    try:
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO fasta_stats VALUES (?, ?, ?, ?)',
+                               (path, stat.st_mtime_ns, stat.st_size, json.dumps(stats)))
+    finally:
+        if own_connection:
+            connection.close()
+
+def get_content_hashes(paths, workers=1):
+    """
+    Returns the content_hash of every path, reading it from the cache when the file's mtime and size
+    are unchanged. Missing hashes are computed with `workers` processes and cached.
+    """
+    connection = open_cache()
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS content_hashes (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT)')
+        hashes = [None] * len(paths)
+        missing = []
+        for i, path in enumerate(paths):
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            row = connection.execute('SELECT mtime_ns, size, hash FROM content_hashes WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                hashes[i] = row[2]
+            else:
+                missing.append((i, path, stat))
+        with connection:
+            for (i, path, stat), file_hash in zip(missing, ordered_map(content_hash, [path for _, path, _ in missing], workers)):
+                hashes[i] = file_hash
+                connection.execute('INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?)',
+                                   (path, stat.st_mtime_ns, stat.st_size, file_hash))
+    finally:
+        connection.close()
+    return hashes
+
+def get_fasta_index(path, connection=None):
+    """
+    Returns the cached FastaRecord index of path (see fasta_reader.read_records); gzip files have no offsets.
+    """
+    stats = get_fasta_stats(path, connection)
+    if path.endswith('.gz'):
+        return [FastaRecord(name, None, None, None, length) for name, _, _, _, length in stats['records']]
+    return [FastaRecord(*record) for record in stats['records']]
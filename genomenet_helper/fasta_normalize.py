@@ -0,0 +1,89 @@
+import os
+import hashlib
+
+import numpy as np
+from Bio import bgzf
+
+from .fasta_cache import NUCLEOTIDES, store_fasta_stats
+from .fasta_reader import read_records, record_name
+
+DEFAULT_LINE_WIDTH = 80
+
+class _HashingWriter:
+    """
+    File wrapper that hashes everything written to it, so the content hash needs no second read.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.hasher = hashlib.blake2b(digest_size=20)
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def wrap_sequence(sequence, line_width):
+    """
+    Returns the sequence (uint8 array) as bytes with a line break after every line_width bases.
+    """
+    n_full = len(sequence) // line_width
+    lines = np.empty((n_full, line_width + 1), dtype=np.uint8)
+    lines[:, :line_width] = sequence[:n_full * line_width].reshape(n_full, line_width)
+    lines[:, line_width] = ord('\n')
+    wrapped = lines.tobytes()
+    if len(sequence) > n_full * line_width:
+        wrapped += sequence[n_full * line_width:].tobytes() + b'\n'
+    return wrapped
+
+def normalize_fasta(source, destination, line_width=DEFAULT_LINE_WIDTH):
+    """
+    Streams a (gzip) FASTA file into destination with uppercase sequences wrapped at line_width.
+    A destination ending in .gz is written BGZF-compressed. The file is written to a .part file
+    and renamed when complete. The statistics of fasta_cache.scan_fasta are computed in the same
+    pass and stored in the index cache, so later commands do not have to rescan the genome.
+    Returns the statistics.
+    """
+    compress = destination.endswith('.gz')
+    part_path = destination + '.part'
+    histogram = np.zeros(256, dtype=np.int64)
+    records = []
+    offset = 0
+    raw = _HashingWriter(open(part_path, 'wb'))
+    out = bgzf.BgzfWriter(fileobj=raw) if compress else raw
+    try:
+        for header, sequence in read_records(source, headers=True):
+            name = record_name(header)
+            header += b'\n'
+            wrapped = wrap_sequence(sequence, line_width)
+            out.write(header)
+            out.write(wrapped)
+            histogram += np.bincount(sequence, minlength=256)
+            records.append([name, offset, offset + len(header), offset + len(header) + len(wrapped), len(sequence)])
+            offset += len(header) + len(wrapped)
+        out.close()
+    except BaseException:
+        out.close()
+        os.remove(part_path)
+        raise
+    os.replace(part_path, destination)
+
+    base_counts = {base: int(histogram[ord(base)]) for base in NUCLEOTIDES}
+    length = sum(record[4] for record in records)
+    stats = {
+        'hash': raw.hasher.hexdigest(),
+        'records': records,
+        'length': length,
+        'base_counts': base_counts,
+        'gc_content': (base_counts['G'] + base_counts['C']) / length if length else 0.0,
+        'n_count': base_counts['N'],
+        'non_acgt_count': length - sum(base_counts[base] for base in 'ACGT'),
+        'invalid_characters': sorted(chr(c) for c in np.flatnonzero(histogram) if chr(c) not in 'ACGTN'),
+    }
+    store_fasta_stats(destination, stats)
+    return stats
@@ -0,0 +1,143 @@
+import os
+import gzip
+import mmap
+from collections import namedtuple
+
+import numpy as np
+
+FASTA_EXTENSIONS = ('.fasta', '.fasta.gz')
+
+# Block size used when scanning memory maps and gzip streams.
+BLOCK_SIZE = 1 << 24
+
+# bytes.translate table that uppercases ASCII letters; line breaks are deleted in the same pass.
+UPPERCASE_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+LINE_BREAKS = b'\r\n'
+
+# Offsets are byte positions in the (uncompressed) file; they are None for gzip input.
+FastaRecord = namedtuple('FastaRecord', ['name', 'header_offset', 'sequence_offset', 'end_offset', 'length'])
+
+def is_fasta(file_name):
+    return file_name.endswith(FASTA_EXTENSIONS)
+
+def fasta_stem(file_name):
+    """
+    Returns the file name without directory and FASTA extension (including .gz).
+    """
+    base_name = os.path.basename(file_name)
+    for extension in FASTA_EXTENSIONS:
+        if base_name.endswith(extension):
+            return base_name[:-len(extension)]
+    return os.path.splitext(base_name)[0]
+
+def record_name(header):
+    fields = header[1:].split(None, 1)
+    return fields[0].decode('utf-8', 'replace') if fields else ''
+
+def _count_sequence_bytes(buffer, start, end):
+    """
+    Number of sequence characters between start and end, i.e. everything except line breaks.
+    """
+    length = end - start
+    for block_start in range(start, end, BLOCK_SIZE):
+        block = np.frombuffer(buffer, dtype=np.uint8, count=min(BLOCK_SIZE, end - block_start), offset=block_start)
+        length -= int(np.count_nonzero((block == 10) | (block == 13)))
+    return length
+
+def _index_buffer(buffer):
+    records = []
+    size = len(buffer)
+    if buffer[0:1] == b'>':
+        header_offset = 0
+    else:
+        header_offset = buffer.find(b'\n>')
+        if header_offset >= 0:
+            header_offset += 1
+    while header_offset >= 0:
+        header_end = buffer.find(b'\n', header_offset)
+        sequence_offset = size if header_end < 0 else header_end + 1
+        next_header = buffer.find(b'\n>', sequence_offset - 1) if sequence_offset < size else -1
+        end_offset = size if next_header < 0 else next_header + 1
+        name = record_name(buffer[header_offset:sequence_offset].rstrip())
+        length = _count_sequence_bytes(buffer, sequence_offset, end_offset)
+        records.append(FastaRecord(name, header_offset, sequence_offset, end_offset, length))
+        header_offset = next_header + 1 if next_header >= 0 else -1
+    return records
+
+def open_map(path):
+    """
+    Memory-maps a plain FASTA file read-only. Returns None for empty files, which cannot be mapped.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def read_record(mapped, record):
+    """
+    Returns the uppercase sequence of one record of a memory-mapped file as a uint8 array.
+    """
+    return np.frombuffer(mapped[record.sequence_offset:record.end_offset].translate(UPPERCASE_TABLE, LINE_BREAKS), dtype=np.uint8)
+
+def read_records(path, index=None, headers=False):
+    """
+    Yields (name, sequence) for every record in path, where sequence is an uppercase uint8 array
+    without line breaks. A precomputed index avoids rescanning plain files for record boundaries.
+    With headers=True the full header line (bytes, without the line break) is yielded instead of the name.
+    """
+    if path.endswith('.gz'):
+        yield from _iter_gzip_records(path, headers)
+        return
+    mapped = open_map(path)
+    if mapped is None:
+        return
+    with mapped:
+        for record in (index if index is not None else _index_buffer(mapped)):
+            name = mapped[record.header_offset:record.sequence_offset].rstrip() if headers else record.name
+            yield name, read_record(mapped, record)
+
+def _iter_gzip_records(path, headers=False):
+    """
+    Streaming fallback for gzip input: decompresses in large blocks and splits records with bytes.find.
+    """
+    name = None
+    parts = []
+    pending = b''
+    line_start = True
+    with gzip.open(path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            data = pending + block
+            pending = b''
+            if block:
+                # Keep an incomplete trailing line for the next block so that headers are never split
+                cut = data.rfind(b'\n') + 1
+                if cut == 0 and not (line_start and data.startswith(b'>')):
+                    cut = len(data)
+                data, pending = data[:cut], data[cut:]
+
+            position = 0
+            at_header = line_start and data.startswith(b'>')
+            while position < len(data):
+                if at_header:
+                    header_end = data.find(b'\n', position)
+                    header_end = len(data) if header_end < 0 else header_end
+                    if name is not None:
+                        yield name, np.frombuffer(b''.join(parts), dtype=np.uint8)
+                    header = data[position:header_end].rstrip()
+                    name, parts = (header if headers else record_name(header)), []
+                    position = header_end + 1
+                    at_header = False
+                    continue
+                next_header = data.find(b'\n>', max(position - 1, 0))
+                stop = len(data) if next_header < 0 else next_header + 1
+                if name is not None:
+                    parts.append(data[position:stop].translate(UPPERCASE_TABLE, LINE_BREAKS))
+                position = stop
+                at_header = next_header >= 0
+            if data:
+                line_start = data.endswith(b'\n')
+            if not block:
+                break
+    if name is not None:
+        yield name, np.frombuffer(b''.join(parts), dtype=np.uint8)
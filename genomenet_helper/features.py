@@ -0,0 +1,159 @@
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .kmer_counting import decode_kmers
+from .kmer_harmonization import CHUNK_ROWS, read_header
+from .profile_store import METADATA_COLUMNS, iter_profile_store
+
+FEATURE_DTYPE = np.float32
+
+# Feature matrices with more nonzero entries than this are converted to dense arrays.
+SPARSE_DENSITY = 0.25
+
+# X is a float32 CSR matrix or dense array with one column per entry of columns (sorted k-mers).
+FeatureSet = namedtuple('FeatureSet', ['X', 'metadata', 'columns'])
+
+# Profiles that stay on disk and are streamed block by block (see iter_rows), for the incremental
+# model backends; rows are numbered across the files in order and sizes has the rows of every file.
+FeatureFiles = namedtuple('FeatureFiles', ['files', 'columns', 'chunk_rows', 'sizes'])
+
+def file_columns(path):
+    """
+    Returns the feature columns of a CSV file or profile store without loading its counts.
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as store:
+            return list(decode_kmers(store['column_codes'], int(store['kmer_size'])))
+    return [column for column in read_header(path) if column not in METADATA_COLUMNS]
+
+def feature_columns(files):
+    """
+    Returns the sorted union of the feature columns of the files.
+    """
+    columns = set()
+    for path in files:
+        columns.update(file_columns(path))
+    return sorted(columns)
+
+def _column_mapping(source_columns, positions):
+    return np.array([positions.get(column, -1) for column in source_columns], dtype=np.int64)
+
+def _aligned(counts, mapping, n_columns):
+    """
+    Moves the columns of a matrix to their positions in the feature columns (mapping, -1 for
+    columns that are dropped) and returns it as a CSR matrix.
+    """
+    counts = sparse.csr_matrix(counts, dtype=FEATURE_DTYPE)
+    target = mapping[counts.indices]
+    keep = target >= 0
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))[keep]
+    aligned = sparse.csr_matrix((counts.data[keep], (rows, target[keep])), shape=(counts.shape[0], n_columns))
+    aligned.sort_indices()
+    return aligned
+
+def iter_features(files, columns, chunk_rows=CHUNK_ROWS):
+    """
+    Yields (X, metadata) blocks of the files aligned to columns, one per chunk of chunk_rows rows of
+    a CSV file (parsed straight into float32) or profile store. X is a float32 CSR matrix; k-mers
+    the file does not have are 0, and columns not among `columns` are dropped.
+    """
+    positions = {column: position for position, column in enumerate(columns)}
+    for path in files:
+        if path.endswith('.npz'):
+            mapping = _column_mapping(file_columns(path), positions)
+            for counts, metadata in iter_profile_store(path, chunk_rows):
+                yield _aligned(counts, mapping, len(positions)), metadata
+            continue
+        source_columns = file_columns(path)
+        mapping = _column_mapping(source_columns, positions)
+        dtypes = {column: FEATURE_DTYPE for column in source_columns}
+        for chunk in pd.read_csv(path, dtype=dtypes, chunksize=chunk_rows):
+            values = np.nan_to_num(chunk[source_columns].to_numpy(dtype=FEATURE_DTYPE), copy=False)
+            yield _aligned(values, mapping, len(positions)), chunk[METADATA_COLUMNS].reset_index(drop=True)
+
+def file_rows(source, rows):
+    """
+    Splits sorted global row numbers of a FeatureFiles source by file; returns one array per file.
+    """
+    offsets = np.concatenate([[0], np.cumsum(source.sizes)])
+    return np.split(rows, np.searchsorted(rows, offsets[1:-1]))
+
+def iter_rows(source, index, rows, labels):
+    """
+    Streams the given rows (sorted global row numbers) of file `index` of a FeatureFiles source and
+    yields (X, y) blocks of them, one per block of iter_features; only one block is in memory at a time.
+    """
+    offset = int(np.sum(source.sizes[:index]))
+    for X, _ in iter_features([source.files[index]], source.columns, source.chunk_rows):
+        start, end = np.searchsorted(rows, [offset, offset + X.shape[0]])
+        if end > start:
+            yield X[rows[start:end] - offset], labels[rows[start:end]]
+        offset += X.shape[0]
+
+def stream_features(files, columns, chunk_rows=CHUNK_ROWS):
+    """
+    Returns a FeatureFiles source of the files and the metadata of all their rows, in row order.
+    """
+    metadata = [load_metadata([path]) for path in files]
+    source = FeatureFiles(list(files), columns, chunk_rows, [len(rows) for rows in metadata])
+    return source, pd.concat([pd.DataFrame(columns=METADATA_COLUMNS)] + metadata, ignore_index=True)
+
+def load_metadata(files):
+    """
+    Returns the metadata of every profile in the files, in row order, without keeping their counts.
+    """
+    metadata = [pd.DataFrame(columns=METADATA_COLUMNS)]
+    for path in files:
+        if path.endswith('.npz'):
+            with np.load(path) as store:
+                metadata.append(pd.DataFrame({column: store[f'meta_{column}'] for column in METADATA_COLUMNS}))
+        else:
+            metadata.append(pd.read_csv(path, usecols=METADATA_COLUMNS)[METADATA_COLUMNS])
+    return pd.concat(metadata, ignore_index=True)
+
+def load_features(files, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    Loads k-mer profiles from CSV files and profile stores (.npz) into one float32 feature matrix
+    aligned to columns (by default the union of the files' columns; missing k-mers are 0).
+    CSV files are parsed straight into float32 in chunks and kept sparse, so no wide float64 table
+    is ever built; the matrix is only made dense if more than SPARSE_DENSITY of it is nonzero.
+    Returns a FeatureSet.
+    """
+    if columns is None:
+        columns = feature_columns(files)
+    blocks, metadata = [sparse.csr_matrix((0, len(columns)), dtype=FEATURE_DTYPE)], [pd.DataFrame(columns=METADATA_COLUMNS)]
+    for X, block_metadata in iter_features(files, columns, chunk_rows):
+        blocks.append(X)
+        metadata.append(block_metadata)
+    X = sparse.vstack(blocks, format='csr')
+    if X.shape[0] * X.shape[1] and X.nnz > SPARSE_DENSITY * X.shape[0] * X.shape[1]:
+        X = X.toarray()
+    return FeatureSet(X, pd.concat(metadata, ignore_index=True), list(columns))
+
+def profile_settings(files):
+    """
+    Returns the k-mer size, canonical flag and profiling parameters recorded in every profile store
+    among files, by path; CSV files record none.
+    """
+    settings = {}
+    for path in files:
+        if path.endswith('.npz'):
+            with np.load(path) as store:
+                settings[path] = int(store['kmer_size']), bool(store['canonical']), json.loads(str(store['params']))
+    return settings
+
+def balanced_indices(labels, per_class, seed=None):
+    """
+    Returns sorted row indices with a random sample of per_class(class size) rows of every class.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.asarray(labels)
+    selected = []
+    for label in np.unique(labels):
+        rows = np.flatnonzero(labels == label)
+        selected.append(rng.choice(rows, size=min(per_class(len(rows)), len(rows)), replace=False))
+    return np.sort(np.concatenate(selected)) if selected else np.array([], dtype=np.int64)
@@ -0,0 +1,123 @@
+import os
+import re
+import glob
+
+import pandas as pd
+from Bio import bgzf
+
+from .fasta_reader import is_fasta
+from .materialize import read_file_manifest
+
+SHARD_INDEX_SUFFIX = '_fragments_index.tsv'
+INDEX_COLUMNS = ['fragment_id', 'genome', 'record', 'source_offset', 'length', 'shard', 'shard_offset']
+
+# Buffer size for shard and index writes.
+WRITE_BUFFER = 1 << 23
+
+class ShardWriter:
+    """
+    Appends fragments to multi-record FASTA shards of about shard_size_mb each, plus a TSV index that
+    maps every fragment to its source genome, record and offset and to its shard and shard offset.
+    With compress=True shards are BGZF (gzip compatible) and shard offsets are BGZF virtual offsets.
+    """
+
+    def __init__(self, output_dir, prefix, shard_size_mb=256, compress=False):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.shard_size = int(shard_size_mb * 1024 * 1024)
+        self.compress = compress
+        self.index_path = os.path.join(output_dir, f"{prefix}{SHARD_INDEX_SUFFIX}")
+        self.shard_number = 0
+        self.shard = None
+        self.raw = None
+        self.index = None
+
+    def shard_name(self, number):
+        extension = '.fasta.gz' if self.compress else '.fasta'
+        return f"{self.prefix}_fragments_{number:05d}{extension}"
+
+    def resume(self, state):
+        """
+        Truncates the shards and the index to a state returned by state(), dropping any partial genome.
+        """
+        self.shard_number = state['shard_number']
+        self._remove_shards_after(self.shard_number)
+        self._open_shard(state['shard_size'])
+        self.index = open(self.index_path, 'r+b', buffering=WRITE_BUFFER)
+        self.index.truncate(state['index_size'])
+        self.index.seek(state['index_size'])
+
+    def start(self):
+        self._remove_shards_after(-1)
+        self.index = open(self.index_path, 'wb', buffering=WRITE_BUFFER)
+        self.index.write(('\t'.join(INDEX_COLUMNS) + '\n').encode())
+        self._open_shard(0)
+
+    def _remove_shards_after(self, number):
+        pattern = re.compile(rf"{re.escape(self.prefix)}_fragments_(\d+)\.fasta(\.gz)?$")
+        for file_name in os.listdir(self.output_dir):
+            match = pattern.match(file_name)
+            if match and int(match.group(1)) > number:
+                os.remove(os.path.join(self.output_dir, file_name))
+
+    def _open_shard(self, size):
+        path = os.path.join(self.output_dir, self.shard_name(self.shard_number))
+        self.raw = open(path, 'r+b' if size and os.path.exists(path) else 'wb', buffering=WRITE_BUFFER)
+        self.raw.truncate(size)
+        self.raw.seek(size)
+        self.shard = bgzf.BgzfWriter(fileobj=self.raw) if self.compress else self.raw
+
+    def _close_shard(self):
+        if self.compress:
+            self.shard.close()  # also closes the raw file
+        else:
+            self.raw.close()
+
+    def write_genome(self, genome, fragments):
+        """
+        Appends the fragments of one genome; fragments are (fragment_id, record, source_offset, sequence bytes).
+        """
+        rows = []
+        for fragment_id, record, source_offset, sequence in fragments:
+            if self.raw.tell() >= self.shard_size:
+                self._close_shard()
+                self.shard_number += 1
+                self._open_shard(0)
+            shard_offset = self.shard.tell()
+            self.shard.write(f">{fragment_id}\n".encode() + sequence + b"\n")
+            rows.append(f"{fragment_id}\t{genome}\t{record}\t{source_offset}\t{len(sequence)}\t{self.shard_name(self.shard_number)}\t{shard_offset}\n")
+        self.index.write(''.join(rows).encode())
+
+    def state(self):
+        """
+        Flushes everything written so far and returns the position to resume from.
+        """
+        self.shard.flush()
+        self.index.flush()
+        return {'shard_number': self.shard_number, 'shard_size': self.raw.tell(), 'index_size': self.index.tell()}
+
+    def close(self):
+        self._close_shard()
+        self.index.close()
+
+def read_shard_index(index_path):
+    return pd.read_csv(index_path, sep='\t')
+
+def shard_index_files(folder):
+    return sorted(glob.glob(os.path.join(folder, f"*{SHARD_INDEX_SUFFIX}")))
+
+def count_fragments(folder):
+    """
+    Counts the sequences in a dataset folder: individual FASTA files (including those listed in a
+    file manifest) plus fragments packed in shards.
+    """
+    index_files = shard_index_files(folder)
+    shards = set()
+    n_fragments = 0
+    for index_path in index_files:
+        index = read_shard_index(index_path)
+        shards.update(index['shard'].unique())
+        n_fragments += len(index)
+    file_names = os.listdir(folder) + [name for name, _ in read_file_manifest(folder)]
+    n_files = sum(1 for f in file_names if is_fasta(f) and f not in shards)
+    return n_files + n_fragments
@@ -2,39 +2,46 @@ import subprocess
 import tempfile
 import os
 import shutil
-import gzip
-import requests
 import re
-from ftplib import FTP
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
+from .download_engine import DEFAULT_PER_HOST, DEFAULT_WORKERS, Downloader
+from .download_state import get_entries, open_state, pending_accessions, record_done, record_failed
+from .fasta_normalize import DEFAULT_LINE_WIDTH, normalize_fasta
+
+# Source URLs; override them (e.g. with --ena_url / --patric_url) to use a mirror or a local test server.
+ENA_URL_TEMPLATE = "https://www.ebi.ac.uk/ena/browser/api/fasta/{id}?download=true"
+PATRIC_URL_TEMPLATE = "ftp://ftp.patricbrc.org/genomes/{id}/{id}.fna"
+
+# ncbi-genome-download archives are post-processed once they have not changed for this long.
+ARCHIVE_SETTLE_SECONDS = 5
+POLL_SECONDS = 1
 
 # Global output directory for all genomes
 output_dir = "genome_downloads"
 os.makedirs(output_dir, exist_ok=True)
 
-def download_patric_genomes(patric_ids):
-    ftp_server = "ftp.patricbrc.org"
-    ftp_path = "/genomes/"
-    
+def download_patric_genomes(patric_ids, url_template=PATRIC_URL_TEMPLATE, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, verify=False):
     # Use the same output directory as for NCBI and ENA genomes
     os.makedirs(output_dir, exist_ok=True)
 
-    for patric_id in patric_ids:
-        file_name = f"{patric_id}.fna"
-        local_file_path = os.path.join(output_dir, file_name)
-        remote_file_path = f"{ftp_path}{patric_id}/{file_name}"
-
-        print(f"Downloading: {patric_id}")
-
-        with FTP(ftp_server) as ftp:
-            ftp.login()  # anonymous login
-            with open(local_file_path, 'wb') as local_file:
-                try:
-                    ftp.retrbinary(f"RETR {remote_file_path}", local_file.write)
-                except Exception as e:
-                    print(f"Error downloading {patric_id}: {e}")
-                    if os.path.exists(local_file_path):
-                        os.remove(local_file_path)
+    connection = open_state(output_dir)
+    pending_ids = pending_accessions(connection, patric_ids, 'patric', output_dir, verify)
+    if len(pending_ids) < len(patric_ids):
+        print(f"Skipping {len(patric_ids) - len(pending_ids)} PATRIC genomes that were already downloaded.")
+
+    jobs = [(patric_id, url_template.format(id=patric_id), os.path.join(output_dir, f"{patric_id}.fna")) for patric_id in sorted(pending_ids)]
+    print(f"Downloading {len(jobs)} PATRIC genomes to: {output_dir}")
+    with Downloader(workers, per_host) as downloader:
+        for patric_id, path, error in downloader.download_all(jobs):
+            if error:
+                print(f"Error downloading {patric_id}: {error}")
+                record_failed(connection, patric_id, 'patric', error)
+            else:
+                record_done(connection, patric_id, 'patric', path)
+    connection.close()
 
     # Calculate and print the download summary
     successful_downloads = [id for id in patric_ids if os.path.exists(os.path.join(output_dir, f"{id}.fna"))]
@@ -45,7 +52,14 @@ def is_patric_id(genome_id):
     # PATRIC IDs are typically numeric with a period and another number
     return re.match(r'^\d+\.\d+$', genome_id)
 
-def reformat_and_download_genome_ids(input_file):
+def reformat_and_download_genome_ids(input_file, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST,
+                                     ena_url=ENA_URL_TEMPLATE, patric_url=PATRIC_URL_TEMPLATE, verify=False,
+                                     line_width=DEFAULT_LINE_WIDTH, compress=False):
+    """
+    Downloads all genomes listed in input_file into genome_downloads.
+    Progress is kept in a state store in genome_downloads (see download_state), so a rerun only
+    downloads genomes that are missing, failed before or no longer match the recorded download.
+    """
     with open(input_file, 'r') as file:
         genome_ids = file.read().splitlines()
 
@@ -76,20 +90,43 @@ def reformat_and_download_genome_ids(input_file):
     print(f"Identified {patric_genomes} PATRIC genome identifiers for download.")
 
     if ncbi_ids:
-        download_ncbi_genomes(ncbi_ids, processed_ids)
+        download_ncbi_genomes(ncbi_ids, processed_ids, verify, workers, line_width, compress)
 
     if ena_ids:
-        reformat_and_download_ena_genome_ids(ena_ids)
+        reformat_and_download_ena_genome_ids(ena_ids, ena_url, workers, per_host, verify)
 
     if patric_ids:
-        download_patric_genomes(patric_ids)
-
+        download_patric_genomes(patric_ids, patric_url, workers, per_host, verify)
+
+
+def ncbi_output_name(file_name):
+    """
+    Returns the accession and output name of an ncbi-genome-download archive,
+    e.g. GCA_000001.1_ASM1v1_genomic.fna.gz -> (GCA_000001.1, GCA_000001).
+    """
+    # Extract the base name without the version and additional text
+    base_name = file_name.split('_genomic.fna.gz')[0]
+    accession = '_'.join(base_name.split('_')[:2])
+    return accession, '.'.join(base_name.split('.')[:-1])  # Remove version
+
+def download_ncbi_genomes(ncbi_ids, processed_ids, verify=False, workers=DEFAULT_WORKERS,
+                          line_width=DEFAULT_LINE_WIDTH, compress=False):
+    """
+    Runs ncbi-genome-download and post-processes every archive as soon as it is complete, while the
+    download continues: a thread pool decompresses it straight into genome_downloads with uppercase
+    sequences wrapped at line_width (BGZF-compressed with compress=True) and caches its statistics.
+    """
+    connection = open_state(output_dir)
+    pending_ids = pending_accessions(connection, ncbi_ids, 'ncbi', output_dir, verify)
+    if len(pending_ids) < len(ncbi_ids):
+        print(f"Skipping {len(ncbi_ids) - len(pending_ids)} NCBI genomes that were already downloaded.")
+    if not pending_ids:
+        connection.close()
+        return
+    ncbi_ids = pending_ids
 
-def download_ncbi_genomes(ncbi_ids, processed_ids):
-    temp_dir = tempfile.mkdtemp(prefix="ncbi_downloads_")
-    temp_file = tempfile.NamedTemporaryFile(mode='w+', dir=temp_dir, delete=False)
-    temp_file_path = temp_file.name
     # Create a temporary directory for the downloads
+    temp_dir = tempfile.mkdtemp(prefix="ncbi_downloads_")
     print(f"Temporary download directory: {temp_dir}")
 
     # Write the IDs to a temporary file
@@ -106,7 +143,6 @@ def download_ncbi_genomes(ncbi_ids, processed_ids):
         '--assembly-accessions', temp_file_path,
         '--section', 'genbank',
         '--parallel', '5',
-        '--no-cache',        
         '--output-folder', temp_dir,
         '--flat-output',
         '--retries', '10',
@@ -114,65 +150,90 @@ def download_ncbi_genomes(ncbi_ids, processed_ids):
         '--verbose', 'all'
     ]
 
-    # Execute the download command
+    # Execute the download command; its output goes to a log file so that it cannot block on a full pipe
     print(f"Starting the download of {len(ncbi_ids)} NCBI genomes...")
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    log_path = os.path.join(temp_dir, 'ncbi-genome-download.log')
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, text=True)
+        downloaded_files = postprocess_ncbi_archives(process, temp_dir, connection, workers, line_width, compress)
 
     # Check the results of the download
-    if result.returncode == 0:
+    if process.returncode == 0:
         print("Finished download successfully.")
     else:
-        print(f"Download failed with error: {result.stderr}")
+        with open(log_path) as log:
+            print(f"Download failed with error: {''.join(log.readlines()[-20:])}")
 
-    # Unpack and rename the files
-    unpack_and_rename(temp_dir, processed_ids, ncbi_ids)
-
-    # Move files to the output directory
-    move_files_to_output_dir(temp_dir, output_dir)
-
-    # Optionally, remove the temp directory
+    # Compare downloaded files with the expected list
+    compare_downloaded_with_expected(downloaded_files, ncbi_ids, temp_dir)
+    recorded = get_entries(connection, 'ncbi')
+    for ncbi_id in ncbi_ids:
+        if recorded.get(ncbi_id, {}).get('status') != 'done':
+            record_failed(connection, ncbi_id, 'ncbi', "missing or empty after ncbi-genome-download")
+    connection.close()
+
+    # Remove the temp directory with the downloaded archives
     shutil.rmtree(temp_dir)
 
-    # Cleanup: remove the temporary file
-    #os.remove(temp_file_path)
-    # Optionally, you could also remove the temp directory if you want everything cleaned up
-    # shutil.rmtree(temp_dir)
-
-def unpack_and_rename(download_dir, processed_ids, ncbi_ids):
+def postprocess_ncbi_archives(process, download_dir, connection, workers=DEFAULT_WORKERS,
+                              line_width=DEFAULT_LINE_WIDTH, compress=False):
+    """
+    Normalizes the archives that ncbi-genome-download writes to download_dir while the process runs.
+    An archive is picked up once its size has not changed for ARCHIVE_SETTLE_SECONDS; one that turns
+    out to be incomplete (or is rewritten by a retry) is processed again when it changes.
+    Returns the output names of the genomes written.
+    """
+    extension = '.fasta.gz' if compress else '.fasta'
     downloaded_files = []
-    for file_name in os.listdir(download_dir):
-        if file_name.endswith('.gz'):
-            # Extract the base name without the version and additional text
-            base_name = file_name.split('_genomic.fna.gz')[0]
-            stripped_base_name = '.'.join(base_name.split('.')[:-1])  # Remove version
-
-            # Construct the full paths
-            gz_file_path = os.path.join(download_dir, file_name)
-            fasta_file_path = os.path.join(download_dir, stripped_base_name + '.fasta')
-
-            # Unzip the file
-            with gzip.open(gz_file_path, 'rb') as f_in:
-                with open(fasta_file_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-
-            # Check if the file is empty
-            if os.path.getsize(fasta_file_path) == 0:
-                print(f"Warning: {fasta_file_path} is empty. Removing file.")
-                os.remove(fasta_file_path)
-            else:
-                downloaded_files.append(stripped_base_name)
-
-            # Remove the original .gz file
-            os.remove(gz_file_path)
-
-    # Compare downloaded files with the expected list
-    compare_downloaded_with_expected(downloaded_files, ncbi_ids, download_dir)
-
-def move_files_to_output_dir(temp_dir, output_dir):
-    for file_name in os.listdir(temp_dir):
-        source_file = os.path.join(temp_dir, file_name)
-        if os.path.isfile(source_file) and file_name.endswith('.fasta'):
-            shutil.move(source_file, os.path.join(output_dir, file_name))
+    processed = {}  # archive name -> (size, mtime) it was submitted with
+    observed = {}  # archive name -> (size, mtime, first seen)
+    futures = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            running = process.poll() is None
+            now = time.monotonic()
+            in_progress = set(futures.values())
+            for file_name in os.listdir(download_dir):
+                if not file_name.endswith('_genomic.fna.gz'):
+                    continue
+                stat = os.stat(os.path.join(download_dir, file_name))
+                version = (stat.st_size, stat.st_mtime_ns)
+                if processed.get(file_name) == version or file_name in in_progress:
+                    continue
+                if observed.get(file_name, (None, None, None))[:2] != version:
+                    observed[file_name] = version + (now,)
+                if running and now - observed[file_name][2] < ARCHIVE_SETTLE_SECONDS:
+                    continue
+                processed[file_name] = version
+                accession, name = ncbi_output_name(file_name)
+                future = executor.submit(normalize_fasta, os.path.join(download_dir, file_name),
+                                         os.path.join(output_dir, name + extension), line_width)
+                futures[future] = file_name
+
+            for future in [future for future in futures if future.done()]:
+                file_name = futures.pop(future)
+                accession, name = ncbi_output_name(file_name)
+                path = os.path.join(output_dir, name + extension)
+                try:
+                    stats = future.result()
+                except (EOFError, OSError, zlib.error) as e:
+                    if running:
+                        continue  # most likely still being written; retried when it changes
+                    print(f"Error processing {file_name}: {e}")
+                    continue
+                if stats['length'] == 0:
+                    # Check if the file is empty
+                    print(f"Warning: {path} is empty. Removing file.")
+                    os.remove(path)
+                    continue
+                downloaded_files.append(name)
+                record_done(connection, accession, 'ncbi', path, stats['hash'])
+
+            if not running and not futures:
+                break
+            time.sleep(POLL_SECONDS)
+    return downloaded_files
 
 def compare_downloaded_with_expected(downloaded_files, ncbi_ids, download_dir):
     # Only consider NCBI IDs for comparison
@@ -195,50 +256,37 @@ def compare_downloaded_with_expected(downloaded_files, ncbi_ids, download_dir):
             report_file.write(downloaded_id + '\n')
 
 
-def reformat_and_download_ena_genome_ids(ena_ids):
+def reformat_and_download_ena_genome_ids(ena_ids, url_template=ENA_URL_TEMPLATE, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, verify=False):
     # No need to read from a file, as we already have the ENA IDs in a set
     total_genomes = len(ena_ids)
     print(f"Found {total_genomes} ENA genome identifiers for download.")
 
     # Download genomes from ENA
     if ena_ids:
-        download_ena_genomes(ena_ids)
+        download_ena_genomes(ena_ids, url_template, workers, per_host, verify)
 
-def download_ena_genomes(genome_ids):
+def download_ena_genomes(genome_ids, url_template=ENA_URL_TEMPLATE, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, verify=False):
     print(f"Downloading ENA genomes to: {output_dir}")
 
-    downloaded_files = []
+    connection = open_state(output_dir)
+    pending_ids = pending_accessions(connection, genome_ids, 'ena', output_dir, verify)
+    if len(pending_ids) < len(genome_ids):
+        print(f"Skipping {len(genome_ids) - len(pending_ids)} ENA genomes that were already downloaded.")
+
+    downloaded_files = sorted(set(genome_ids) - pending_ids)
     failed_downloads = []
-    
-    # URL components
-    url_prefix = "https://www.ebi.ac.uk/ena/browser/api/fasta/"
-    url_suffix = "?download=true"
-
-    for ena_id in genome_ids:
-        # Construct the URL
-        url = f"{url_prefix}{ena_id}{url_suffix}"
-        
-        # File path in the output directory
-        file_path = os.path.join(output_dir, f"{ena_id}.fasta")
-        
-        # Download the file
-        print(f"Downloading: {ena_id}")
-        response = requests.get(url)
-        
-        # Check if the download was successful (response code 200)
-        if response.status_code == 200:
-            with open(file_path, 'wb') as file:
-                file.write(response.content)
-            # Check if the file is empty
-            if os.path.getsize(file_path) > 0:
-                downloaded_files.append(ena_id)
-            else:
-                print(f"Warning: File {file_path} is empty")
+
+    jobs = [(ena_id, url_template.format(id=ena_id), os.path.join(output_dir, f"{ena_id}.fasta")) for ena_id in sorted(pending_ids)]
+    with Downloader(workers, per_host) as downloader:
+        for ena_id, path, error in downloader.download_all(jobs):
+            if error:
+                print(f"Failed to download {ena_id}: {error}")
                 failed_downloads.append(ena_id)
-                os.remove(file_path)
-        else:
-            print(f"Failed to download {ena_id}")
-            failed_downloads.append(ena_id)
+                record_failed(connection, ena_id, 'ena', error)
+            else:
+                downloaded_files.append(ena_id)
+                record_done(connection, ena_id, 'ena', path)
+    connection.close()
 
     generate_reports_ena(downloaded_files, failed_downloads, genome_ids)
 
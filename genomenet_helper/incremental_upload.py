@@ -0,0 +1,154 @@
+import io
+import os
+import gzip
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from b2sdk.v2.exception import FileNotPresent
+
+from .fasta_cache import get_content_hashes
+from .materialize import FILE_MANIFEST, read_file_manifest
+from .stream_upload import DEFAULT_UPLOAD_WORKERS
+
+# Remote layout: content-addressed blobs and packs, and the numbered manifests of every dataset.
+BLOB_PREFIX = 'blobs/'
+PACK_PREFIX = 'packs/'
+DATASET_PREFIX = 'datasets/'
+
+# Files smaller than this are packed together into objects of about PACK_SIZE bytes.
+PACK_THRESHOLD = 1 << 20
+PACK_SIZE = 64 << 20
+
+MANIFEST_COLUMNS = ['split', 'path', 'hash', 'size', 'object', 'offset']
+
+def dataset_files(split_folders):
+    """
+    Returns the (split, path in the split, path on disk) of every file in the split folders.
+    Files behind symlinks count as files; manifest-mode folders (see materialize) contribute their
+    source files under the listed names.
+    """
+    files = []
+    for split, folder in split_folders.items():
+        manifest = read_file_manifest(folder)
+        for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+            dirnames.sort()
+            for f in sorted(filenames):
+                if manifest and dirpath == folder and f == FILE_MANIFEST:
+                    continue
+                path = os.path.join(dirpath, f)
+                files.append((split, os.path.relpath(path, folder), path))
+        files.extend((split, name, source) for name, source in manifest)
+    return files
+
+def blob_name(file_hash):
+    return f"{BLOB_PREFIX}{file_hash[:2]}/{file_hash}"
+
+def manifest_name(dataset, version):
+    return f"{DATASET_PREFIX}{dataset}/manifest-{version:06d}.tsv.gz"
+
+def read_remote_manifest(bucket, dataset):
+    """
+    Returns the latest version number of a dataset and its manifest entries (dicts with the
+    MANIFEST_COLUMNS), or (0, []) for a new dataset.
+    """
+    prefix = f"{DATASET_PREFIX}{dataset}/"
+    versions = [int(file_version.file_name[len(prefix) + len('manifest-'):-len('.tsv.gz')])
+                for file_version, _ in bucket.ls(prefix)
+                if file_version.file_name.startswith(prefix + 'manifest-') and file_version.file_name.endswith('.tsv.gz')]
+    if not versions:
+        return 0, []
+    buffer = io.BytesIO()
+    bucket.download_file_by_name(manifest_name(dataset, max(versions))).save(buffer)
+    lines = gzip.decompress(buffer.getvalue()).decode().splitlines()
+    header = lines[0].split('\t')
+    entries = [dict(zip(header, line.split('\t'))) for line in lines[1:] if line]
+    for entry in entries:
+        entry['size'], entry['offset'] = int(entry['size']), int(entry['offset'])
+    return max(versions), entries
+
+def write_remote_manifest(bucket, dataset, version, entries):
+    lines = ['\t'.join(MANIFEST_COLUMNS)] + ['\t'.join(str(entry[column]) for column in MANIFEST_COLUMNS) for entry in entries]
+    data = gzip.compress(('\n'.join(lines) + '\n').encode(), mtime=0)
+    bucket.upload_bytes(data, manifest_name(dataset, version), 'application/gzip')
+    return manifest_name(dataset, version)
+
+def blob_exists(bucket, name):
+    try:
+        bucket.get_file_info_by_name(name)
+        return True
+    except FileNotPresent:
+        return False
+
+def _upload_blob(bucket, name, path):
+    if not blob_exists(bucket, name):
+        bucket.upload_local_file(local_file=path, file_name=name)
+
+def _upload_pack(bucket, data, members, stored):
+    """
+    Uploads a pack and records the pack and offset of its (hash, offset) members in stored.
+    Packs are named by their content, and a run packs the same new contents in the same order, so a
+    pack that is already in the bucket (e.g. from an interrupted run) is not uploaded again.
+    """
+    name = PACK_PREFIX + hashlib.blake2b(data, digest_size=20).hexdigest()
+    if not blob_exists(bucket, name):
+        bucket.upload_bytes(data, name, 'application/octet-stream')
+    for file_hash, offset in members:
+        stored[file_hash] = (name, offset)
+
+def upload_incremental(bucket, split_folders, dataset, workers=1, upload_workers=DEFAULT_UPLOAD_WORKERS):
+    """
+    Uploads a new version of a dataset (split name -> folder) as content-addressed objects and a manifest
+    listing the split, path, content hash and size of every file and where its content is stored.
+    Files whose content is already referenced by the previous manifest are not uploaded again; new
+    files are uploaded as blobs named by their hash, or, if smaller than PACK_THRESHOLD, packed
+    together (the manifest stores the pack and offset). Blobs and packs that are already in the
+    bucket, e.g. from an interrupted run, are skipped. Returns the manifest name and the number of new bytes.
+    """
+    files = dataset_files(split_folders)
+    print(f"Hashing {len(files)} files")
+    hashes = get_content_hashes([path for _, _, path in files], workers)
+    previous_version, previous_entries = read_remote_manifest(bucket, dataset)
+    stored = {entry['hash']: (entry['object'], entry['offset']) for entry in previous_entries}
+    print(f"Previous version of {dataset}: {previous_version or 'none'}")
+
+    # Every new content is uploaded once, however many files have it
+    new_contents = {}
+    for (_, _, path), file_hash in zip(files, hashes):
+        if file_hash not in stored and file_hash not in new_contents:
+            new_contents[file_hash] = path
+    new_bytes = sum(os.path.getsize(path) for path in new_contents.values())
+    print(f"{len(new_contents)} new contents ({new_bytes / (1024 ** 3):.2f} GB) to upload, "
+          f"{len(files) - sum(1 for file_hash in hashes if file_hash in new_contents)} files are unchanged")
+
+    # Large contents become blobs, small ones are packed; at most upload_workers uploads are pending
+    pending = deque()
+    pack, pack_members = bytearray(), []
+    with ThreadPoolExecutor(upload_workers) as pool:
+        for file_hash, path in new_contents.items():
+            if os.path.getsize(path) >= PACK_THRESHOLD:
+                stored[file_hash] = (blob_name(file_hash), 0)
+                task = (_upload_blob, bucket, blob_name(file_hash), path)
+            else:
+                with open(path, 'rb') as f:
+                    pack_members.append((file_hash, len(pack)))
+                    pack += f.read()
+                if len(pack) < PACK_SIZE:
+                    continue
+                task = (_upload_pack, bucket, bytes(pack), pack_members, stored)
+                pack, pack_members = bytearray(), []
+            if len(pending) >= upload_workers:
+                pending.popleft().result()
+            pending.append(pool.submit(*task))
+        if pack:
+            pending.append(pool.submit(_upload_pack, bucket, bytes(pack), pack_members, stored))
+        while pending:
+            pending.popleft().result()
+
+    entries = []
+    for (split, relative_path, path), file_hash in zip(files, hashes):
+        object_name, offset = stored[file_hash]
+        entries.append({'split': split, 'path': relative_path, 'hash': file_hash, 'size': os.path.getsize(path),
+                        'object': object_name, 'offset': offset})
+    name = write_remote_manifest(bucket, dataset, previous_version + 1, entries)
+    return name, new_bytes
@@ -0,0 +1,106 @@
+from functools import lru_cache
+
+import numpy as np
+
+# Largest k for which the column index lists every possible k-mer (4^12 = 16.7M columns); larger k
+# are indexed by the k-mers that occur.
+MAX_DENSE_KMER_SIZE = 12
+
+# Lookup table mapping ASCII bytes to 2-bit nucleotide codes. Every other byte maps to 4.
+ENCODE_TABLE = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    ENCODE_TABLE[_base] = _code
+    ENCODE_TABLE[_base + 32] = _code  # lowercase
+
+DECODE_TABLE = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def encode_sequence(sequence):
+    """
+    Returns the 2-bit codes (A=0, C=1, G=2, T=3) of a sequence given as str, bytes or uint8 array.
+    Ambiguous bases (N, IUPAC codes, ...) are encoded as 4.
+    """
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+    if isinstance(sequence, np.ndarray):
+        return ENCODE_TABLE[sequence.view(np.uint8)]
+    return ENCODE_TABLE[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def kmer_codes(codes, kmer_size, canonical=False):
+    """
+    Returns the integer code of every k-mer window of an encoded sequence.
+    Windows containing an ambiguous base are dropped, so k-mers never span an N-break.
+    With canonical=True the smaller of a k-mer and its reverse complement is returned.
+    """
+    n_windows = len(codes) - kmer_size + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    invalid = codes > 3
+    invalid_prefix = np.concatenate(([0], np.cumsum(invalid, dtype=np.int64)))
+    valid_windows = (invalid_prefix[kmer_size:] - invalid_prefix[:-kmer_size]) == 0
+
+    values = np.where(invalid, 0, codes).astype(np.int64)
+    forward = np.zeros(n_windows, dtype=np.int64)
+    for offset in range(kmer_size):
+        forward = (forward << 2) | values[offset:offset + n_windows]
+
+    if canonical:
+        reverse = np.zeros(n_windows, dtype=np.int64)
+        for offset in range(kmer_size):
+            reverse |= (3 - values[offset:offset + n_windows]) << (2 * offset)
+        forward = np.minimum(forward, reverse)
+
+    return forward[valid_windows]
+
+
+@lru_cache(maxsize=None)
+def kmer_column_codes(kmer_size, canonical=False):
+    """
+    Returns the k-mer codes that make up the fixed, lexicographically ordered column index.
+    In canonical mode only codes that are their own canonical representative are kept.
+    """
+    codes = np.arange(4 ** kmer_size, dtype=np.int64)
+    if not canonical:
+        return codes
+    reverse = np.zeros_like(codes)
+    for offset in range(kmer_size):
+        reverse |= (3 - ((codes >> (2 * (kmer_size - 1 - offset))) & 3)) << (2 * offset)
+    return codes[codes <= reverse]
+
+
+def decode_kmers(codes, kmer_size):
+    """
+    Converts integer k-mer codes back to their nucleotide strings.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    letters = np.empty((len(codes), kmer_size), dtype=np.uint8)
+    for offset in range(kmer_size):
+        letters[:, offset] = DECODE_TABLE[(codes >> (2 * (kmer_size - 1 - offset))) & 3]
+    return [kmer.decode('ascii') for kmer in letters.view(f'S{kmer_size}').ravel()]
+
+
+def encode_kmers(kmers):
+    """
+    Converts equal-length k-mer strings to their integer codes.
+    """
+    if not len(kmers):
+        return np.empty(0, dtype=np.int64)
+    kmer_size = len(kmers[0])
+    letters = encode_sequence(''.join(kmers)).reshape(-1, kmer_size).astype(np.int64)
+    codes = np.zeros(len(kmers), dtype=np.int64)
+    for offset in range(kmer_size):
+        codes = (codes << 2) | letters[:, offset]
+    return codes
+
+
+def count_kmers_sparse(sequence, kmer_size, canonical=False):
+    """
+    Counts the k-mers of a sequence and returns the occurring columns of the column index of
+    kmer_column_codes(kmer_size, canonical) with their counts, so no 4^k vector is built.
+    """
+    codes, counts = np.unique(kmer_codes(encode_sequence(sequence), kmer_size, canonical), return_counts=True)
+    if canonical:
+        codes = np.searchsorted(kmer_column_codes(kmer_size, canonical=True), codes)
+    return codes, counts
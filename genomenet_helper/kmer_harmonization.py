@@ -1,21 +1,101 @@
+import os
+import csv
+
+import numpy as np
 import pandas as pd
+from scipy import sparse
+
+from .kmer_counting import encode_kmers
+from .profile_store import METADATA_COLUMNS, save_profile_store
+from .utils import ordered_map
+
+# Rows read, aligned and written at a time, so memory does not depend on the file size.
+CHUNK_ROWS = 2000
+
+def read_header(path):
+    with open(path, newline='') as f:
+        return next(csv.reader(f), [])
+
+def harmonized_columns(file_paths):
+    """
+    Returns the sorted union of the k-mer columns of the files, reading only their header lines.
+    """
+    kmer_cols = set()
+    for path in file_paths:
+        kmer_cols.update(column for column in read_header(path) if column not in METADATA_COLUMNS)
+    return sorted(kmer_cols)
 
-def harmonize_kmer_headers(*file_paths):
-    # Load all CSV files into dataframes
-    dataframes = [pd.read_csv(file) for file in file_paths]
+def harmonize_file(task):
+    """
+    Rewrites one CSV file with the metadata columns followed by kmer_cols (missing k-mers are 0),
+    streaming it in chunks of chunk_rows rows into a temporary file that replaces the original when
+    complete. A file whose header already matches is not rewritten. With collect=True, the k-mer
+    counts are also returned as a CSR matrix together with the metadata. Runs in a worker process.
+    """
+    path, kmer_cols, collect, chunk_rows = task
+    columns = METADATA_COLUMNS + kmer_cols
+    rewrite = read_header(path) != columns
+    if not rewrite and not collect:
+        return path, False, None
 
-    # Get the union of k-mer columns from all files
-    kmer_cols = sorted(set.union(*(set(df.columns) - {'unique_id', 'file_name', 'sample_id', 'class'} for df in dataframes)))
+    part_path = path + '.part'
+    blocks, metadata = [], []
+    try:
+        with open(part_path, 'w', newline='') if rewrite else open(os.devnull, 'w') as out:
+            header = True
+            for chunk in pd.read_csv(path, chunksize=chunk_rows):
+                chunk = chunk.reindex(columns=columns, fill_value=0)
+                if rewrite:
+                    chunk.to_csv(out, index=False, header=header)
+                    header = False
+                if collect:
+                    blocks.append(sparse.csr_matrix(chunk[kmer_cols].to_numpy(dtype=np.uint32)))
+                    metadata.append(chunk[METADATA_COLUMNS])
+            if rewrite and header:
+                out.write(','.join(columns) + '\n')  # file without rows
+    except BaseException:
+        if rewrite and os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    if rewrite:
+        os.replace(part_path, path)
+    if not collect:
+        return path, rewrite, None
+    counts = sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, len(kmer_cols)), dtype=np.uint32)
+    metadata = pd.concat(metadata, ignore_index=True) if metadata else pd.DataFrame(columns=METADATA_COLUMNS)
+    return path, rewrite, (counts, metadata)
 
-    # Rearrange and fill missing k-mers with 0s, then overwrite the original file
-    for df, file in zip(dataframes, file_paths):
-        # Ensure only k-mer columns that are missing are added
-        missing_cols = [col for col in kmer_cols if col not in df.columns]
-        df = df.reindex(columns=df.columns.tolist() + missing_cols, fill_value=0)
+def harmonize_kmer_headers(*file_paths, workers=1, chunk_rows=CHUNK_ROWS, store_path=None, canonical=False, max_subseqs=None,
+                           subsequence_size=None):
+    """
+    Aligns k-mer profile CSV files to a common column layout: the metadata columns followed by the
+    sorted union of all k-mer columns. Only the header lines are read to build the union; each file is
+    then streamed in chunks (files in parallel with `workers` processes) and atomically replaced.
+    With store_path, all profiles are also written as a single profile store (.npz, see
+    profile_store), which training can load without parsing text. CSV files do not say how their
+    profiles were made, so canonical, max_subseqs and subsequence_size are recorded in the store
+    as given, like the parameters of stores written by kmer profiling.
+    """
+    kmer_cols = harmonized_columns(file_paths)
+    kmer_sizes = {len(kmer) for kmer in kmer_cols}
+    if store_path is not None and len(kmer_sizes) > 1:
+        # Checked before any file is rewritten
+        raise ValueError(f"The files mix k-mer sizes {sorted(kmer_sizes)}; they cannot be stored in one profile store")
+    print(f"Harmonizing {len(file_paths)} files to {len(kmer_cols)} k-mer columns")
 
-        # Reorder all columns to match the sorted k-mer list
-        non_kmer_cols = ['unique_id', 'file_name', 'sample_id', 'class']
-        df = df[non_kmer_cols + kmer_cols]
+    blocks, metadata = [], []
+    tasks = ((path, kmer_cols, store_path is not None, chunk_rows) for path in file_paths)
+    for path, rewritten, collected in ordered_map(harmonize_file, tasks, workers):
+        print(f"{path}: {'rewritten' if rewritten else 'already harmonized'}")
+        if collected is not None:
+            blocks.append(collected[0])
+            metadata.append(collected[1])
 
-        # Save the harmonized dataframe
-        df.to_csv(file, index=False)
+    if store_path is not None:
+        counts = sparse.vstack(blocks, format='csr')
+        params = {'harmonized_from': list(file_paths)}
+        if max_subseqs is not None and subsequence_size is not None:
+            params.update(max_subseqs=max_subseqs, subsequence_size=subsequence_size, random_mode=False, seed=None)
+        save_profile_store(store_path, counts, pd.concat(metadata, ignore_index=True), encode_kmers(kmer_cols),
+                           kmer_sizes.pop() if kmer_sizes else 0, canonical, params=params)
+        print(f"Wrote {counts.shape[0]} profiles with {counts.shape[1]} k-mers to {store_path}")
@@ -1,47 +1,85 @@
 import os
 import subprocess
-from Bio import SeqIO
+import numpy as np
 import pandas as pd
+from scipy import sparse
 import tempfile
-import random
 import logging
 
-def process_fasta(fasta_path, max_subseqs=20, kmer_size=7, subsequence_size=2000, temp_dir="", random_mode=False):
-    output_files = []
-    total_seq = 0
-
-    for record in SeqIO.parse(fasta_path, "fasta"):
-        seq_str = str(record.seq)
+from .fasta_cache import get_fasta_index
+from .fasta_reader import fasta_stem, is_fasta, read_records
+from .kmer_counting import MAX_DENSE_KMER_SIZE, count_kmers_sparse, encode_kmers, kmer_column_codes
+from .profile_store import compress_columns, export_profile_csv, save_profile_store
+from .utils import genome_rng, ordered_map
 
+def select_subsequences(fasta_path, max_subseqs=20, subsequence_size=2000, random_mode=False, seed=None):
+    """
+    Returns the subsequences of each record in fasta_path that will be profiled.
+    In random mode the chunks are drawn from a generator keyed on the seed and the file name.
+    """
+    rng = genome_rng(seed, fasta_path) if random_mode else None
+    subseqs = []
+    for _, sequence in read_records(fasta_path, get_fasta_index(fasta_path)):
         # Calculate non-overlapping subsequence start indices
-        subseq_start_indices = range(0, len(seq_str), subsequence_size)
-        
+        subseq_start_indices = range(0, len(sequence), subsequence_size)
+
         if random_mode:
             # Calculate the maximum number of non-overlapping subsequences
             max_possible_subseqs = len(subseq_start_indices)
             # Select a random sample without overlapping
-            chosen_indices = random.sample(subseq_start_indices, min(max_subseqs, max_possible_subseqs))
+            chosen = rng.choice(max_possible_subseqs, min(max_subseqs, max_possible_subseqs), replace=False)
+            chosen_indices = [subseq_start_indices[i] for i in chosen]
         else:
             # Use the first 'max_subseqs' subsequences
             chosen_indices = list(subseq_start_indices)[:max_subseqs]
 
-        subseqs = [seq_str[i:i+subsequence_size] for i in chosen_indices]
-        total_seq += len(subseqs)
+        subseqs.extend(sequence[i:i+subsequence_size] for i in chosen_indices)
+    return subseqs
+
+def resolve_backend(backend, kmer_size):
+    """
+    Picks the counting backend; 'auto' uses the in-process counter unless k is too large for a dense vector.
+    """
+    if backend == 'auto':
+        return 'numpy' if kmer_size <= MAX_DENSE_KMER_SIZE else 'jellyfish'
+    if backend == 'numpy' and kmer_size > MAX_DENSE_KMER_SIZE:
+        raise ValueError(f"The numpy backend supports k-mer sizes up to {MAX_DENSE_KMER_SIZE}; use the jellyfish backend for k={kmer_size}")
+    return backend
 
+def process_fasta(fasta_path, max_subseqs=20, kmer_size=7, subsequence_size=2000, temp_dir="", random_mode=False, backend='numpy', canonical=False, seed=None):
+    """
+    Counts the k-mers of the selected subsequences of fasta_path.
+    Returns a CSR matrix with one row per subsequence. Up to MAX_DENSE_KMER_SIZE its columns follow
+    kmer_column_codes(kmer_size, canonical); above it the column index is the raw k-mer code.
+    """
+    subseqs = select_subsequences(fasta_path, max_subseqs, subsequence_size, random_mode, seed)
+
+    if backend == 'numpy':
+        # Rows are built from the occurring k-mers only; a dense 4^k row per subsequence is too large for k=12
+        n_columns = len(kmer_column_codes(kmer_size, canonical))
+        rows = [count_kmers_sparse(subseq, kmer_size, canonical) for subseq in subseqs]
+        indptr = np.concatenate(([0], np.cumsum([len(columns) for columns, _ in rows])))
+        indices = np.concatenate([columns for columns, _ in rows]) if rows else np.empty(0, dtype=np.int64)
+        data = np.concatenate([counts for _, counts in rows]).astype(np.uint32) if rows else np.empty(0, dtype=np.uint32)
+        profiles = sparse.csr_matrix((data, indices, indptr), shape=(len(subseqs), n_columns))
+    else:
+        output_files = []
         for idx, subseq in enumerate(subseqs):
             subseq_file = os.path.join(temp_dir, f"subseq_{idx}.fasta")
-            with open(subseq_file, "w") as f:
-                f.write(f">subseq_{idx}\n{subseq}")
-            run_jellyfish(subseq_file, kmer_size, temp_dir)
+            with open(subseq_file, "wb") as f:
+                f.write(f">subseq_{idx}\n".encode() + subseq.tobytes())
+            run_jellyfish(subseq_file, kmer_size, temp_dir, canonical)
             output_files.append(os.path.join(temp_dir, f"{os.path.basename(subseq_file).replace('.fasta', '')}_jf_formatted.csv"))
-    
-    logging.info(f"Processed {total_seq} sequences from {fasta_path}")
-    return output_files
+        profiles = read_jellyfish_output(output_files, kmer_size, canonical)
+
+    logging.info(f"Processed {len(subseqs)} sequences from {fasta_path}")
+    return profiles
 
 
-def run_jellyfish(fasta_path, kmer_size, temp_dir):
+def run_jellyfish(fasta_path, kmer_size, temp_dir, canonical=False):
     output_prefix = os.path.join(temp_dir, os.path.basename(fasta_path).replace('.fasta', '') + '_jf')
-    command = f"jellyfish count -m {kmer_size} -o {output_prefix} -s 10000000 -t 20 {fasta_path}"
+    canonical_flag = " -C" if canonical else ""
+    command = f"jellyfish count -m {kmer_size}{canonical_flag} -o {output_prefix} -s 10000000 -t 1 {fasta_path}"
     try:
         subprocess.run(command, shell=True, check=True)
         logging.info(f'Jellyfish completed for {fasta_path}')
@@ -60,37 +98,76 @@ def reformat_jellyfish_dump(file_path):
             count, sequence = lines[i].strip('>\n'), lines[i+1].strip()
             file.write(f'{sequence},{count}\n')
 
-def aggregate_jellyfish_output(fasta_path, output_files, class_):
-    aggregated_data = []
+def read_jellyfish_output(output_files, kmer_size, canonical=False):
+    """
+    Reads the reformatted jellyfish dumps into a CSR matrix laid out like the output of process_fasta.
+    """
+    rows, codes, counts = [], [], []
     for idx, file in enumerate(output_files):
-        df = pd.read_csv(file, header=None, names=['kmer', 'count'])
-        unique_id = f"{os.path.splitext(os.path.basename(fasta_path))[0]}_chunk_{idx+1}"
-        data = {'unique_id': unique_id, 'file_name': os.path.basename(fasta_path), 'sample_id': idx+1, 'class': class_}
-        data.update(df.set_index('kmer')['count'].to_dict())
-        aggregated_data.append(data)
-    result_df = pd.DataFrame(aggregated_data).fillna(0)
-    result_df.to_csv(f"{os.path.splitext(os.path.basename(fasta_path))[0]}_aggregated_jellyfish_output.csv", index=False)
-
-def process_kmer_profiles(input_dir, kmer_size, max_subseqs, subsequence_size, random_mode, label=""):
-    all_aggregated_data = []
-    individual_files_to_delete = []
-    fasta_files = [os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith('.fasta')]
-    
-    for fasta_file in fasta_files:
+        df = pd.read_csv(file, header=None, names=['kmer', 'count'], dtype={'kmer': str, 'count': np.uint32})
+        rows.append(np.full(len(df), idx))
+        codes.append(encode_kmers(df['kmer'].tolist()))
+        counts.append(df['count'].to_numpy())
+    if kmer_size <= MAX_DENSE_KMER_SIZE:
+        column_codes = kmer_column_codes(kmer_size, canonical)
+        n_columns = len(column_codes)
+        columns = [np.searchsorted(column_codes, c) for c in codes]
+    else:
+        n_columns = 4 ** kmer_size
+        columns = codes
+    if not output_files:
+        return sparse.csr_matrix((0, n_columns), dtype=np.uint32)
+    return sparse.csr_matrix(
+        (np.concatenate(counts), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(len(output_files), n_columns), dtype=np.uint32)
+
+def profile_metadata(fasta_path, n_profiles, class_):
+    """
+    Returns the sample metadata rows (unique_id, file_name, sample_id, class) of fasta_path.
+    """
+    base_name = fasta_stem(fasta_path)
+    return pd.DataFrame({
+        'unique_id': [f"{base_name}_chunk_{idx+1}" for idx in range(n_profiles)],
+        'file_name': os.path.basename(fasta_path),
+        'sample_id': range(1, n_profiles + 1),
+        'class': class_,
+    })
+
+def profile_genome(task):
+    """
+    Profiles a single genome. Runs in a worker process and returns its profile block and metadata rows.
+    """
+    fasta_file, kmer_size, max_subseqs, subsequence_size, random_mode, label, backend, canonical, seed = task
+    if backend == 'jellyfish':
         with tempfile.TemporaryDirectory() as temp_dir:
-            output_files = process_fasta(fasta_file, max_subseqs, kmer_size, subsequence_size, temp_dir, random_mode)
-            aggregate_jellyfish_output(fasta_file, output_files, label)
-            result_file = f"{os.path.splitext(os.path.basename(fasta_file))[0]}_aggregated_jellyfish_output.csv"
-            individual_files_to_delete.append(result_file)
-            all_aggregated_data.append(pd.read_csv(result_file))
-
-    if all_aggregated_data:
-        combined_df = pd.concat(all_aggregated_data, ignore_index=True)
-        output_file_path = f"{os.path.basename(input_dir)}_all_aggregated_jellyfish_output.csv"
-        combined_df.to_csv(output_file_path, index=False)
+            profiles = process_fasta(fasta_file, max_subseqs, kmer_size, subsequence_size, temp_dir, random_mode, backend, canonical, seed)
+    else:
+        profiles = process_fasta(fasta_file, max_subseqs, kmer_size, subsequence_size, random_mode=random_mode, backend=backend, canonical=canonical, seed=seed)
+    return profiles, profile_metadata(fasta_file, profiles.shape[0], label)
+
+def process_kmer_profiles(input_dir, kmer_size, max_subseqs, subsequence_size, random_mode, label="", backend='auto', canonical=False, csv=False, workers=1, seed=None):
+    backend = resolve_backend(backend, kmer_size)
+    blocks = []
+    metadata = []
+    fasta_files = sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if is_fasta(f))
+    tasks = ((fasta_file, kmer_size, max_subseqs, subsequence_size, random_mode, label, backend, canonical, seed) for fasta_file in fasta_files)
+
+    # Blocks arrive in input order whatever the number of workers, so the store is identical for any worker count
+    for profiles, rows in ordered_map(profile_genome, tasks, workers):
+        blocks.append(profiles)
+        metadata.append(rows)
+    if blocks:
+        counts = sparse.vstack(blocks, format='csr')
+        if kmer_size <= MAX_DENSE_KMER_SIZE:
+            column_codes = kmer_column_codes(kmer_size, canonical)
+        else:
+            counts, column_codes = compress_columns(counts)
+        params = {'max_subseqs': max_subseqs, 'subsequence_size': subsequence_size, 'random_mode': random_mode, 'seed': seed}
+        output_file_path = f"{os.path.basename(os.path.normpath(input_dir))}_kmer_profiles.npz"
+        save_profile_store(output_file_path, counts, pd.concat(metadata, ignore_index=True), column_codes, kmer_size, canonical, params)
         logging.info(f"K-mer profiling completed. Output file saved as: {output_file_path}")
 
-        # Delete individual files
-        for file_path in individual_files_to_delete:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+        if csv:
+            csv_path = f"{os.path.basename(os.path.normpath(input_dir))}_all_aggregated_jellyfish_output.csv"
+            export_profile_csv(output_file_path, csv_path)
+            logging.info(f"CSV export saved as: {csv_path}")
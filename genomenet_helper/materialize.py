@@ -0,0 +1,91 @@
+import os
+import errno
+import shutil
+
+MATERIALIZE_MODES = ['copy', 'hardlink', 'reflink', 'symlink', 'manifest']
+
+# In manifest mode a dataset folder lists its files here instead of containing them.
+FILE_MANIFEST = 'file_manifest.tsv'
+
+# Linux ioctl that clones a file's extents (copy-on-write) on btrfs, XFS, bcachefs, ...
+FICLONE = 0x40049409
+
+# Errors that mean "not possible here" rather than a real I/O failure, so the next method is tried.
+FALLBACK_ERRORS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY, errno.EMLINK}
+
+def reflink(src, dst):
+    """
+    Creates dst as a copy-on-write clone of src. Raises OSError where cloning is not supported.
+    """
+    import fcntl  # not available on Windows, where cloning is not supported either
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+def _replace_link(link, src, dst):
+    """
+    Creates a link, replacing an existing dst. Trying first saves a stat call per file in new folders.
+    """
+    try:
+        link(src, dst)
+    except FileExistsError:
+        os.remove(dst)
+        link(src, dst)
+
+def materialize_file(src, dst, mode='copy'):
+    """
+    Places src at dst without rewriting it where possible and returns the method actually used.
+    hardlink falls back to reflink and reflink falls back to a plain copy, e.g. across filesystems
+    or on filesystems without cloning. symlink creates an absolute link; manifest does nothing
+    (the caller records the file, see write_file_manifest).
+    """
+    if mode == 'manifest':
+        return mode
+    if mode == 'symlink':
+        _replace_link(os.symlink, os.path.abspath(src), dst)
+        return mode
+    if mode == 'hardlink':
+        try:
+            _replace_link(os.link, src, dst)
+            return mode
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRORS:
+                raise
+            mode = 'reflink'
+    # Never write through an existing link to another file
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'reflink':
+        try:
+            reflink(src, dst)
+            return mode
+        except (OSError, ImportError) as e:
+            if isinstance(e, OSError) and e.errno not in FALLBACK_ERRORS:
+                raise
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def write_file_manifest(folder, entries):
+    """
+    Writes the (file name, source path) entries of a manifest-mode dataset folder.
+    """
+    with open(os.path.join(folder, FILE_MANIFEST), 'w') as f:
+        f.write('file\tsource\n')
+        for name, source in entries:
+            f.write(f"{name}\t{os.path.abspath(source)}\n")
+
+def read_file_manifest(folder):
+    """
+    Returns the (file name, source path) entries of a manifest-mode dataset folder, or [] if it has none.
+    """
+    path = os.path.join(folder, FILE_MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        next(f)
+        return [tuple(line.rstrip('\n').split('\t', 1)) for line in f if line.strip()]
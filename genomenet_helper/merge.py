@@ -1,45 +1,207 @@
 import os
-import shutil
-
-def merge_directories(source_dirs, destination_dir):
-    # Create destination directory if it doesn't exist
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
-
-    # Copy all files from source directories to destination directory
-    for dir_path in source_dirs:
-        for filename in os.listdir(dir_path):
-            src_file = os.path.join(dir_path, filename)
-            dst_file = os.path.join(destination_dir, filename)
-            if os.path.isfile(src_file):
-                # In case of file name conflicts, you can customize how to handle them here
-                shutil.copy2(src_file, dst_file)
-            elif os.path.isdir(src_file):
-                # Handle sub-directories if necessary
-                merge_directories([src_file], os.path.join(destination_dir, filename))
-
-def merge_datasets(input_base, date):
-    # Define the expected directories
-    subsampled_prefix = f"{input_base}_train_subsampled_{date}"
-    simulated_prefix = f"{input_base}_train_simulated_{date}"
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-    categories = ['train', 'test', 'validation']
-    processes = ['subsampled', 'simulated']
+from .fasta_cache import get_content_hashes
+from .fragment_shards import SHARD_INDEX_SUFFIX, count_fragments, read_shard_index
+from .materialize import FILE_MANIFEST, materialize_file, read_file_manifest, write_file_manifest
+from .utils import MANIFEST_NAME
 
-    for category in categories:
-        source_dirs = [
-            f"{input_base}_{category}_{process}_{date}"
-            for process in processes
-        ]
+# How files with the same name but different content are kept apart:
+#   namespace: prefix every version with the name of its source (e.g. simulated__x.fasta)
+#   hash:      prefix every version with the start of its content hash (e.g. 3f2a9c1b__x.fasta)
+#   error:     stop before anything is written
+CONFLICT_POLICIES = ['namespace', 'hash', 'error']
 
-        destination_dir = f"{input_base}-merged/{category}"
+DATASET_PROCESSES = ['subsampled', 'simulated']
+DEFAULT_MERGE_WORKERS = 8
+
+# Files are placed in batches of this many per thread pool task, so that a million small files
+# cost a few thousand task round trips rather than a million.
+MERGE_BATCH = 512
+
+# name is the path relative to the destination; size is only known up front for colliding files; shards maps the shard names of a shard index that
+# has to be rewritten because its shards were renamed (None for all other files).
+MergeAction = namedtuple('MergeAction', ['source', 'name', 'size', 'shards'])
+
+def list_source_files(source_dir):
+    """
+    Returns the (relative path, path) of every file below source_dir, including the files listed in
+    file manifests (see materialize) and excluding resume bookkeeping and the manifests themselves.
+    """
+    files = []
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        prefix = relative_dir + os.sep if relative_dir else ''
+        directory = os.path.join(source_dir, relative_dir)
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name in (MANIFEST_NAME, FILE_MANIFEST):
+                    continue
+                if entry.is_dir():
+                    stack.append(prefix + entry.name)
+                else:
+                    files.append((prefix + entry.name, entry.path))
+        files.extend((prefix + name, source) for name, source in read_file_manifest(directory))
+    return files
+
+def _resolved_name(name, namespace, file_hash, on_conflict):
+    directory, base_name = os.path.split(name)
+    if on_conflict == 'namespace':
+        return os.path.join(directory, f"{namespace}__{base_name}")
+    return os.path.join(directory, f"{file_hash[:8]}__{base_name}")
+
+def plan_merge(sources, on_conflict='namespace', workers=1):
+    """
+    Plans the merge of sources (namespace -> directory) before anything is written. Files with the
+    same relative path and the same content are placed once; files with the same path but different
+    content are renamed according to on_conflict (see CONFLICT_POLICIES). Only files whose names
+    collide are sized and hashed; everything else costs a directory entry until it is placed.
+    Shard indexes whose shards were renamed are rewritten.
+    Returns the list of MergeActions and a Counter of skipped duplicates and renamed files.
+    """
+    by_name = defaultdict(list)
+    for namespace, source_dir in sources.items():
+        for name, path in list_source_files(source_dir):
+            by_name[name].append((namespace, path, None))
+
+    collisions = {name: [(namespace, path, os.path.getsize(path)) for namespace, path, _ in entries]
+                  for name, entries in by_name.items() if len(entries) > 1}
+    by_name.update(collisions)
+    sizes = Counter((name, size) for name, entries in collisions.items() for _, _, size in entries)
+    to_hash = sorted({path for name, entries in collisions.items() for _, path, size in entries
+                      if on_conflict == 'hash' or sizes[(name, size)] > 1})
+    hashes = dict(zip(to_hash, get_content_hashes(to_hash, workers)))
+
+    stats = Counter()
+    names = {}  # (namespace, relative path) -> destination name, for colliding names only
+    placed = []
+    for name, entries in by_name.items():
+        if len(entries) == 1:
+            placed.append((entries[0][0], name, entries[0][1], name, None))
+            continue
+        # Identical contents (same hash; files that were not hashed are unique) are placed once
+        contents = {}
+        for namespace, path, size in entries:
+            contents.setdefault(hashes.get(path, path), []).append((namespace, path, size))
+        if len(contents) > 1:
+            if on_conflict == 'error':
+                raise ValueError(f"{name} exists with different content in: " + ", ".join(namespace for namespace, _, _ in entries))
+            stats['renamed'] += len(contents)
+        for versions in contents.values():
+            namespace, path, size = versions[0]
+            destination = name if len(contents) == 1 else _resolved_name(name, namespace, hashes.get(path), on_conflict)
+            placed.append((namespace, name, path, destination, size))
+            for duplicate_namespace, _, _ in versions:
+                names[(duplicate_namespace, name)] = destination
+            stats['duplicates'] += len(versions) - 1
+            stats['duplicate_bytes'] += sum(duplicate_size for _, _, duplicate_size in versions[1:])
+
+    actions = []
+    for namespace, name, path, destination, size in placed:
+        shards = None
+        if name.endswith(SHARD_INDEX_SUFFIX):
+            # Shards live next to their index, and renaming never changes the directory
+            directory = os.path.dirname(name)
+            shards = {shard: os.path.basename(names.get((namespace, os.path.join(directory, shard)), shard))
+                      for shard in read_shard_index(path)['shard'].unique()}
+            if all(shard == new_name for shard, new_name in shards.items()):
+                shards = None
+        actions.append(MergeAction(path, destination, size, shards))
+    return actions, stats
 
-        # Check if all the source directories exist
-        if all(os.path.exists(src) for src in source_dirs):
-            merge_directories(source_dirs, destination_dir)
+def rewrite_shard_index(source, destination, shards):
+    """
+    Writes a shard index with the shard names replaced according to shards (old name -> new name).
+    """
+    index = read_shard_index(source)
+    index['shard'] = index['shard'].map(shards)
+    if os.path.lexists(destination):
+        os.remove(destination)
+    index.to_csv(destination, sep='\t', index=False)
+
+def _place_batch(batch, destination_dir, materialize):
+    methods, method_bytes = Counter(), Counter()
+    for action in batch:
+        destination = os.path.join(destination_dir, action.name)
+        if action.shards is not None:
+            rewrite_shard_index(action.source, destination, action.shards)
+            method = 'rewritten'
+        elif materialize == 'manifest' and action.name.endswith(SHARD_INDEX_SUFFIX):
+            # Shard indexes are found by listing the folder (see count_fragments), so they are always placed
+            method = materialize_file(action.source, destination, 'copy')
         else:
-            missing_dirs = [src for src in source_dirs if not os.path.exists(src)]
-            print(f"Error: The following directories are missing and required for merging: {', '.join(missing_dirs)}")
-            return  # Exit the function if any directories are missing
+            method = materialize_file(action.source, destination, materialize)
+        methods[method] += 1
+        method_bytes[method] += action.size if action.size is not None else os.path.getsize(action.source)
+    return methods, method_bytes
+
+def merge_directories(sources, destination_dir, materialize='copy', workers=DEFAULT_MERGE_WORKERS, on_conflict='namespace'):
+    """
+    Merges the files of sources (a list of directories, or a dict of namespace -> directory; by default
+    the namespace is the directory name) into destination_dir. The full file set is planned first
+    (see plan_merge), then files are placed according to `materialize` (see materialize_file) in
+    batches on a thread pool of `workers`. Returns a Counter with the number of files and bytes per
+    method (e.g. 'copy', 'copy_bytes') plus skipped duplicates and renamed files.
+    """
+    if not isinstance(sources, dict):
+        namespaces = Counter()
+        named_sources = {}
+        for source_dir in sources:
+            namespace = os.path.basename(os.path.normpath(source_dir))
+            namespaces[namespace] += 1
+            named_sources[namespace if namespaces[namespace] == 1 else f"{namespace}{namespaces[namespace]}"] = source_dir
+        sources = named_sources
+    actions, stats = plan_merge(sources, on_conflict, workers)
+
+    for directory in sorted({os.path.dirname(action.name) for action in actions} | {''}):
+        os.makedirs(os.path.join(destination_dir, directory), exist_ok=True)
+    batches = [actions[start:start + MERGE_BATCH] for start in range(0, len(actions), MERGE_BATCH)]
+    with ThreadPoolExecutor(workers) as pool:
+        for methods, method_bytes in pool.map(_place_batch, batches, [destination_dir] * len(batches),
+                                              [materialize] * len(batches)):
+            stats.update(methods)
+            stats.update({f"{method}_bytes": size for method, size in method_bytes.items()})
+
+    if materialize == 'manifest':
+        listed = defaultdict(list)
+        for action in actions:
+            if action.shards is None and not action.name.endswith(SHARD_INDEX_SUFFIX):
+                listed[os.path.dirname(action.name)].append((os.path.basename(action.name), action.source))
+        for directory, entries in listed.items():
+            write_file_manifest(os.path.join(destination_dir, directory), entries)
+    return stats
+
+def format_merge_stats(stats):
+    methods = sorted(key for key in stats if not key.endswith('_bytes') and key not in ('duplicates', 'renamed'))
+    files = sum(stats[method] for method in methods)
+    size = sum(stats[f"{method}_bytes"] for method in methods)
+    summary = f"{files} files ({size / (1024 ** 3):.2f} GB): " + ", ".join(
+        f"{stats[method]} {method} ({stats[method + '_bytes'] / (1024 ** 3):.2f} GB)" for method in methods)
+    if stats['duplicates']:
+        summary += f"; {stats['duplicates']} identical files ({stats['duplicate_bytes'] / (1024 ** 3):.2f} GB) placed once"
+    if stats['renamed']:
+        summary += f"; {stats['renamed']} files renamed because of name conflicts"
+    return summary
+
+def merge_datasets(input_base, date, materialize='copy', processes=DATASET_PROCESSES, workers=DEFAULT_MERGE_WORKERS,
+                   on_conflict='namespace'):
+    categories = ['train', 'test', 'validation']
+
+    # Check that all the source directories exist before merging anything
+    source_dirs = {category: {process: f"{input_base}_{category}_{process}_{date}" for process in processes}
+                   for category in categories}
+    missing_dirs = [src for sources in source_dirs.values() for src in sources.values() if not os.path.exists(src)]
+    if missing_dirs:
+        print(f"Error: The following directories are missing and required for merging: {', '.join(missing_dirs)}")
+        return
+
+    for category in categories:
+        destination_dir = f"{input_base}-merged/{category}"
+        stats = merge_directories(source_dirs[category], destination_dir, materialize, workers, on_conflict)
+        print(f"{destination_dir}: {format_merge_stats(stats)}")
+        # Shards and their indexes are placed together, so shard offsets stay valid
+        print(f"{destination_dir} contains {count_fragments(destination_dir)} sequences.")
 
     print(f"Datasets merged successfully into {input_base}-merged directory.")
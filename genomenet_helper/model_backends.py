@@ -0,0 +1,143 @@
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MaxAbsScaler
+from threadpoolctl import threadpool_limits
+
+from .features import FeatureFiles, file_rows, iter_rows
+
+# Rows per partial_fit batch of the incremental backends, and per prediction batch of models that
+# need dense input; a batch is the most that is ever converted to a dense array at once.
+BATCH_ROWS = 4096
+INCREMENTAL_EPOCHS = 5
+
+# build(n_estimators, n_jobs) returns an unfitted model; sparse says whether the model accepts sparse
+# input (otherwise every batch is made dense); incremental models are trained with partial_fit on
+# batches of rows and are a pipeline of a MaxAbsScaler ('scale') and a classifier ('classify').
+ModelBackend = namedtuple('ModelBackend', ['build', 'sparse', 'incremental'])
+
+def _random_forest(n_estimators, n_jobs):
+    return RandomForestClassifier(n_estimators=n_estimators, random_state=0, n_jobs=n_jobs)
+
+def _hist_gradient_boosting(n_estimators, n_jobs):
+    # n_estimators is the number of boosting iterations
+    return HistGradientBoostingClassifier(max_iter=n_estimators, random_state=0)
+
+def _linear(loss):
+    def build(n_estimators, n_jobs):
+        return Pipeline([('scale', MaxAbsScaler()), ('classify', SGDClassifier(loss=loss, random_state=0))])
+    return build
+
+#   random_forest:          the original baseline
+#   hist_gradient_boosting: histogram-based gradient boosting, much faster than a forest on many rows
+#   sgd:                    linear SVM-like model (modified Huber loss) trained with SGD
+#   logistic:               logistic regression trained with SGD
+MODEL_BACKENDS = {
+    'random_forest': ModelBackend(_random_forest, sparse=True, incremental=False),
+    'hist_gradient_boosting': ModelBackend(_hist_gradient_boosting, sparse=False, incremental=False),
+    'sgd': ModelBackend(_linear('modified_huber'), sparse=True, incremental=True),
+    'logistic': ModelBackend(_linear('log_loss'), sparse=True, incremental=True),
+}
+
+def _batches(rows, batch_rows):
+    for start in range(0, len(rows), batch_rows):
+        yield rows[start:start + batch_rows]
+
+def _input(X, backend):
+    return X.toarray() if sparse.issparse(X) and not backend.sparse else X
+
+def _shuffled_blocks(X, y, rows, rng):
+    for batch in _batches(rng.permutation(rows), BATCH_ROWS):
+        batch = np.sort(batch)
+        yield X[batch], y[batch]
+
+def _stack(blocks):
+    return sparse.vstack(blocks, format='csr') if sparse.issparse(blocks[0]) else np.vstack(blocks)
+
+def _mixed_batches(streams, sizes, batch_rows, rng):
+    """
+    Yields (X, y) batches of batch_rows rows drawn from streams of (X, y) blocks (stream i holds
+    sizes[i] rows) in a random order across the streams: every batch takes rows from each stream in
+    proportion to the rows it has left, so batches look like random samples of all rows even when
+    every stream holds a single class. The rows of a block are taken in a random order, and only the
+    current block of every stream is in memory.
+    """
+    remaining = np.array(sizes, dtype=np.int64)
+    current = [None] * len(streams)  # [X, y, next row] of the block being taken from
+    while remaining.sum():
+        take = rng.multivariate_hypergeometric(remaining, min(batch_rows, int(remaining.sum())))
+        X_parts, y_parts = [], []
+        for index in np.flatnonzero(take):
+            needed = take[index]
+            while needed:
+                if current[index] is None or current[index][2] == current[index][0].shape[0]:
+                    X, y = next(streams[index])
+                    order = rng.permutation(X.shape[0])
+                    current[index] = [X[order], y[order], 0]
+                X, y, start = current[index]
+                end = min(start + needed, X.shape[0])
+                X_parts.append(X[start:end])
+                y_parts.append(y[start:end])
+                current[index][2] = end
+                needed -= end - start
+        remaining -= take
+        order = rng.permutation(int(take.sum()))
+        yield _stack(X_parts)[order], np.concatenate(y_parts)[order]
+
+def fit_incremental(model, streams, sizes, classes, epochs=INCREMENTAL_EPOCHS, batch_rows=BATCH_ROWS, seed=0):
+    """
+    Trains an incremental model with partial_fit, one batch at a time. streams(rng) returns fresh
+    iterators of (X, y) blocks of the training rows, one per stream of sizes[i] rows (e.g. one per
+    file); they are run once to fit the scaler and then `epochs` times for the classifier, with the
+    rows of all streams mixed into every batch in a new random order (see _mixed_batches).
+    """
+    scaler, classifier = model.named_steps['scale'], model.named_steps['classify']
+    rng = np.random.default_rng(seed)
+    for stream in streams(rng):
+        for X, _ in stream:
+            scaler.partial_fit(X)
+    for _ in range(epochs):
+        for X, y in _mixed_batches(streams(rng), sizes, batch_rows, rng):
+            classifier.partial_fit(scaler.transform(X), y, classes=classes)
+    return model
+
+def fit_model(model_type, X, y, rows, n_classes, n_estimators=50, n_jobs=1):
+    """
+    Builds a model of the given backend (see MODEL_BACKENDS) and trains it on the given rows of X
+    with at most n_jobs threads. For incremental backends X can be a FeatureFiles source, whose
+    rows are streamed from disk file by file in every pass instead of being held in memory.
+    """
+    backend = MODEL_BACKENDS[model_type]
+    model = backend.build(n_estimators, n_jobs)
+    rows = np.sort(rows)
+    with threadpool_limits(n_jobs):
+        if backend.incremental:
+            if isinstance(X, FeatureFiles):
+                per_file = file_rows(X, rows)
+                streams = lambda rng: [iter_rows(X, index, selected, y) for index, selected in enumerate(per_file)]
+                sizes = [len(selected) for selected in per_file]
+            else:
+                streams = lambda rng: [_shuffled_blocks(X, y, rows, rng)]
+                sizes = [len(rows)]
+            fit_incremental(model, streams, sizes, np.arange(n_classes))
+        else:
+            model.fit(_input(X[rows], backend), y[rows])
+    return model
+
+def predict_proba(model_type, model, X, n_classes, batch_rows=BATCH_ROWS):
+    """
+    Returns the class probabilities of the rows of X, with one column per encoded class (also for
+    classes the model never saw), predicting in batches for models that need dense input.
+    """
+    backend = MODEL_BACKENDS[model_type]
+    y_prob = np.zeros((X.shape[0], n_classes))
+    if backend.sparse:
+        y_prob[:, model.classes_] = model.predict_proba(X)
+        return y_prob
+    for start in range(0, X.shape[0], batch_rows):
+        y_prob[start:start + batch_rows, model.classes_] = model.predict_proba(_input(X[start:start + batch_rows], backend))
+    return y_prob
@@ -0,0 +1,155 @@
+import os
+import logging
+
+import joblib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .fasta_reader import is_fasta
+from .features import FEATURE_DTYPE, file_columns, iter_features
+from .kmer_counting import MAX_DENSE_KMER_SIZE, encode_kmers, kmer_column_codes
+from .kmer_profiling import profile_genome, resolve_backend
+from .model_backends import predict_proba
+from .profile_store import METADATA_COLUMNS
+from .utils import ordered_map
+
+ARTIFACT_VERSION = 1
+
+# Profiles collected from FASTA files before they are predicted and written together.
+PREDICT_BATCH_ROWS = 4096
+
+# FASTA profiles are made without random subsequence selection unless the model says otherwise.
+DEFAULT_PROFILE_PARAMS = {'random_mode': False, 'seed': None}
+
+def save_model_artifact(path, model, model_type, columns, classes, kmer_size, canonical, profile_params, training):
+    """
+    Saves a trained model with everything needed to score new genomes: its backend, the k-mer columns
+    it was trained on, the class names in encoded order, how the training profiles were made and a
+    description of the training run. Written atomically.
+    """
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'model': model,
+        'model_type': model_type,
+        'columns': list(columns),
+        'classes': list(classes),
+        'kmer_size': kmer_size,
+        'canonical': canonical,
+        'profile_params': profile_params,
+        'training': training,
+    }
+    joblib.dump(artifact, path + '.part', compress=3)
+    os.replace(path + '.part', path)
+
+def load_model_artifact(path):
+    artifact = joblib.load(path)
+    if not isinstance(artifact, dict) or artifact.get('version') != ARTIFACT_VERSION:
+        raise ValueError(f"{path} is not a model artifact of version {ARTIFACT_VERSION}")
+    return artifact
+
+def _aligned_codes(counts, column_codes, model_codes):
+    """
+    Moves the columns of a profile block (column k-mer codes column_codes, or raw k-mer codes when
+    column_codes is None) to the positions of the sorted model_codes, dropping other k-mers.
+    """
+    counts = sparse.csr_matrix(counts)
+    codes = counts.indices if column_codes is None else column_codes[counts.indices]
+    positions = np.minimum(np.searchsorted(model_codes, codes), len(model_codes) - 1)
+    keep = model_codes[positions] == codes
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))[keep]
+    return sparse.csr_matrix((counts.data[keep].astype(FEATURE_DTYPE), (rows, positions[keep])),
+                             shape=(counts.shape[0], len(model_codes)))
+
+def iter_fasta_features(fasta_files, artifact, profile_params, workers=1, batch_rows=PREDICT_BATCH_ROWS):
+    """
+    Profiles FASTA files like the training data (in parallel with `workers` processes) and yields
+    (X, metadata) blocks of about batch_rows profiles aligned to the model's columns.
+    """
+    kmer_size, canonical = artifact['kmer_size'], artifact['canonical']
+    backend = resolve_backend('auto', kmer_size)
+    model_codes = encode_kmers(artifact['columns'])
+    column_codes = kmer_column_codes(kmer_size, canonical) if kmer_size <= MAX_DENSE_KMER_SIZE else None
+    tasks = ((fasta_file, kmer_size, profile_params['max_subseqs'], profile_params['subsequence_size'],
+              profile_params['random_mode'], '', backend, canonical, profile_params['seed']) for fasta_file in fasta_files)
+    blocks, metadata, rows = [], [], 0
+    for profiles, profile_rows in ordered_map(profile_genome, tasks, workers):
+        blocks.append(_aligned_codes(profiles, column_codes, model_codes))
+        metadata.append(profile_rows)
+        rows += profiles.shape[0]
+        if rows >= batch_rows:
+            yield sparse.vstack(blocks, format='csr'), pd.concat(metadata, ignore_index=True)
+            blocks, metadata, rows = [], [], 0
+    if blocks:
+        yield sparse.vstack(blocks, format='csr'), pd.concat(metadata, ignore_index=True)
+
+def report_missing_columns(source, missing, n_columns):
+    if missing:
+        logging.warning(f"{source}: {missing} of the {n_columns} k-mer columns of the model are missing and scored as 0")
+
+def expand_inputs(inputs):
+    """
+    Splits the inputs into profile files (.npz, .csv) and FASTA files; directories contribute their FASTA files.
+    """
+    profile_files, fasta_files = [], []
+    for path in inputs:
+        if os.path.isdir(path):
+            fasta_files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if is_fasta(f)))
+        elif path.endswith(('.npz', '.csv')):
+            profile_files.append(path)
+        elif is_fasta(path):
+            fasta_files.append(path)
+        else:
+            raise ValueError(f"Cannot predict {path}: expected a FASTA file, a folder of FASTA files, a CSV file or a profile store")
+    return profile_files, fasta_files
+
+def predict_files(model_path, inputs, output_path, workers=1, batch_rows=PREDICT_BATCH_ROWS, max_subseqs=None,
+                  subsequence_size=None):
+    """
+    Scores profile stores, CSV profiles and FASTA files with a saved model and writes one TSV row per
+    profile (metadata, predicted class and the probability of every class). Inputs are featurized
+    and predicted in batches, and every batch is appended to the output as soon as it is predicted;
+    the output gets its final name when all inputs are done. FASTA files are profiled with the
+    settings of the training profiles unless max_subseqs or subsequence_size are given; a model that
+    does not record them (trained on CSV files) needs both.
+    Returns the number of profiles written.
+    """
+    artifact = load_model_artifact(model_path)
+    classes = np.array(artifact['classes'])
+    profile_params = dict(DEFAULT_PROFILE_PARAMS, **(artifact['profile_params'] or {}))
+    if max_subseqs is not None:
+        profile_params['max_subseqs'] = max_subseqs
+    if subsequence_size is not None:
+        profile_params['subsequence_size'] = subsequence_size
+    profile_files, fasta_files = expand_inputs(inputs)
+    if fasta_files and artifact['kmer_size'] is None:
+        raise ValueError(f"{model_path} does not record a k-mer size, so FASTA files cannot be profiled for it")
+    if fasta_files and ('max_subseqs' not in profile_params or 'subsequence_size' not in profile_params):
+        raise ValueError(f"{model_path} does not record how its training profiles were made; pass --max_subseqs and "
+                         f"--subsequence_size to profile FASTA files for it")
+    n_columns = len(artifact['columns'])
+    for path in profile_files:
+        present = set(file_columns(path))
+        report_missing_columns(path, sum(1 for column in artifact['columns'] if column not in present), n_columns)
+    if fasta_files and artifact['kmer_size'] <= MAX_DENSE_KMER_SIZE:
+        # E.g. non-canonical model columns that canonical profiling never produces
+        codes = kmer_column_codes(artifact['kmer_size'], artifact['canonical'])
+        report_missing_columns('FASTA profiles', int(np.count_nonzero(~np.isin(encode_kmers(artifact['columns']), codes))), n_columns)
+
+    blocks = iter_features(profile_files, artifact['columns'], batch_rows)
+    written = 0
+    with open(output_path + '.part', 'w') as out:
+        out.write('\t'.join(METADATA_COLUMNS + ['prediction'] + [f"probability_{name}" for name in classes]) + '\n')
+        for source in (blocks, iter_fasta_features(fasta_files, artifact, profile_params, workers, batch_rows)):
+            for X, metadata in source:
+                y_prob = predict_proba(artifact['model_type'], artifact['model'], X, len(classes))
+                predictions = metadata[METADATA_COLUMNS].copy()
+                predictions['prediction'] = classes[np.argmax(y_prob, axis=1)]
+                for index, name in enumerate(classes):
+                    predictions[f"probability_{name}"] = np.round(y_prob[:, index], 4)
+                predictions.to_csv(out, sep='\t', index=False, header=False)
+                out.flush()
+                written += len(predictions)
+                logging.info(f"Predicted {written} profiles")
+    os.replace(output_path + '.part', output_path)
+    return written
@@ -1,8 +1,12 @@
 import os
+import time
 import logging
+from datetime import datetime
 import pandas as pd
 import numpy as np
-from sklearn.ensemble import RandomForestClassifier
+from scipy import sparse
+import sklearn
+from joblib import Parallel, delayed
 from sklearn.metrics import classification_report
 from sklearn.decomposition import PCA
 import matplotlib.pyplot as plt
@@ -11,52 +15,177 @@ from sklearn.metrics import roc_curve, auc
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.cm as cm
 
+from .features import balanced_indices, feature_columns, load_features, profile_settings, stream_features
+from .kmer_harmonization import CHUNK_ROWS
+from .model_backends import MODEL_BACKENDS, fit_model, predict_proba
+from .model_predictor import save_model_artifact
+
 
 logging.basicConfig(level=logging.INFO)
 
-def train_model(train_files, test_files, output_path, model_type='random_forest', n_estimators=50, fractions=[1.0, 0.5, 0.25, 0.05, 0.01]):
-    train_data_full = pd.concat([pd.read_csv(file) for file in train_files], ignore_index=True)
-    test_data = pd.concat([pd.read_csv(file) for file in test_files], ignore_index=True)
+def _fit_fraction(X, y, rows, X_test, n_classes, model_type, n_estimators, n_jobs, keep_model):
+    """
+    Trains one model on the given rows of X and returns its test predictions, class probabilities
+    (one column per encoded class), the fit and prediction times in seconds and, with keep_model,
+    the model itself.
+    """
+    start = time.perf_counter()
+    model = fit_model(model_type, X, y, rows, n_classes, n_estimators, n_jobs)
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    y_prob = predict_proba(model_type, model, X_test, n_classes)
+    predict_seconds = time.perf_counter() - start
+    y_pred = model.classes_[np.argmax(y_prob[:, model.classes_], axis=1)]
+    return y_pred, y_prob, fit_seconds, predict_seconds, model if keep_model else None
 
-    # Balance the test data
-    min_class_count_test = test_data['class'].value_counts().min()
-    test_data = test_data.groupby('class').apply(lambda x: x.sample(min_class_count_test)).reset_index(drop=True)
+def sweep_fractions(X, y, X_test, fraction_rows, n_classes, model_type='random_forest', n_estimators=50, workers=os.cpu_count(),
+                    keep_fraction=None):
+    """
+    Trains one model per training fraction (fraction -> row indices into X) and returns the test
+    predictions, probabilities and fit/predict times of each, predicted once. The fits run in
+    parallel, largest first, with the cores split between fits and the threads of each fit; joblib
+    memory-maps X and X_test into the worker processes instead of pickling them for every fit.
+    X can also be a FeatureFiles source for incremental backends; every fit then streams it.
+    Only the model of keep_fraction is sent back.
+    """
+    fits = max(1, min(len(fraction_rows), workers))
+    order = sorted(fraction_rows, key=lambda fraction: len(fraction_rows[fraction]), reverse=True)
+    results = Parallel(n_jobs=fits)(
+        delayed(_fit_fraction)(X, y, fraction_rows[fraction], X_test, n_classes, model_type, n_estimators, max(1, workers // fits),
+                               fraction == keep_fraction)
+        for fraction in order)
+    return dict(zip(order, results))
+
+def _profiling(params):
+    """
+    Returns the profiling parameters that decide how FASTA files are profiled, or None if params
+    do not have them (e.g. a store harmonized from CSV files without them).
+    """
+    if params.get('max_subseqs') is None or params.get('subsequence_size') is None:
+        return None
+    random_mode = bool(params.get('random_mode', False))
+    return {'max_subseqs': params['max_subseqs'], 'subsequence_size': params['subsequence_size'],
+            'random_mode': random_mode, 'seed': params.get('seed') if random_mode else None}
+
+def training_profile_settings(train_files, columns, canonical=None, max_subseqs=None, subsequence_size=None):
+    """
+    Returns the k-mer size, canonical flag and profiling parameters of the training profiles, which
+    are saved with the model so that predict profiles FASTA files the same way. Profile stores record
+    them and have to agree with each other; CSV files do not, so the caller can give canonical,
+    max_subseqs and subsequence_size. Given settings win over recorded ones with a warning; recorded
+    settings that conflict raise a ValueError unless they are given.
+    """
+    if (max_subseqs is None) != (subsequence_size is None):
+        raise ValueError("--max_subseqs and --subsequence_size have to be given together")
+    settings = profile_settings(train_files)
+
+    kmer_sizes = {kmer_size for kmer_size, _, _ in settings.values()}
+    if len(kmer_sizes) > 1:
+        raise ValueError(f"The training profile stores have different k-mer sizes {sorted(kmer_sizes)}")
+    kmer_size = kmer_sizes.pop() if kmer_sizes else len(columns[0]) if columns else None
+
+    recorded = {path: flag for path, (_, flag, _) in settings.items()}
+    if canonical is not None:
+        differing = [path for path, flag in recorded.items() if flag != canonical]
+        if differing:
+            logging.warning(f"--canonical overrides the canonical flag recorded in {', '.join(differing)}")
+    elif len(set(recorded.values())) > 1:
+        raise ValueError(f"The training profile stores disagree on canonical k-mers: "
+                         f"{', '.join(f'{path} ({flag})' for path, flag in recorded.items())}")
+    else:
+        canonical = next(iter(recorded.values()), False)
+
+    recorded = {path: _profiling(params) for path, (_, _, params) in settings.items()}
+    recorded = {path: params for path, params in recorded.items() if params is not None}
+    unrecorded = [path for path in train_files if path not in recorded]
+    if max_subseqs is not None:
+        profile_params = _profiling({'max_subseqs': max_subseqs, 'subsequence_size': subsequence_size})
+        differing = [path for path, params in recorded.items() if params != profile_params]
+        if differing:
+            logging.warning(f"--max_subseqs and --subsequence_size override the profiling settings recorded in {', '.join(differing)}")
+        return kmer_size, canonical, profile_params
+
+    distinct = []
+    for params in recorded.values():
+        if params not in distinct:
+            distinct.append(params)
+    if len(distinct) > 1:
+        raise ValueError(f"The training profile stores were made with different settings: "
+                         f"{'; '.join(f'{path} {params}' for path, params in recorded.items())}. "
+                         f"Pass --max_subseqs and --subsequence_size to choose the ones saved with the model")
+    if not distinct:
+        logging.warning("The training profiles do not record how they were made and --max_subseqs/--subsequence_size were not given; "
+                        "the saved model can only score FASTA files if predict is told how to profile them")
+        return kmer_size, canonical, None
+    if unrecorded:
+        logging.warning(f"{', '.join(unrecorded)} do not record how their profiles were made; "
+                        f"assuming the settings of the other training files: {distinct[0]}")
+    return kmer_size, canonical, distinct[0]
+
+def train_model(train_files, test_files, output_path, model_type='random_forest', n_estimators=50, fractions=[1.0, 0.5, 0.25, 0.05, 0.01],
+                workers=os.cpu_count(), model_output=None, chunk_rows=CHUNK_ROWS, canonical=None,
+                max_subseqs=None, subsequence_size=None):
+    # Train and test features share one column layout, and are loaded once as float32 (sparse when sparse)
+    columns = feature_columns(train_files + test_files)
+    # Checked before anything is trained; saved with the model
+    kmer_size, canonical, profile_params = training_profile_settings(train_files, columns, canonical, max_subseqs, subsequence_size)
+    test = load_features(test_files, columns)
+    if MODEL_BACKENDS[model_type].incremental:
+        # Incremental backends stream the training profiles from disk in every pass, so the training
+        # set does not have to fit in memory; only its metadata is loaded
+        train_X, train_metadata = stream_features(train_files, columns, chunk_rows)
+    else:
+        train = load_features(train_files, columns, chunk_rows)
+        train_X, train_metadata = train.X, train.metadata
+    logging.info(f"Loaded {len(train_metadata)} training and {test.X.shape[0]} test profiles with {len(columns)} features")
 
     label_encoder = LabelEncoder()
-    test_data.fillna(0, inplace=True)
-    X_test = test_data.drop(['unique_id', 'file_name', 'sample_id', 'class'], axis=1).apply(pd.to_numeric, errors='coerce').fillna(0)
-    y_test = label_encoder.fit_transform(test_data['class'])
+    label_encoder.fit(pd.concat([train_metadata['class'], test.metadata['class']]).astype(str))
+    y_train_full = label_encoder.transform(train_metadata['class'].astype(str))
     class_names = label_encoder.classes_
 
+    # Balance the test data
+    y_test_full = label_encoder.transform(test.metadata['class'].astype(str))
+    min_class_count_test = np.unique(y_test_full, return_counts=True)[1].min()
+    test_rows = balanced_indices(y_test_full, lambda size: min_class_count_test, seed=0)
+    X_test = test.X[test_rows]
+    y_test = y_test_full[test_rows]
+
     # Assuming the positive class is the second class in alphabetical order
     # Adjust this logic if necessary
     positive_class_index = np.where(label_encoder.classes_ == sorted(label_encoder.classes_)[1])[0][0]
 
-    metrics_df = pd.DataFrame(columns=['Fraction', 'Precision', 'Recall', 'F1-score', 'ROC AUC', 'Samples Per Class'])
+    min_class_count_train = np.unique(y_train_full, return_counts=True)[1].min()
+    logging.info(f"min_class_count_train: {min_class_count_train}")
+
+    metrics_df = pd.DataFrame(columns=['Fraction', 'Precision', 'Recall', 'F1-score', 'ROC AUC', 'Samples Per Class',
+                                       'Fit (s)', 'Predict (s)'])
     roc_data = {}
 
+    # Balanced training rows of every fraction, drawn once; all fits run in parallel on the shared matrix
+    fraction_rows = {fraction: balanced_indices(y_train_full, lambda size: min(int(size * fraction), min_class_count_train), seed=0)
+                     for fraction in fractions}
+    train_classes = len(np.unique(y_train_full))
+    for fraction in [fraction for fraction, rows in fraction_rows.items() if len(np.unique(y_train_full[rows])) < train_classes]:
+        logging.warning(f"Skipping training fraction {fraction}: it leaves no training rows for some classes")
+        del fraction_rows[fraction]
+    fractions = [fraction for fraction in fractions if fraction in fraction_rows]
+    if not fractions:
+        logging.error(f"No training fraction leaves training rows for every class (smallest class: {min_class_count_train} rows); "
+                      f"use larger fractions or more training profiles")
+        return
+    results = sweep_fractions(train_X, y_train_full, X_test, fraction_rows, len(class_names), model_type, n_estimators, workers,
+                              max(fractions))
+
     with PdfPages(output_path) as pdf:
         for fraction in fractions:
-            # Balance the training data for the current fraction
-            min_class_count_train = train_data_full['class'].value_counts().min()
-            logging.info(f"min_class_count_train: {min_class_count_train}")
-
-            # Balance the training data for the current fraction
-            train_data = train_data_full.groupby('class').apply(lambda x: x.sample(min(int(len(x) * fraction), min_class_count_train), random_state=0)).reset_index(drop=True)
-            logging.info(f"Number of rows in the balanced training data: {len(train_data)}")
-
-            train_data.fillna(0, inplace=True)
-            X_train = train_data.drop(['unique_id', 'file_name', 'sample_id', 'class'], axis=1).apply(pd.to_numeric, errors='coerce').fillna(0)
-            y_train = label_encoder.transform(train_data['class'])
-            
-            # Count the number of samples per class for the current fraction
-            samples_per_class = train_data['class'].value_counts().sort_index().to_dict()
-
-            classifier = RandomForestClassifier(n_estimators=n_estimators, random_state=0, n_jobs=-1)
-            classifier.fit(X_train, y_train)
-
-            y_pred = classifier.predict(X_test)
-            report = classification_report(y_test, y_pred, target_names=class_names, output_dict=True)
+            train_rows = fraction_rows[fraction]
+            logging.info(f"Number of rows in the balanced training data for fraction {fraction}: {len(train_rows)}")
+            y_pred, y_prob, fit_seconds, predict_seconds, model = results[fraction]
+            logging.info(f"{model_type} fit {len(train_rows) / fit_seconds:.0f} rows/s ({fit_seconds:.2f} s), "
+                         f"predicted {len(y_test) / predict_seconds:.0f} rows/s ({predict_seconds:.2f} s)")
+            report = classification_report(y_test, y_pred, labels=np.arange(len(class_names)), target_names=class_names,
+                                           output_dict=True, zero_division=0)
 
             logging.info(f"Model Evaluation for Training Fraction: {fraction}")
             for label, metrics in report.items():
@@ -66,8 +195,7 @@ def train_model(train_files, test_files, output_path, model_type='random_forest'
 
             metrics = report['weighted avg']
             if len(class_names) == 2:
-                y_prob = classifier.predict_proba(X_test)[:, positive_class_index]
-                fpr, tpr, _ = roc_curve(y_test, y_prob, pos_label=positive_class_index)
+                fpr, tpr, _ = roc_curve(y_test, y_prob[:, positive_class_index], pos_label=positive_class_index)
                 roc_auc = auc(fpr, tpr)
                 roc_data[fraction] = (fpr, tpr, roc_auc)
             else:
@@ -78,14 +206,24 @@ def train_model(train_files, test_files, output_path, model_type='random_forest'
                             'Recall': [round(metrics['recall'], 2)], 
                             'F1-score': [round(metrics['f1-score'], 2)],
                             'ROC AUC': [round(roc_auc, 2) if roc_auc is not np.nan else 'N/A'],
-                            'Samples Per Class': [len(train_data)]})
+                            'Samples Per Class': [len(train_rows)],
+                            'Fit (s)': [round(fit_seconds, 2)],
+                            'Predict (s)': [round(predict_seconds, 2)]})
             metrics_df = pd.concat([metrics_df, new_row], ignore_index=True)
 
+            if model is not None and model_output:
+                # The model of the largest fraction is kept for scoring new genomes (see model_predictor)
+                training = {'train_files': list(train_files), 'test_files': list(test_files), 'fraction': fraction,
+                            'rows': len(train_rows), 'n_estimators': n_estimators, 'sklearn_version': sklearn.__version__,
+                            'trained_at': datetime.now().isoformat(timespec='seconds'),
+                            'precision': metrics['precision'], 'recall': metrics['recall'], 'f1-score': metrics['f1-score'],
+                            'roc_auc': None if np.isnan(roc_auc) else float(roc_auc)}
+                save_model_artifact(model_output, model, model_type, columns, class_names, kmer_size, canonical, profile_params, training)
+                logging.info(f"Model of training fraction {fraction} saved as: {model_output}")
+
             if fraction == 1.0:
-                # Predict on test data
-                y_pred_test = classifier.predict(X_test)  # Predictions on test data
-                # Now create the PCoA plot with test data and predictions
-                create_pcoa_plot(X_test, y_test, y_pred_test, class_names, 'PCoA Plot - Test Data', pdf)
+                # Create the PCoA plot with test data and the predictions of the full model
+                create_pcoa_plot(X_test, y_test, y_pred, class_names, 'PCoA Plot - Test Data', pdf)
             
         fig, ax = plt.subplots()
         ax.axis('off')
@@ -107,7 +245,8 @@ def train_model(train_files, test_files, output_path, model_type='random_forest'
             plt.close()
         
 def create_pcoa_plot(X, y_true, y_pred, class_names, title, pdf):
-    pca = PCA(n_components=2)
+    # PCA centers sparse input implicitly with the arpack solver, so X is never made dense
+    pca = PCA(n_components=2, svd_solver='arpack' if sparse.issparse(X) else 'auto')
     principal_components = pca.fit_transform(X)
     explained_variance = pca.explained_variance_ratio_ * 100
 
@@ -133,12 +272,17 @@ def create_pcoa_plot(X, y_true, y_pred, class_names, title, pdf):
     pdf.savefig()
     plt.close()
     
-def process_model_training(train_files, test_files, output_path):
-     # Check if files exist and are valid CSVs
+def process_model_training(train_files, test_files, output_path, workers=os.cpu_count(), model_type='random_forest', n_estimators=50,
+                           model_output=None, canonical=None, max_subseqs=None, subsequence_size=None):
+     # Check if files exist and are valid CSVs or profile stores
     for file in train_files + test_files:
-        if not os.path.isfile(file) or not file.endswith('.csv'):
+        if not os.path.isfile(file) or not file.endswith(('.csv', '.npz')):
             logging.error(f"Invalid file path or format: {file}")
             return
-    train_model(train_files, test_files, output_path)
+    if model_type not in MODEL_BACKENDS:
+        logging.error(f"Unknown model type: {model_type} (choose from {', '.join(MODEL_BACKENDS)})")
+        return
+    train_model(train_files, test_files, output_path, model_type, n_estimators, workers=workers, model_output=model_output,
+                canonical=canonical, max_subseqs=max_subseqs, subsequence_size=subsequence_size)
 
 
@@ -0,0 +1,148 @@
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+# Units up to this rank (by weight) are placed one by one, largest first; the rest are cut in bulk.
+LPT_UNITS = 2048
+REFINE_ROUNDS = 50
+
+# assignment: part index of every item; requested/achieved: weight fractions of the parts.
+Partition = namedtuple('Partition', ['assignment', 'requested', 'achieved'])
+
+def _lpt_cut(weights, targets, by_weight, rng):
+    """
+    Assigns units to parts with the given target weights: the largest units greedily (each into the part
+    furthest below its target), then the remaining small units, in random order, by cutting their
+    cumulative weight at the remaining deficits of the parts.
+    """
+    order = by_weight[::-1]
+    head, tail = order[:LPT_UNITS], rng.permutation(order[LPT_UNITS:])
+    assignment = np.empty(len(weights), dtype=np.intp)
+    current = np.zeros(len(targets))
+    for unit in head:
+        part = int(np.argmax(targets - current))
+        assignment[unit] = part
+        current[part] += weights[unit]
+    if len(tail):
+        deficits = np.clip(targets - current, 0, None)
+        if deficits.sum() == 0:
+            deficits = targets.astype(np.float64)
+        bounds = np.cumsum(deficits) / deficits.sum() * weights[tail].sum()
+        midpoints = np.cumsum(weights[tail]) - weights[tail] / 2
+        assignment[tail] = np.minimum(np.searchsorted(bounds, midpoints, side='right'), len(targets) - 1)
+    return assignment
+
+def _transfer_gain(excess, deficit, transfer):
+    """
+    Reduction of the total absolute deviation when `transfer` weight moves from a part that is
+    `excess` over its target to one that is `deficit` under it.
+    """
+    return excess + deficit - np.abs(excess - transfer) - np.abs(deficit - transfer)
+
+def _refine(weights, targets, assignment, by_weight):
+    """
+    Local search: moves single units, or swaps pairs of units, from the most overfull part to the most
+    underfull one whenever that reduces the total absolute deviation from the targets.
+    by_weight orders the units by increasing weight; every round is O(n) plus binary searches.
+    """
+    for _ in range(REFINE_ROUNDS):
+        current = np.bincount(assignment, weights=weights, minlength=len(targets))
+        deviation = current - targets
+        over, under = int(np.argmax(deviation)), int(np.argmin(deviation))
+        if over == under or deviation[over] <= 0:
+            break
+        excess, deficit = deviation[over], -deviation[under]
+        best_gain, best_move = 0.0, None
+
+        assigned = assignment[by_weight]
+        over_sorted = by_weight[assigned == over]
+        under_units = by_weight[assigned == under]
+        ideal = min(excess, deficit)
+
+        # Single move: the unit of the overfull part closest to the ideal transfer
+        position = np.searchsorted(weights[over_sorted], ideal)
+        for candidate in over_sorted[max(position - 1, 0):position + 1]:
+            candidate_gain = _transfer_gain(excess, deficit, weights[candidate])
+            if candidate_gain > best_gain:
+                best_gain, best_move = candidate_gain, (candidate, None)
+
+        # Swap: for every unit of the underfull part, the overfull unit that makes the net transfer ideal
+        if len(over_sorted) and len(under_units):
+            positions = np.searchsorted(weights[over_sorted], weights[under_units] + ideal)
+            for shift in (-1, 0):
+                partners = over_sorted[np.clip(positions + shift, 0, len(over_sorted) - 1)]
+                gains = _transfer_gain(excess, deficit, weights[partners] - weights[under_units])
+                best = int(np.argmax(gains))
+                if gains[best] > best_gain:
+                    best_gain, best_move = gains[best], (partners[best], under_units[best])
+
+        if best_move is None or best_gain <= 1e-9 * max(targets.sum(), 1):
+            break
+        moved, swapped = best_move
+        assignment[moved] = under
+        if swapped is not None:
+            assignment[swapped] = over
+    return assignment
+
+def partition(weights, fractions, groups=None, strata=None, seed=None):
+    """
+    Splits items with the given weights into len(fractions) parts whose total weights follow the
+    fractions as closely as possible. Items with the same group label always end up in the same part.
+    With strata, every stratum (e.g. a class label) is partitioned separately, so that each part gets
+    the requested fraction of every stratum; a group belongs to the stratum of its first item.
+    Returns a Partition with the part of every item and the requested and achieved weight fractions.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    fractions = np.asarray(fractions, dtype=np.float64) / np.sum(fractions)
+    rng = np.random.default_rng(seed)
+    n = len(weights)
+
+    # Units are groups (or single items); each unit carries the summed weight of its items
+    if groups is None:
+        unit_of_item = np.arange(n)
+    else:
+        _, first_items, unit_of_item = np.unique(np.asarray(groups), return_index=True, return_inverse=True)
+    unit_weights = np.bincount(unit_of_item, weights=weights)
+    if strata is None:
+        unit_strata = np.zeros(len(unit_weights), dtype=np.intp)
+    else:
+        _, item_strata = np.unique(np.asarray(strata), return_inverse=True)
+        unit_strata = item_strata if groups is None else item_strata[first_items]
+
+    unit_assignment = np.empty(len(unit_weights), dtype=np.intp)
+    for stratum in range(unit_strata.max() + 1 if len(unit_strata) else 0):
+        units = np.flatnonzero(unit_strata == stratum) if strata is not None else np.arange(len(unit_weights))
+        stratum_weights = unit_weights[units]
+        targets = fractions * stratum_weights.sum()
+        # Shuffled before sorting so that units of equal weight are placed in random order
+        shuffled = rng.permutation(len(units))
+        by_weight = shuffled[np.argsort(stratum_weights[shuffled])]
+        assignment = _lpt_cut(stratum_weights, targets, by_weight, rng)
+        unit_assignment[units] = _refine(stratum_weights, targets, assignment, by_weight)
+
+    assignment = unit_assignment[unit_of_item]
+    achieved = np.bincount(assignment, weights=weights, minlength=len(fractions))
+    achieved = achieved / achieved.sum() if achieved.sum() else achieved
+    return Partition(assignment, fractions, achieved)
+
+def combine_groups(*labelings):
+    """
+    Combines several group labelings of the same items (e.g. similarity clusters and a metadata column)
+    into one: items that share a label in any of them end up in the same group.
+    """
+    n = len(labelings[0])
+    offset, columns = 0, []
+    for labels in labelings:
+        _, codes = np.unique(np.asarray(labels), return_inverse=True)
+        columns.append(codes + offset)
+        offset += codes.max() + 1 if n else 0
+    rows = np.tile(np.arange(n), len(labelings))
+    graph = sparse.coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, n + np.concatenate(columns))), shape=(n + offset, n + offset))
+    _, components = connected_components(graph, directed=False)
+    return components[:n]
+
+def format_partition_report(result, names=('train', 'validation', 'test')):
+    return ", ".join(f"{name} {requested * 100:.2f}% requested / {achieved * 100:.2f}% achieved"
+                     for name, requested, achieved in zip(names, result.requested, result.achieved))
@@ -0,0 +1,121 @@
+import json
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .kmer_counting import decode_kmers
+
+METADATA_COLUMNS = ['unique_id', 'file_name', 'sample_id', 'class']
+
+ProfileStore = namedtuple('ProfileStore', ['counts', 'metadata', 'kmers', 'kmer_size', 'canonical', 'params'])
+
+def compress_columns(counts, column_codes=None):
+    """
+    Restricts a count matrix whose column indices are raw k-mer codes to the given column codes.
+    Without column_codes, the sorted union of observed k-mers becomes the column index.
+    Returns the compressed matrix and its column codes.
+    """
+    counts = sparse.csr_matrix(counts)
+    if column_codes is None:
+        column_codes = np.unique(counts.indices).astype(np.int64)
+    positions = np.searchsorted(column_codes, counts.indices)
+    compressed = sparse.csr_matrix((counts.data, positions, counts.indptr), shape=(counts.shape[0], len(column_codes)))
+    return compressed, column_codes
+
+def save_profile_store(path, counts, metadata, column_codes, kmer_size, canonical=False, params=None):
+    """
+    Writes k-mer profiles as a compressed .npz store: a CSR uint32 count matrix whose columns follow
+    the lexicographic column_codes, plus the metadata table (unique_id, file_name, sample_id, class).
+    """
+    counts = sparse.csr_matrix(counts, dtype=np.uint32)
+    counts.sort_indices()
+    arrays = {
+        'data': counts.data,
+        'indices': counts.indices,
+        'indptr': counts.indptr,
+        'shape': np.array(counts.shape, dtype=np.int64),
+        'column_codes': np.asarray(column_codes, dtype=np.int64),
+        'kmer_size': np.array(kmer_size),
+        'canonical': np.array(canonical),
+        'params': np.array(json.dumps(params or {})),
+    }
+    for column in METADATA_COLUMNS:
+        values = metadata[column].to_numpy()
+        arrays[f'meta_{column}'] = values.astype(np.int64) if column == 'sample_id' else values.astype(str)
+    write_npz(path, arrays)
+
+def write_npz(path, arrays):
+    """
+    Equivalent of np.savez_compressed with fixed zip timestamps, so identical data gives identical bytes.
+    """
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, array in arrays.items():
+            info = zipfile.ZipInfo(f'{name}.npy', date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+def load_profile_store(path):
+    """
+    Loads a profile store written by save_profile_store.
+    """
+    with np.load(path) as store:
+        shape = tuple(store['shape'])
+        counts = sparse.csr_matrix((store['data'], store['indices'], store['indptr']), shape=shape)
+        metadata = pd.DataFrame({column: store[f'meta_{column}'] for column in METADATA_COLUMNS})
+        kmer_size = int(store['kmer_size'])
+        return ProfileStore(
+            counts=counts,
+            metadata=metadata,
+            kmers=decode_kmers(store['column_codes'], kmer_size),
+            kmer_size=kmer_size,
+            canonical=bool(store['canonical']),
+            params=json.loads(str(store['params'])),
+        )
+
+def _open_array(archive, name):
+    """
+    Opens an array of a profile store for sequential reading; returns the open member and its dtype.
+    """
+    f = archive.open(f'{name}.npy')
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    _, _, dtype = read_header(f)
+    return f, dtype
+
+def _read_values(f, dtype, count):
+    return np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count)
+
+def iter_profile_store(path, chunk_rows):
+    """
+    Yields (counts, metadata) blocks of chunk_rows profiles of a profile store written by
+    save_profile_store. The count arrays are decompressed as they are read, so only one block of
+    counts is in memory at a time.
+    """
+    with np.load(path) as store:
+        n_rows, n_columns = (int(n) for n in store['shape'])
+        indptr = store['indptr']
+        metadata = pd.DataFrame({column: store[f'meta_{column}'] for column in METADATA_COLUMNS})
+    with zipfile.ZipFile(path) as archive:
+        data, data_dtype = _open_array(archive, 'data')
+        indices, indices_dtype = _open_array(archive, 'indices')
+        with data, indices:
+            for start in range(0, n_rows, chunk_rows):
+                end = min(start + chunk_rows, n_rows)
+                count = int(indptr[end] - indptr[start])
+                counts = sparse.csr_matrix((_read_values(data, data_dtype, count), _read_values(indices, indices_dtype, count),
+                                            indptr[start:end + 1] - indptr[start]), shape=(end - start, n_columns))
+                yield counts, metadata.iloc[start:end].reset_index(drop=True)
+
+def profile_store_to_frame(store):
+    """
+    Expands a profile store into the wide table layout used by the CSV export.
+    """
+    profiles = pd.DataFrame(store.counts.toarray(), columns=store.kmers)
+    return pd.concat([store.metadata, profiles], axis=1)
+
+def export_profile_csv(store_path, csv_path):
+    profile_store_to_frame(load_profile_store(store_path)).to_csv(csv_path, index=False)
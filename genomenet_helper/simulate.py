@@ -1,76 +1,155 @@
 import os
-import random
-import collections
-from collections import defaultdict
 import numpy as np
-from Bio import SeqIO
-from .utils import generate_output_directory
+from .fasta_cache import get_fasta_index, get_fasta_stats
+from .fasta_reader import is_fasta, read_records
+from .kmer_counting import DECODE_TABLE, encode_kmers, encode_sequence, kmer_codes
+from .utils import append_manifest, atomic_write, generate_output_directory, genome_rng, ordered_map, read_manifest
+
+SIMULATION_MODELS = ['kmer', 'markov']
 
 def calculate_frequencies(fasta_file, kmer_length):
-    records = list(SeqIO.parse(fasta_file, "fasta"))
-    sequence = str(records[0].seq).upper()
+    """
+    Counts the k-mers of all records of fasta_file into a vector indexed by integer k-mer code.
+    K-mers containing non-ACGT characters are skipped.
+    """
+    stats = get_fasta_stats(fasta_file)
 
     # Check for non-ACGT characters and print a message if found
-    non_acgt_characters = set([base for base in sequence if base not in 'ACGT'])
+    non_acgt_characters = sorted(set((['N'] if stats['n_count'] else []) + [c.upper() for c in stats['invalid_characters']]))
     if non_acgt_characters:
         non_acgt_char_list = ', '.join(non_acgt_characters)
         print(f"Warning: Non-ACGT characters detected in {os.path.basename(fasta_file)} ({non_acgt_char_list}). These will be excluded from k-mer frequencies.")
 
-    # Filter out non-ACGT characters
-    filtered_sequence = ''.join([base for base in sequence if base in 'ACGT'])
+    counts = np.zeros(4 ** kmer_length, dtype=np.int64)
+    for _, sequence in read_records(fasta_file, get_fasta_index(fasta_file)):
+        counts += np.bincount(kmer_codes(encode_sequence(sequence), kmer_length), minlength=4 ** kmer_length)
+    return counts
+
+def add_randomness(probabilities, randomness, rng):
+    """
+    Perturbs the probabilities of the observed k-mers; k-mers that do not occur in the genome stay at 0.
+    """
+    observed = probabilities > 0
+    new_probabilities = probabilities.copy()
+    new_probabilities[observed] = np.clip(probabilities[observed] + rng.uniform(-randomness, randomness, int(observed.sum())), 0, None)
+    if not new_probabilities.sum():
+        return probabilities
+    return new_probabilities / new_probabilities.sum()
+
+def decode_bases(codes):
+    """
+    Converts an array of 2-bit base codes to sequence bytes via a lookup table.
+    """
+    return DECODE_TABLE[codes].tobytes()
+
+def sample_kmers(rng, probabilities, kmer_length, seq_length):
+    """
+    Concatenates seq_length // kmer_length k-mers drawn independently from the k-mer distribution.
+    """
+    cumulative = np.cumsum(probabilities)
+    codes = np.searchsorted(cumulative, rng.random(seq_length // kmer_length) * cumulative[-1], side='right')
+    codes = np.minimum(codes, len(probabilities) - 1)
+    shifts = 2 * np.arange(kmer_length - 1, -1, -1)
+    return decode_bases(((codes[:, None] >> shifts) & 3).ravel())
+
+def sample_markov(rng, probabilities, kmer_length, seq_length):
+    """
+    Generates a sequence from the order-(k-1) Markov chain implied by the k-mer distribution.
+    The sequence is built as about sqrt(seq_length) lanes that are extended in parallel and joined
+    end to end. Within a lane every k-mer junction follows the observed transition frequencies, but
+    each lane restarts the chain with a k-mer drawn from the k-mer distribution, so the k-1 junctions
+    across each lane boundary do not.
+    """
+    context_size = 4 ** (kmer_length - 1)
+    transitions = probabilities.reshape(context_size, 4)
+    row_totals = transitions.sum(axis=1, keepdims=True)
+    transitions = np.where(row_totals > 0, transitions / np.where(row_totals > 0, row_totals, 1), 0.25)
+    cumulative = np.cumsum(transitions, axis=1)
+
+    n_lanes = max(1, int(np.sqrt(seq_length)))
+    lane_length = max(kmer_length, -(-seq_length // n_lanes))
+    lanes = np.empty((n_lanes, lane_length), dtype=np.uint8)
+
+    starts = np.searchsorted(np.cumsum(probabilities), rng.random(n_lanes) * probabilities.sum(), side='right')
+    starts = np.minimum(starts, len(probabilities) - 1)
+    for offset in range(kmer_length):
+        lanes[:, offset] = (starts >> (2 * (kmer_length - 1 - offset))) & 3
 
-    counter = collections.Counter([filtered_sequence[i:i+kmer_length] for i in range(len(filtered_sequence) - kmer_length + 1)])
-    total = sum(counter.values())
-    kmers = list(counter.keys())
-    probabilities = [counter[kmer] / total for kmer in kmers]
-    return kmers, probabilities, counter
+    context = starts & (context_size - 1)
+    draws = rng.random((lane_length - kmer_length, n_lanes))
+    for step in range(lane_length - kmer_length):
+        bases = (draws[step][:, None] > cumulative[context, :3]).sum(axis=1)
+        lanes[:, kmer_length + step] = bases
+        context = ((context << 2) | bases) & (context_size - 1)
+    return decode_bases(lanes.ravel()[:seq_length])
 
-def add_randomness(probabilities, randomness):
-    new_probabilities = [p + np.random.uniform(-randomness, randomness) for p in probabilities]
-    total = sum(new_probabilities)
-    new_probabilities = [p / total for p in new_probabilities]
-    return new_probabilities
+def simulate_genome(task):
+    """
+    Simulates the genome for one input file with its own random stream.
+    Runs in a worker process; returns the manifest entry of the input.
+    """
+    input_path, output_dir, number, sim_size_kb, kmer_length, seed, randomness, monitor_kmers, model = task
+    fasta_file = os.path.basename(input_path)
+    rng = genome_rng(seed, fasta_file)
 
+    mean_length = sim_size_kb * 1000  # Convert kb to bases
+    std_dev = sim_size_kb * 1000 * 0.10  # 10% of sim_size_kb in bases
+    # This means that roughly 68% of the sequences would be within 90kb to 110kb, 95% would be within 80kb to 120kb, and almost all should fall between 70kb and 130kb if the lengths are normally distributed.
 
-def simulate_genomes(input_dir, sim_size_kb=100, kmer_length=3, seed=None, randomness=0.0, monitor_kmers=None):
-    random.seed(seed)
-    
-    output_dir = generate_output_directory(input_dir, "simulated")
+    kmer_counts = calculate_frequencies(input_path, kmer_length)
+    if not kmer_counts.any():
+        return {'input': fasta_file, 'output': None, 'length': None, 'frequencies': None}
+    probabilities = kmer_counts / kmer_counts.sum()
+    frequencies = None
+    if monitor_kmers:
+        frequencies = {kmer: float(probabilities[encode_kmers([kmer])[0]]) if len(kmer) == kmer_length else 0.0 for kmer in monitor_kmers}
+
+    seq_length = max(0, int(rng.normal(mean_length, std_dev)))
+    new_probabilities = add_randomness(probabilities, randomness, rng) if randomness else probabilities
+
+    if model == 'markov':
+        sequence = sample_markov(rng, new_probabilities, kmer_length, seq_length)
+    else:
+        sequence = sample_kmers(rng, new_probabilities, kmer_length, seq_length)
+
+    header = f'>simulated_sequence_{number}'
+    filename = f'simulated_sequence_{number}.fasta'
+    atomic_write(os.path.join(output_dir, filename), header.encode() + b'\n' + sequence)
+    return {'input': fasta_file, 'output': filename, 'length': seq_length, 'frequencies': frequencies}
+
+def simulate_genomes(input_dir, sim_size_kb=100, kmer_length=3, seed=None, randomness=0.0, monitor_kmers=None, model='kmer', workers=1, output_dir=None):
+    """
+    Simulates one genome per input file. Each genome uses a random stream derived from the seed and
+    its file name, so the output does not depend on the number of workers. Finished genomes are
+    recorded in a manifest in the output directory; rerunning with the same output directory
+    resumes an interrupted run.
+    """
+    output_dir = output_dir or generate_output_directory(input_dir, "simulated")
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    num_files_written = 0
-    lengths = []
+    completed = read_manifest(output_dir)
+    fasta_files = [f for f in sorted(os.listdir(input_dir)) if is_fasta(f)]
+    if completed:
+        print(f"Resuming: {len(completed)} of {len(fasta_files)} genomes already simulated in {output_dir}.")
+    # Output numbers follow the sorted input order, so they are stable across resumes and worker counts
+    tasks = ((os.path.join(input_dir, fasta_file), output_dir, number, sim_size_kb, kmer_length, seed, randomness, monitor_kmers, model)
+             for number, fasta_file in enumerate(fasta_files, start=1) if fasta_file not in completed)
+
+    num_reported = 0
     print("Frequencies for selected k-mers for the first 10 processed files:")
-    for fasta_file in os.listdir(input_dir):
-        if fasta_file.endswith('.fasta'):
-            input_path = os.path.join(input_dir, fasta_file)
-
-            mean_length = sim_size_kb * 1000  # Convert kb to bases
-            std_dev = sim_size_kb * 1000 * 0.10  # 10% of sim_size_kb in bases
-            # This means that roughly 68% of the sequences would be within 90kb to 110kb, 95% would be within 80kb to 120kb, and almost all should fall between 70kb and 130kb if the lengths are normally distributed.
-
-            kmers, probabilities, kmer_counts = calculate_frequencies(input_path, kmer_length)
-            if num_files_written < 10 and monitor_kmers:
-                frequencies = {kmer: kmer_counts.get(kmer, 0) / sum(kmer_counts.values()) for kmer in monitor_kmers}
-                print(f"Frequencies in {fasta_file}: " + ", ".join([f"{kmer}: {freq:.4f}" for kmer, freq in frequencies.items()]))
-
-            seq_length = int(np.random.normal(mean_length, std_dev))
-            lengths.append(seq_length)
-            new_probabilities = add_randomness(probabilities, randomness)
-            
-            sequence = ''.join(random.choices(kmers, weights=new_probabilities, k=seq_length // kmer_length))
-            
-            header = f'>simulated_sequence_{num_files_written + 1}'
-            filename = os.path.join(output_dir, f'simulated_sequence_{num_files_written + 1}.fasta')
-
-            with open(filename, 'w') as f:
-                f.write(header + '\n')
-                f.write(sequence)
-
-            num_files_written += 1
-
-    print(f'Finished generating {num_files_written} simulated genomes in {output_dir}.')
-    print(f'Average sequence length: {np.mean(lengths):.2f} ± {np.std(lengths):.2f}')
-    print(f'Min sequence length: {min(lengths)}')
-    print(f'Max sequence length: {max(lengths)}')
+    for entry in ordered_map(simulate_genome, tasks, workers):
+        append_manifest(output_dir, entry)
+        completed[entry['input']] = entry
+        if entry['output'] is None:
+            print(f"Skipping {entry['input']}: no valid {kmer_length}-mers found.")
+        elif num_reported < 10 and entry['frequencies']:
+            print(f"Frequencies in {entry['input']}: " + ", ".join([f"{kmer}: {freq:.4f}" for kmer, freq in entry['frequencies'].items()]))
+            num_reported += 1
+
+    lengths = [entry['length'] for entry in completed.values() if entry['output'] is not None]
+    print(f'Finished generating {len(lengths)} simulated genomes in {output_dir}.')
+    if lengths:
+        print(f'Average sequence length: {np.mean(lengths):.2f} ± {np.std(lengths):.2f}')
+        print(f'Min sequence length: {min(lengths)}')
+        print(f'Max sequence length: {max(lengths)}')
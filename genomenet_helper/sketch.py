@@ -0,0 +1,174 @@
+import os
+import sqlite3
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from .fasta_cache import get_fasta_index, open_cache
+from .fasta_reader import read_records
+from .kmer_counting import encode_sequence, kmer_codes
+from .utils import ordered_map
+
+DEFAULT_SKETCH_KMER = 21
+DEFAULT_SKETCH_SIZE = 512
+SKETCH_SEED = 42
+
+# Marks a sketch bin that received no k-mer.
+EMPTY_BIN = np.uint32(0xFFFFFFFF)
+
+# Sequences are hashed in chunks of this many bases to bound memory on very long records.
+SKETCH_CHUNK = 1 << 23
+
+def hash_kmers(codes, seed=SKETCH_SEED):
+    """
+    Mixes integer k-mer codes into uniformly distributed 64-bit hashes (splitmix64 finalizer).
+    """
+    x = codes.astype(np.uint64) + np.uint64(seed)
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+def sketch_genome(path, kmer_size=DEFAULT_SKETCH_KMER, sketch_size=DEFAULT_SKETCH_SIZE):
+    """
+    Computes a one-permutation MinHash sketch of the canonical k-mers of a genome: every k-mer hash is
+    assigned to one of sketch_size bins by its low bits and each bin keeps the smallest high 32 bits.
+    Two sketches estimate the Jaccard index of the k-mer sets as the fraction of equal bins.
+    """
+    sketch = np.full(sketch_size, EMPTY_BIN, dtype=np.uint32)
+    for _, sequence in read_records(path, get_fasta_index(path)):
+        codes = encode_sequence(sequence)
+        for start in range(0, max(len(codes) - kmer_size + 1, 0), SKETCH_CHUNK):
+            chunk = codes[start:start + SKETCH_CHUNK + kmer_size - 1]
+            hashes = hash_kmers(kmer_codes(chunk, kmer_size, canonical=True))
+            bins = (hashes & np.uint64(sketch_size - 1)).astype(np.intp)
+            np.minimum.at(sketch, bins, (hashes >> np.uint64(32)).astype(np.uint32))
+    return sketch
+
+def _sketch_task(task):
+    path, kmer_size, sketch_size = task
+    return sketch_genome(path, kmer_size, sketch_size)
+
+def _open_sketch_cache():
+    connection = open_cache()
+    connection.execute('CREATE TABLE IF NOT EXISTS sketches (path TEXT, mtime_ns INTEGER, size INTEGER, '
+                       'kmer_size INTEGER, sketch_size INTEGER, sketch BLOB, PRIMARY KEY (path, kmer_size, sketch_size))')
+    return connection
+
+def sketch_genomes(paths, kmer_size=DEFAULT_SKETCH_KMER, sketch_size=DEFAULT_SKETCH_SIZE, workers=1):
+    """
+    Returns a (len(paths), sketch_size) uint32 matrix of sketches. Sketches are cached next to the
+    FASTA index (keyed by path, mtime and size); only new or changed genomes are sketched, in parallel.
+    """
+    if sketch_size & (sketch_size - 1):
+        raise ValueError(f"The sketch size must be a power of two, got {sketch_size}")
+    sketches = np.empty((len(paths), sketch_size), dtype=np.uint32)
+    connection = _open_sketch_cache()
+    try:
+        missing = []
+        for i, path in enumerate(paths):
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            row = connection.execute('SELECT mtime_ns, size, sketch FROM sketches WHERE path = ? AND kmer_size = ? AND sketch_size = ?',
+                                     (path, kmer_size, sketch_size)).fetchone()
+            if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+                sketches[i] = np.frombuffer(row[2], dtype=np.uint32)
+            else:
+                missing.append((i, path, stat))
+
+        tasks = ((path, kmer_size, sketch_size) for _, path, _ in missing)
+        for (i, path, stat), sketch in zip(missing, ordered_map(_sketch_task, tasks, workers)):
+            sketches[i] = sketch
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO sketches VALUES (?, ?, ?, ?, ?, ?)',
+                                   (path, stat.st_mtime_ns, stat.st_size, kmer_size, sketch_size, sqlite3.Binary(sketch.tobytes())))
+    finally:
+        connection.close()
+    return sketches
+
+def jaccard_to_distance(jaccard, kmer_size):
+    """
+    Mash distance for a Jaccard index estimate (1 for disjoint k-mer sets).
+    """
+    jaccard = np.asarray(jaccard, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        distance = -np.log(2 * jaccard / (1 + jaccard)) / kmer_size
+    return np.clip(distance, 0.0, 1.0)
+
+def distance_to_jaccard(distance, kmer_size):
+    return 1 / (2 * np.exp(kmer_size * distance) - 1)
+
+def lsh_band_rows(sketch_size, jaccard_threshold):
+    """
+    Chooses the rows per LSH band: the largest power of two whose band collision threshold
+    (1/bands)^(1/rows) stays below the Jaccard threshold, so that similar pairs are rarely missed.
+    """
+    rows = 1
+    while rows * 2 <= sketch_size and (rows * 2 / sketch_size) ** (1 / (rows * 2)) < 0.8 * jaccard_threshold:
+        rows *= 2
+    return rows
+
+def band_keys(sketches, band, rows):
+    """
+    Hashes the rows of one LSH band of every sketch into a single 64-bit bucket key.
+    """
+    keys = np.zeros(len(sketches), dtype=np.uint64)
+    for column in range(band * rows, (band + 1) * rows):
+        keys = hash_kmers(keys ^ sketches[:, column].astype(np.uint64))
+    return keys
+
+def pair_distances(sketches, first, second, kmer_size, chunk_size=1 << 16):
+    """
+    Mash distances of the sketch pairs (first[i], second[i]), computed in chunks.
+    """
+    distances = np.empty(len(first), dtype=np.float64)
+    for start in range(0, len(first), chunk_size):
+        a = sketches[first[start:start + chunk_size]]
+        b = sketches[second[start:start + chunk_size]]
+        filled = (a != EMPTY_BIN) | (b != EMPTY_BIN)
+        jaccard = ((a == b) & filled).sum(axis=1) / np.maximum(filled.sum(axis=1), 1)
+        distances[start:start + chunk_size] = jaccard_to_distance(jaccard, kmer_size)
+    return distances
+
+def cluster_sketches(sketches, distance_threshold, kmer_size=DEFAULT_SKETCH_KMER):
+    """
+    Single-linkage clusters of genomes within distance_threshold (Mash distance) of each other.
+    Candidate pairs come from an LSH index over bands of the sketches, so genomes are never compared
+    all-against-all: within each band bucket every genome is paired with the first genome of the
+    bucket and with its neighbour, and only pairs not yet in the same cluster are verified with the
+    full sketch distance. Returns an array with the cluster number of every genome.
+    """
+    n, sketch_size = sketches.shape
+    rows = lsh_band_rows(sketch_size, distance_to_jaccard(distance_threshold, kmer_size))
+    labels = np.arange(n)
+    edges = [np.empty((2, 0), dtype=np.intp)]
+
+    for band in range(sketch_size // rows):
+        keys = band_keys(sketches, band, rows)
+        # Genomes whose bins in this band are all empty collide without being similar
+        keys[(sketches[:, band * rows:(band + 1) * rows] == EMPTY_BIN).all(axis=1)] = np.uint64(0)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        same_as_previous = np.concatenate(([False], sorted_keys[1:] == sorted_keys[:-1])) & (sorted_keys != 0)
+        if not same_as_previous.any():
+            continue
+        bucket_first = order[np.maximum.accumulate(np.where(same_as_previous, 0, np.arange(n)))]
+        members = np.flatnonzero(same_as_previous)
+        first = np.concatenate((bucket_first[members], order[members - 1]))
+        second = np.concatenate((order[members], order[members]))
+        candidates = labels[first] != labels[second]
+        first, second = first[candidates], second[candidates]
+        if not len(first):
+            continue
+        close = pair_distances(sketches, first, second, kmer_size) <= distance_threshold
+        if close.any():
+            edges.append(np.vstack((first[close], second[close])))
+            all_edges = np.hstack(edges)
+            graph = sparse.coo_matrix((np.ones(all_edges.shape[1], dtype=np.int8), (all_edges[0], all_edges[1])), shape=(n, n))
+            _, labels = connected_components(graph, directed=False)
+
+    _, clusters = np.unique(labels, return_inverse=True)
+    return clusters
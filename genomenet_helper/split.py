@@ -1,101 +1,67 @@
 import os
+import gzip
 import random
-import shutil
-import hashlib
 import statistics
+from collections import Counter
 
-from .utils import generate_output_directory
+from Bio import bgzf
 
-def split_files_by_size(file_sizes, fractions):
-    """
-    Splits the files based on their sizes according to the given fractions.
-    """
-    total_size = sum(file_sizes.values())
-    sorted_files = sorted(file_sizes.keys(), key=lambda x: file_sizes[x], reverse=True)
-
-    train_size = fractions[0] / 100 * total_size
-    val_size = fractions[1] / 100 * total_size
-
-    train_files, val_files, test_files = [], [], []
-    current_train, current_val = 0, 0
-
-    for f in sorted_files:
-        if current_train + file_sizes[f] <= train_size:
-            train_files.append(f)
-            current_train += file_sizes[f]
-        elif current_val + file_sizes[f] <= val_size:
-            val_files.append(f)
-            current_val += file_sizes[f]
-        else:
-            test_files.append(f)
+from .fasta_cache import get_fasta_stats
+from .fasta_reader import is_fasta
+from .materialize import materialize_file, write_file_manifest
+from .partition import combine_groups, format_partition_report, partition
+from .sketch import DEFAULT_SKETCH_KMER, DEFAULT_SKETCH_SIZE, cluster_sketches, sketch_genomes
+from .split_policy import decide, resolve_policy, write_split_report
+from .utils import generate_output_directory, ordered_map
 
-    return train_files, val_files, test_files
-
-def find_and_remove_non_acgt_characters(filepath):
+def split_files_by_weight(file_weights, fractions, groups=None, strata=None, seed=None):
     """
-    Find non-ACGT characters in a FASTA file and return them along with their count.
-    If user opts in, remove the non-ACGT characters.
+    Splits the files so that the total weights (file sizes or 1 per file) of train, validation and test
+    follow the given fractions as closely as possible (see partition.partition). Files with the same
+    group (e.g. a cluster of similar genomes) stay in one split; with strata, every stratum
+    (e.g. a class label) is split according to the fractions on its own.
+    Prints the achieved fractions and returns the train, validation and test file lists.
     """
-    non_acgt_characters = set()
-    content = []
-    with open(filepath, 'r') as f:
-        for line in f:
-            clean_line = line.strip()
-            if clean_line.startswith('>'):  # Header line
-                content.append(clean_line)
-            else:  # Sequence line
-                non_acgt_characters.update(set(c for c in clean_line if c not in 'ACGTNacgtn'))
-                content.append(clean_line)
-
-    if non_acgt_characters:
-        print(f"Non-ACGT characters found in {filepath}: {', '.join(non_acgt_characters)}")
-        choice = input("Do you want to delete these characters? (y/n): ")
-        if choice.strip().lower() == 'y':
-            content = [line.translate({ord(c): None for c in non_acgt_characters}) for line in content]
-            with open(filepath, 'w') as f:
-                for line in content:
-                    f.write(f"{line}\n")
-            print(f"Deleted {len(non_acgt_characters)} types of non-ACGT characters from {filepath}")
-            return len(non_acgt_characters)
-    return 0
-
-
-def check_empty_files_and_delete(dirs):
+    files = sorted(file_weights)
+    result = partition([file_weights[f] for f in files], fractions,
+                       groups=None if groups is None else [groups[f] for f in files],
+                       strata=None if strata is None else [strata[f] for f in files], seed=seed)
+    print("Split fractions: " + format_partition_report(result))
+    assigned = [[], [], []]
+    for f, split in zip(files, result.assignment):
+        assigned[split].append(f)
+    return assigned[0], assigned[1], assigned[2]
+
+def read_split_metadata(path, files, columns):
     """
-    Check if any file in the directories is empty.
-    Deletes the empty files after confirmation from the user.
+    Reads the given columns of a tab-separated metadata file with a `file` column
+    and returns {column: {file name: value}} for the files to split.
     """
-    empty_files = []
-    for d in dirs:
-        for file in os.listdir(d):
-            filepath = os.path.join(d, file)
-            if os.path.getsize(filepath) == 0:
-                empty_files.append(filepath)
-
-    if empty_files:
-        print("Warning: The following files are empty and will be deleted:")
-        for f in empty_files:
-            print(f)
-        confirmation = input("Do you want to delete these files? (y/n): ")
-        if confirmation.strip().lower() == 'y':
-            for f in empty_files:
-                os.remove(f)
-                print(f"Deleted {f}")
-
-
-def file_size_outliers(dirs):
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        missing_columns = [column for column in ['file'] + columns if column not in header]
+        if missing_columns:
+            raise ValueError(f"Metadata file {path} has no column(s): " + ", ".join(missing_columns))
+        rows = {}
+        for line in f:
+            if line.strip():
+                row = dict(zip(header, line.rstrip('\n').split('\t')))
+                rows[os.path.basename(row['file'])] = row
+    missing_files = [f for f in files if f not in rows]
+    if missing_files:
+        raise ValueError(f"{len(missing_files)} files are missing from {path}, e.g. " + ", ".join(missing_files[:5]))
+    return {column: {f: rows[f].get(column, '') for f in files} for column in columns}
+
+def file_size_outliers(file_sizes):
     """
     Checks for file size outliers, which are defined as files that have a size 2 SDs away from the mean.
-    Returns the average file size and a list of outlier files.
+    Takes a dict of file path to size; returns the average file size and a list of outlier files.
     """
-    file_sizes = []
-    for d in dirs:
-        for file in os.listdir(d):
-            file_sizes.append(os.path.getsize(os.path.join(d, file)))
-
-    mean_size = statistics.mean(file_sizes)
-    stdev_size = statistics.stdev(file_sizes)
-    outliers = [os.path.join(d, file) for d in dirs for file in os.listdir(d) if abs(os.path.getsize(os.path.join(d, file)) - mean_size) > 2 * stdev_size]
+    if len(file_sizes) < 2:
+        return (statistics.mean(file_sizes.values()) if file_sizes else 0), []
+    mean_size = statistics.mean(file_sizes.values())
+    stdev_size = statistics.stdev(file_sizes.values())
+    outliers = [path for path, size in file_sizes.items() if abs(size - mean_size) > 2 * stdev_size]
     return mean_size, outliers
 
 def rename_files(input_dir):
@@ -103,184 +69,246 @@ def rename_files(input_dir):
     for f in files_to_rename:
         os.rename(os.path.join(input_dir, f), os.path.join(input_dir, f.replace('.fna', '.fasta')))
 
-def contains_non_acgt(filename):
-    """
-    Check if a FASTA file contains non-ACGT characters.
-    """
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()  # Remove any trailing whitespace
-            if not line:  # Skip empty lines
-                continue
-            if line.startswith('>'):  # Skip FASTA header lines
-                continue
-            for char in line:
-                if char not in 'ACGTNacgtn':  # Considering both uppercase and lowercase characters
-                    return True
-    return False
-
-def check_duplicate_filenames(dirs):
-    all_files = []
-    for d in dirs:
-        all_files.extend(os.listdir(d))
+def check_duplicate_filenames(paths):
+    all_files = [os.path.basename(path) for path in paths]
     return len(all_files) != len(set(all_files))
 
-def compute_hash(filepath):
-    hash_md5 = hashlib.md5()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-def check_file_hashes(dirs):
-    hashes = {}
-    for d in dirs:
-        for file in os.listdir(d):
-            file_hash = compute_hash(os.path.join(d, file))
-            if file_hash in hashes:
-                return False, (hashes[file_hash], os.path.join(d, file))
-            hashes[file_hash] = os.path.join(d, file)
-    return True, None
-
-def get_file_sizes(input_dir):
+def scan_file(path):
     """
-    Returns a dictionary with file names as keys and their sizes as values.
+    Returns the pre-flight statistics of one file (size, content hash, non-ACGT characters), read
+    from the FASTA index cache or computed in a single pass over large blocks.
     """
-    return {f: os.path.getsize(os.path.join(input_dir, f)) for f in os.listdir(input_dir) if f.endswith('.fasta')}
+    stats = get_fasta_stats(path)
+    return {'size': stats['size'], 'hash': stats['hash'], 'length': stats['length'],
+            'invalid_characters': stats['invalid_characters']}
 
-def split_files(input_dir, fractions, by_size=False):
+def preflight_scan(paths, workers=1):
     """
-    Splits the files in input_dir according to the given fractions.
-    Files that contain non-ACGT characters will have these characters removed
-    in the output directories without modifying the original files.
+    Scans all files once, in parallel, and returns their statistics keyed by path.
+    The split, cleaning, outlier and duplicate checks all work from these results.
     """
-    total_size = sum(file_sizes.values())
-    sorted_files = sorted(file_sizes.keys(), key=lambda x: file_sizes[x], reverse=True)
+    return dict(zip(paths, ordered_map(scan_file, paths, workers)))
 
-    train_size = fractions[0] / 100 * total_size
-    val_size = fractions[1] / 100 * total_size
+# Everything except ACGTN is removed from sequence lines when cleaning a file.
+NON_NUCLEOTIDE_BYTES = bytes(c for c in range(256) if chr(c) not in 'ACGTNacgtn')
 
-    train_files, val_files, test_files = [], [], []
-    current_train, current_val = 0, 0
-
-    for f in sorted_files:
-        if current_train + file_sizes[f] <= train_size:
-            train_files.append(f)
-            current_train += file_sizes[f]
-        elif current_val + file_sizes[f] <= val_size:
-            val_files.append(f)
-            current_val += file_sizes[f]
-        else:
-            test_files.append(f)
-
-    return train_files, val_files, test_files
-
-
-def split_files(input_dir, fractions, by_size=False):
+def clean_copy(src_path, dest_path):
+    """
+    Copies a FASTA file, removing non-ACGT characters (N is kept) from the sequence lines.
+    """
+    opener = gzip.open if src_path.endswith('.gz') else open
+    with opener(src_path, 'rb') as source_file:
+        with open(dest_path, 'wb') as raw:
+            dest_file = bgzf.BgzfWriter(fileobj=raw) if dest_path.endswith('.gz') else raw
+            for line in source_file:
+                if line.startswith(b'>'):  # Header line
+                    dest_file.write(line)
+                else:  # Sequence line
+                    dest_file.write(line.translate(None, NON_NUCLEOTIDE_BYTES) + b'\n')
+            if dest_file is not raw:
+                dest_file.close()
+
+def split_files(input_dir, fractions, by_size=False, workers=1, materialize='copy', cluster_distance=None,
+                sketch_kmer=DEFAULT_SKETCH_KMER, sketch_size=DEFAULT_SKETCH_SIZE, metadata=None, stratify=None, group=None,
+                policy=None, report_path=None):
     """
     Splits the files in input_dir according to the given fractions.
     Files that contain non-ACGT characters will have these characters removed
     in the output directories without modifying the original files.
+    All files are scanned once up front, with `workers` processes (see preflight_scan).
+    Clean files are placed in the output directories according to `materialize` (see materialize_file);
+    in manifest mode they are only listed in each directory's file manifest.
+    With cluster_distance, genomes within that Mash distance of each other (see sketch.cluster_sketches)
+    always end up in the same split, so near-duplicates cannot leak between train and test.
+    stratify and group name columns of the tab-separated metadata file: every stratum is split
+    according to the fractions, and files with the same group value stay in one split.
+    policy (see split_policy.resolve_policy) decides what happens to .fna files, non-ACGT characters,
+    empty, duplicate and outlier files and the original files; by default the user is asked.
+    Returns a report of every action and statistic, which is also written as JSON to report_path.
     """
-    output_dir_base = os.path.basename(os.path.normpath(input_dir))
-    all_files = [f for f in os.listdir(input_dir) if f.endswith('.fasta')]
+    policy = policy or resolve_policy()
+    report = {'input_dir': os.path.abspath(input_dir), 'fractions': list(fractions), 'by_size': by_size,
+              'materialize': materialize, 'policy': policy, 'actions': [], 'excluded': {}}
+
+    # Check and rename .fna files
+    fna_files = sorted(f for f in os.listdir(input_dir) if f.endswith('.fna'))
+    if fna_files and decide(policy, 'rename_fna', "Found .fna files. Do you want to rename them to .fasta?") == 'rename':
+        rename_files(input_dir)
+        report['actions'] += [{'action': 'renamed', 'file': f, 'to': f.replace('.fna', '.fasta')} for f in fna_files]
 
-    # Check for non-fasta files
-    non_fasta_files = [f for f in os.listdir(input_dir) if not f.endswith('.fasta')]
+    # Check for non-fasta files; hidden files such as the download state are metadata
+    non_fasta_files = [f for f in os.listdir(input_dir) if not is_fasta(f) and not f.startswith('.')]
     if non_fasta_files:
         raise ValueError("Found non-fasta files: " + ", ".join(non_fasta_files))
+    all_files = sorted(f for f in os.listdir(input_dir) if is_fasta(f))
 
-    # Check and rename .fna files
-    fna_files = [f for f in os.listdir(input_dir) if f.endswith('.fna')]
-    if fna_files:
-        rename_choice = input("Found .fna files. Do you want to rename them to .fasta? (y/n): ")
-        if rename_choice.strip().lower() == 'y':
-            rename_files(input_dir)
-
-    # Find files that contain non-ACGT characters
-    amino_files = []
+    # Read sizes, hashes and non-ACGT characters of all files in one parallel pass
     print("Reading file informations")
-    for file in all_files:
-        filepath = os.path.join(input_dir, file)
-        if contains_non_acgt(filepath):
-            amino_files.append(filepath)
+    scan = preflight_scan([os.path.join(input_dir, f) for f in all_files], workers)
+    file_stats = {f: scan[os.path.join(input_dir, f)] for f in all_files}
+    amino_files = {f for f in all_files if file_stats[f]['invalid_characters']}
+    print(f"Scanned {len(scan)} files ({sum(stats['size'] for stats in scan.values()) / (1024 ** 3):.2f} GB), "
+          f"{len(amino_files)} contain non-ACGT characters.")
+    report['scanned'] = {'files': len(all_files), 'bytes': sum(stats['size'] for stats in scan.values()),
+                         'non_acgt_files': len(amino_files)}
+
+    # Decide on files with non-ACGT characters, empty, duplicate and outlier files before splitting
+    if amino_files and policy['non_acgt'] == 'fail':
+        raise ValueError(f"{len(amino_files)} files contain non-ACGT characters, e.g. " + ", ".join(sorted(amino_files)[:5]))
+    if policy['non_acgt'] == 'exclude':
+        report['excluded']['non_acgt'] = sorted(amino_files)
+
+    empty_files = [f for f in all_files if file_stats[f]['length'] == 0]
+    if empty_files:
+        print("Warning: The following files are empty:")
+        for f in empty_files:
+            print(f)
+        action = decide(policy, 'empty_files', "Do you want to exclude these files from the split?")
+        if action == 'fail':
+            raise ValueError(f"{len(empty_files)} files contain no sequence, e.g. " + ", ".join(empty_files[:5]))
+        if action == 'exclude':
+            report['excluded']['empty'] = empty_files
+    else:
+        print("All files have content. None are empty.")
+    report['empty_files'] = empty_files
+
+    excluded = {f for files in report['excluded'].values() for f in files}
+    files_by_hash = {}
+    for f in all_files:
+        if f not in excluded:
+            files_by_hash.setdefault(file_stats[f]['hash'], []).append(f)
+    duplicate_sets = [files for files in files_by_hash.values() if len(files) > 1]
+    report['duplicates'] = duplicate_sets
+    if duplicate_sets:
+        action = decide(policy, 'duplicates', f"{sum(len(files) - 1 for files in duplicate_sets)} files have the same content "
+                        "as another file. Do you want to list them?")
+        if action == 'fail':
+            raise ValueError(f"Files {duplicate_sets[0][0]} and {duplicate_sets[0][1]} have the same content!")
+        if action in ('report', 'exclude'):
+            for files in duplicate_sets:
+                print(f"Files {' and '.join(files)} have the same content!")
+        if action == 'exclude':
+            report['excluded']['duplicate'] = [f for files in duplicate_sets for f in files[1:]]
+            print("Only the first file of each set is kept.")
+    else:
+        print("No duplications found.")
+
+    # test if there are files with a unexpected size
+    excluded = {f for files in report['excluded'].values() for f in files}
+    mean_size, outlier_files = file_size_outliers({f: file_stats[f]['size'] for f in all_files if f not in excluded})
+    report['outliers'] = outlier_files
+    if outlier_files:
+        print(f"\nAverage file size is {mean_size / (1024 * 1024):.2f} MB.")
+        print(f"{len(outlier_files)} files are significantly larger or smaller than the average:")
+        for f in outlier_files:
+            print(f"{f} - {file_stats[f]['size'] / (1024 * 1024):.2f} MB")
+        if policy['outliers'] == 'fail':
+            raise ValueError(f"{len(outlier_files)} files have an unexpected size")
+        if policy['outliers'] == 'exclude':
+            report['excluded']['outlier'] = outlier_files
+    else:
+        print("\nAll files are of typical size. No outliers detected.")
+
+    excluded = {f for files in report['excluded'].values() for f in files}
+    if excluded:
+        print(f"{len(excluded)} files are excluded from the split: " +
+              ", ".join(f"{len(files)} {reason}" for reason, files in report['excluded'].items() if files))
+    split_input = [f for f in all_files if f not in excluded]
+
+    # Group and stratum of every file, if requested
+    columns = [column for column in (stratify, group) if column]
+    if columns and metadata is None:
+        raise ValueError("--stratify and --group need a --metadata file")
+    file_metadata = read_split_metadata(metadata, split_input, columns) if columns else {}
+    strata = file_metadata.get(stratify)
+    groups = file_metadata.get(group)
+
+    if cluster_distance is not None:
+        print(f"Sketching {len(split_input)} genomes (k={sketch_kmer}, sketch size {sketch_size})")
+        sketches = sketch_genomes([os.path.join(input_dir, f) for f in split_input], sketch_kmer, sketch_size, workers)
+        clusters = cluster_sketches(sketches, cluster_distance, sketch_kmer)
+        cluster_sizes = Counter(clusters)
+        print(f"Found {len(cluster_sizes)} clusters at Mash distance {cluster_distance}; "
+              f"the largest contains {max(cluster_sizes.values(), default=0)} genomes.")
+        report['clusters'] = len(cluster_sizes)
+        if groups is not None:
+            # Similar genomes and files of the same group must both stay together
+            clusters = combine_groups(clusters, [groups[f] for f in split_input])
+        groups = dict(zip(split_input, clusters))
 
     # Split files by size or randomly
-    if by_size:
-        file_sizes = get_file_sizes(input_dir)
-        train_files, val_files, test_files = split_files_by_size(file_sizes, fractions)
+    if by_size or groups is not None or strata is not None:
+        file_weights = {f: file_stats[f]['size'] if by_size else 1 for f in split_input}
+        train_files, val_files, test_files = split_files_by_weight(file_weights, fractions, groups, strata, policy['seed'])
     else:
-        random.shuffle(all_files)
-        n = len(all_files)
-        train_files = all_files[:int(n * fractions[0] / 100)]
-        val_files = all_files[int(n * fractions[0] / 100):int(n * (fractions[0] + fractions[1]) / 100)]
-        test_files = all_files[int(n * (fractions[0] + fractions[1]) / 100):]
+        random.Random(policy['seed']).shuffle(split_input)
+        n = len(split_input)
+        train_files = split_input[:int(n * fractions[0] / 100)]
+        val_files = split_input[int(n * fractions[0] / 100):int(n * (fractions[0] + fractions[1]) / 100)]
+        test_files = split_input[int(n * (fractions[0] + fractions[1]) / 100):]
 
     # Create directories for train, validation, and test sets
     dirs = ["train", "validation", "test"]
-    output_dirs = []
+    output_stats = {}
+    methods = Counter()
+    report['splits'] = {}
     for d, files in zip(dirs, [train_files, val_files, test_files]):
         output_dir = generate_output_directory(input_dir, d)
-        output_dirs.append(output_dir)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
         # Copy and clean files if necessary
+        manifest_entries = []
         for f in files:
             src_path = os.path.join(input_dir, f)
             dest_path = os.path.join(output_dir, f)
-            if src_path in amino_files:
-                # Create a cleaned version of the file before copying
-                with open(src_path, 'r') as source_file:
-                    with open(dest_path, 'w') as dest_file:
-                        for line in source_file:
-                            if line.startswith('>'):  # Header line
-                                dest_file.write(line)
-                            else:  # Sequence line
-                                # Remove non-ACGT characters
-                                clean_line = ''.join(c for c in line.strip() if c in 'ACGTNacgtn')
-                                dest_file.write(clean_line + '\n')
+            output_stats[dest_path] = dict(file_stats[f])
+            if f in amino_files and policy['non_acgt'] == 'clean':
+                # Create a cleaned version of the file before copying; never write through a link to the original
+                if os.path.lexists(dest_path):
+                    os.remove(dest_path)
+                clean_copy(src_path, dest_path)
+                output_stats[dest_path]['size'] = os.path.getsize(dest_path)
+                methods['cleaned'] += 1
+                report['actions'].append({'action': 'cleaned', 'file': f, 'split': d,
+                                          'removed_characters': file_stats[f]['invalid_characters']})
                 print(f"Cleaned and copied {f} to {output_dir}")
             else:
-                # If file doesn't contain non-ACGT characters, copy it directly
-                shutil.copy2(src_path, dest_path)
-        print(f"{output_dir} contains {len(files)} files with a total size of {sum([os.path.getsize(os.path.join(output_dir, x)) for x in files]) / (1024 * 1024 * 1024):.2f} GB")
-
-    delete_original = input("Do you want to delete the original files in the source directory? (y/n): ")
-    if delete_original.strip().lower() == 'y':
-        for f in all_files:
+                # If file doesn't contain non-ACGT characters, it is placed without being rewritten
+                methods[materialize_file(src_path, dest_path, materialize)] += 1
+                if materialize == 'manifest':
+                    manifest_entries.append((f, src_path))
+        if materialize == 'manifest':
+            write_file_manifest(output_dir, manifest_entries)
+        split_size = sum(output_stats[os.path.join(output_dir, x)]['size'] for x in files)
+        report['splits'][d] = {'directory': os.path.abspath(output_dir), 'bytes': split_size, 'files': sorted(files)}
+        print(f"{output_dir} contains {len(files)} files with a total size of {split_size / (1024 * 1024 * 1024):.2f} GB")
+
+    print("Materialized files: " + ", ".join(f"{count} {method}" for method, count in sorted(methods.items())))
+    report['materialized'] = dict(methods)
+    total_files, total_bytes = len(split_input), sum(split['bytes'] for split in report['splits'].values())
+    report['achieved_fractions'] = {
+        'files': [len(report['splits'][d]['files']) / total_files * 100 if total_files else 0.0 for d in dirs],
+        'bytes': [report['splits'][d]['bytes'] / total_bytes * 100 if total_bytes else 0.0 for d in dirs],
+    }
+
+    if materialize in ('symlink', 'manifest'):
+        print(f"The split refers to the original files in {input_dir} ({materialize} mode), so they are kept.")
+        delete_original = 'keep'
+    else:
+        delete_original = decide(policy, 'originals', "Do you want to delete the original files in the source directory?")
+    if delete_original == 'delete':
+        # Excluded files are not in any split, so they are never deleted
+        for f in split_input:
             os.remove(os.path.join(input_dir, f))
         print(f"Original files in {input_dir} have been deleted.")
-    
-    # test if there are files with a unexpected size
-    mean_size, outlier_files = file_size_outliers(output_dirs)
-    if outlier_files:
-        print(f"\nAverage file size is {mean_size / (1024 * 1024):.2f} MB.")
-        print(f"{len(outlier_files)} files are significantly larger or smaller than the average:")
-        for f in outlier_files:
-            print(f"{f} - {os.path.getsize(f) / (1024 * 1024):.2f} MB")
-    else:
-        print("\nAll files are of typical size. No outliers detected.")
+    report['originals'] = 'deleted' if delete_original == 'delete' else 'kept'
 
     # Check for duplicate filenames
-    output_dirs = [generate_output_directory(input_dir, d) for d in ["train", "validation", "test"]]
-    if check_duplicate_filenames(output_dirs):
+    if check_duplicate_filenames(list(output_stats)):
         raise ValueError("Duplicate filenames detected across train, validation, and test folders!")
 
-    # Check for file content duplication using hashes
-    hash_check_choice = input("Do you want to check for duplicate content across files using hashes? (y/n): ")
-    if hash_check_choice.strip().lower() == 'y':
-        success, duplicate_files = check_file_hashes(output_dirs)
-        if not success:
-            print(f"Files {duplicate_files[0]} and {duplicate_files[1]} have the same content!")
-        else:
-             print("No duplications found.")
-
-    # check for empty files
-    empty_files = check_empty_files_and_delete(output_dirs)
-    if empty_files:
-        print("Warning: The following files are empty:")
-        for f in empty_files:
-            print(f)
-    else:
-        print("All files have content. None are empty.")
+    if report_path:
+        write_split_report(report_path, report)
+        print(f"Split report written to {report_path}")
+    return report
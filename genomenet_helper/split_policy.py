@@ -0,0 +1,92 @@
+import os
+import json
+
+# What split does in each situation; 'ask' prompts on the terminal.
+#   rename_fna:  rename .fna input files to .fasta, or keep them as they are
+#   non_acgt:    clean (remove non-ACGT characters in the output copy), keep the file unchanged, exclude it, or fail
+#   empty_files: exclude files without sequence from the split, keep them, or fail
+#   duplicates:  report files with identical content, exclude all but the first of each set, fail, or ignore them
+#   outliers:    report files whose size is more than 2 SDs from the mean, exclude them, or fail
+#   originals:   keep or delete the input files after the split
+POLICY_OPTIONS = {
+    'rename_fna': ['ask', 'rename', 'keep'],
+    'non_acgt': ['clean', 'keep', 'exclude', 'fail'],
+    'empty_files': ['ask', 'exclude', 'keep', 'fail'],
+    'duplicates': ['ask', 'report', 'exclude', 'fail', 'ignore'],
+    'outliers': ['report', 'exclude', 'fail'],
+    'originals': ['ask', 'keep', 'delete'],
+}
+
+# The action taken for a 'y' and an 'n' answer when a policy is 'ask'.
+ASK_ANSWERS = {
+    'rename_fna': ('rename', 'keep'),
+    'empty_files': ('exclude', 'keep'),
+    'duplicates': ('report', 'ignore'),
+    'originals': ('delete', 'keep'),
+}
+
+INTERACTIVE_POLICY = {'rename_fna': 'ask', 'non_acgt': 'clean', 'empty_files': 'ask', 'duplicates': 'ask',
+                      'outliers': 'report', 'originals': 'ask', 'seed': None}
+
+# Used with --batch: never prompts and never deletes input files unless the policy says so.
+BATCH_POLICY = {'rename_fna': 'keep', 'non_acgt': 'clean', 'empty_files': 'exclude', 'duplicates': 'report',
+                'outliers': 'report', 'originals': 'keep', 'seed': None}
+
+def load_policy_file(path):
+    """
+    Reads a split policy from a JSON or (with PyYAML installed) YAML file.
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading a YAML policy requires PyYAML (pip install pyyaml); use a JSON policy instead")
+            policy = yaml.safe_load(f)
+        else:
+            policy = json.load(f)
+    if not isinstance(policy, dict):
+        raise ValueError(f"The split policy in {path} must be a mapping of settings to actions")
+    return policy
+
+def resolve_policy(policy_file=None, batch=False, **overrides):
+    """
+    Combines the defaults (interactive, or BATCH_POLICY in batch mode), a policy file and command
+    line overrides (None values are ignored) into a complete, validated policy. In batch mode
+    'ask' is not allowed, so that a split never waits for input.
+    """
+    policy = dict(BATCH_POLICY if batch else INTERACTIVE_POLICY)
+    if policy_file:
+        policy.update(load_policy_file(policy_file))
+    policy.update({key: value for key, value in overrides.items() if value is not None})
+
+    unknown = sorted(set(policy) - set(POLICY_OPTIONS) - {'seed'})
+    if unknown:
+        raise ValueError("Unknown split policy settings: " + ", ".join(unknown))
+    for key, options in POLICY_OPTIONS.items():
+        if policy[key] not in options:
+            raise ValueError(f"Invalid split policy {key}: {policy[key]!r} (choose from {', '.join(options)})")
+        if batch and policy[key] == 'ask':
+            raise ValueError(f"Split policy {key} is 'ask', which is not possible in batch mode")
+    return policy
+
+def decide(policy, key, question):
+    """
+    Returns the action of the policy for key, asking the question on the terminal if it is 'ask'.
+    """
+    if policy[key] != 'ask':
+        return policy[key]
+    answer = input(f"{question} (y/n): ")
+    yes, no = ASK_ANSWERS[key]
+    return yes if answer.strip().lower() == 'y' else no
+
+def write_split_report(path, report):
+    """
+    Writes the JSON report of a split, atomically so that a scheduler never reads a partial report.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path + '.part', 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(path + '.part', path)
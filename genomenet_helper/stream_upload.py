@@ -0,0 +1,262 @@
+import io
+import os
+import zlib
+import struct
+import time
+import random
+import hashlib
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from b2sdk.v2.exception import B2Error
+
+from .materialize import FILE_MANIFEST, read_file_manifest
+
+# Uncompressed bytes per gzip member; members are compressed independently, in parallel.
+COMPRESS_BLOCK_SIZE = 8 << 20
+COMPRESS_LEVEL = 6
+
+DEFAULT_PART_SIZE_MB = 100
+DEFAULT_UPLOAD_WORKERS = 4
+
+# B2 limits: every part but the last needs at least 5 MB, and a large file has at most 10000 parts.
+MIN_PART_SIZE = 5 << 20
+MAX_PARTS = 10000
+
+# Attempts after the first for a part that failed with an error B2 asks clients to retry (timeouts,
+# 503s, expired upload tokens), each on a new upload URL after an exponential backoff.
+PART_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# File info key under which the plan of an upload is stored, so that an interrupted upload can be resumed.
+PLAN_INFO_KEY = 'genomenet_plan'
+
+# No file name and mtime 0, so that the same input always gives the same compressed bytes.
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+class ArchiveTooLarge(Exception):
+    """
+    The compressed archive exceeded the size limit of the upload.
+    """
+
+def gzip_member(data, level=COMPRESS_LEVEL):
+    """
+    Compresses data into one complete gzip member. Concatenated members form a valid gzip file.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    return GZIP_HEADER + body + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+
+class ParallelGzipWriter:
+    """
+    File-like object that compresses everything written to it in blocks of block_size bytes on a
+    thread pool (zlib releases the GIL) and passes the gzip members, in order, to sink.
+    At most 2 * workers blocks are held in memory.
+    """
+
+    def __init__(self, sink, workers, level=COMPRESS_LEVEL, block_size=COMPRESS_BLOCK_SIZE):
+        self.sink = sink
+        self.level = level
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        self.max_pending = 2 * workers
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        if len(self.pending) >= self.max_pending:
+            self.sink(self.pending.popleft().result())
+        self.pending.append(self.pool.submit(gzip_member, block, self.level))
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.sink(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+class LargeFileUpload:
+    """
+    Uploads a stream of unknown length to a B2 bucket in parts of part_size bytes, with up to
+    `workers` parts in flight. The first part is held back until a second one starts, so that a small
+    stream becomes a single upload (large files need at least two parts).
+    An unfinished large file with the same name and plan_id is resumed: parts that are already
+    uploaded with the same SHA-1 are skipped, so a repeated upload only sends the missing parts.
+    A part that fails with a transient error is retried up to `retries` times on a new upload URL.
+    """
+
+    def __init__(self, bucket, file_name, plan_id, part_size, workers=DEFAULT_UPLOAD_WORKERS, max_size=None,
+                 retries=PART_RETRIES, backoff=BACKOFF_SECONDS):
+        self.bucket = bucket
+        self.session = bucket.api.session
+        self.retries = retries
+        self.backoff = backoff
+        self.file_name = file_name
+        self.file_info = {PLAN_INFO_KEY: plan_id}
+        self.part_size = part_size
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.part_number = 0
+        self.first_part = None
+        self.large_file_id = None
+        self.uploaded = {}  # part number -> (SHA-1, length) of the parts already in the bucket
+        self.sha1s = []
+        self.skipped = 0
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        self.max_pending = workers
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ArchiveTooLarge(f"{self.file_name} exceeds {self.max_size / (1024 ** 3):.0f} GB")
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._add_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _add_part(self, data):
+        self.part_number += 1
+        if self.part_number > MAX_PARTS:
+            raise ValueError(f"{self.file_name} needs more than {MAX_PARTS} parts; use a larger part size")
+        if self.part_number == 1:
+            self.first_part = data
+            return
+        if self.part_number == 2:
+            self._start()
+            self._upload(1, self.first_part)
+            self.first_part = None
+        self._upload(self.part_number, data)
+
+    def _start(self):
+        for unfinished in self.bucket.list_unfinished_large_files(prefix=self.file_name):
+            if unfinished.file_name == self.file_name and unfinished.file_info == self.file_info:
+                self.large_file_id = unfinished.file_id
+                self.uploaded = {part.part_number: (part.content_sha1, part.content_length)
+                                 for part in self.bucket.list_parts(self.large_file_id)}
+                print(f"Resuming the upload of {self.file_name}: {len(self.uploaded)} parts are already uploaded.")
+                return
+        large_file = self.session.start_large_file(self.bucket.id_, self.file_name, 'application/gzip', self.file_info)
+        self.large_file_id = large_file['fileId']
+
+    def _upload_part(self, part_number, data, sha1):
+        """
+        Uploads one part. Errors that B2 asks clients to retry with a new upload URL are retried
+        with exponential backoff, each attempt on a freshly requested URL; others are raised.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                upload_url = self.session.get_upload_part_url(self.large_file_id)
+                return self.session.raw_api.upload_part(upload_url['uploadUrl'], upload_url['authorizationToken'],
+                                                        part_number, len(data), sha1, io.BytesIO(data))
+            except B2Error as error:
+                if attempt == self.retries or not error.should_retry_upload():
+                    raise
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"Part {part_number} of {self.file_name} failed ({error}), retrying in {delay:.0f} s")
+                time.sleep(delay)
+
+    def _upload(self, part_number, data):
+        sha1 = hashlib.sha1(data).hexdigest()
+        self.sha1s.append(sha1)
+        if self.uploaded.get(part_number) == (sha1, len(data)):
+            self.skipped += 1
+            return
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(self._upload_part, part_number, data, sha1))
+
+    def close(self):
+        """
+        Uploads the rest of the stream, waits for all parts and finishes the file.
+        """
+        try:
+            if self.part_number == 0 or (self.part_number == 1 and not self.buffer):
+                data = self.first_part or b''
+                data += bytes(self.buffer)
+                self.bucket.upload_bytes(data, self.file_name, 'application/gzip', self.file_info)
+                return
+            if self.buffer:
+                self._add_part(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.pending.popleft().result()
+            self.session.finish_large_file(self.large_file_id, self.sha1s)
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    def cancel(self):
+        self.pool.shutdown(cancel_futures=True)
+        if self.large_file_id is not None:
+            self.bucket.cancel_large_file(self.large_file_id)
+
+def archive_members(folders):
+    """
+    Returns the (path, name in the archive) pairs of everything in the folders, in a fixed order.
+    Files behind symlinks are archived as files; manifest-mode folders (see materialize) get their
+    source files under the listed names instead of the manifest.
+    """
+    members = []
+    for folder in folders:
+        root = os.path.normpath(folder).lstrip(os.sep)
+        members.append((folder, root))
+        manifest = read_file_manifest(folder)
+        for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, folder)
+            for f in sorted(filenames):
+                if manifest and dirpath == folder and f == FILE_MANIFEST:
+                    continue
+                members.append((os.path.join(dirpath, f), os.path.normpath(os.path.join(root, relative, f))))
+        members.extend((source, os.path.join(root, name)) for name, source in manifest)
+    return members
+
+def upload_plan_id(members, part_size, level):
+    """
+    Hashes everything that determines the uploaded bytes, so that a resumed upload is only continued
+    while the input files and settings are unchanged.
+    """
+    hasher = hashlib.sha1(f"{part_size} {level}\n".encode())
+    for path, name in members:
+        stat = os.stat(path)
+        hasher.update(f"{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return hasher.hexdigest()
+
+def upload_folders(bucket, folders, file_name, part_size=DEFAULT_PART_SIZE_MB << 20, workers=os.cpu_count(),
+                   upload_workers=DEFAULT_UPLOAD_WORKERS, level=COMPRESS_LEVEL, max_size=None):
+    """
+    Streams a tar.gz archive of the folders into bucket as file_name without writing it to disk:
+    tar feeds the parallel compressor, which feeds the part uploader. Memory use is bounded by
+    about 2 * workers compression blocks and upload_workers + 1 parts.
+    Returns the size of the archive and the number of parts that were already uploaded.
+    """
+    members = archive_members(folders)
+    upload = LargeFileUpload(bucket, file_name, upload_plan_id(members, part_size, level), part_size, upload_workers, max_size)
+    compressor = ParallelGzipWriter(upload.write, workers, level)
+    try:
+        with tarfile.open(fileobj=compressor, mode='w|', dereference=True) as tar:
+            for path, name in members:
+                tar.add(path, arcname=name, recursive=False)
+        compressor.close()
+        upload.close()
+    except ArchiveTooLarge:
+        upload.cancel()
+        raise
+    finally:
+        compressor.pool.shutdown(cancel_futures=True)
+        upload.pool.shutdown(cancel_futures=True)
+    return upload.size, upload.skipped
@@ -1,47 +1,197 @@
 import os
-import random
-from Bio import SeqIO
-from .utils import generate_output_directory
+import numpy as np
+from .fasta_cache import get_fasta_index
+from .fasta_reader import fasta_stem, is_fasta, read_records
+from .fragment_shards import ShardWriter
+from .kmer_counting import ENCODE_TABLE
+from .utils import append_manifest, generate_output_directory, genome_rng, ordered_map, read_manifest
 
-def sample_fasta_files(input_file, output_dir, fragment_length, n_fragments):
+QUOTA_POLICIES = ['fixed', 'proportional', 'balanced']
+
+def window_starts(length, fragment_length, stride):
+    """
+    Start offsets of all fragment windows of a record; stride < fragment_length gives overlapping windows.
+    """
+    return np.arange(0, max(length - fragment_length + 1, 0), stride, dtype=np.int64)
+
+def count_windows(length, fragment_length, stride):
+    return max(length - fragment_length, -1) // stride + 1
+
+def select_fragments(input_file, fragment_length, n_fragments, rng=None, stride=None, max_n_fraction=1.0):
     """
-    This function subsamples the fasta file to produce n_fragments of size fragment_length.
-    For simplicity, I'm assuming each fasta file contains one sequence, 
-    and I'm generating non-overlapping fragments.
+    Draws n_fragments distinct fragments of size fragment_length from all records of the fasta file
+    (chromosomes, plasmids, contigs); a fragment never spans two records. Candidate windows start
+    every stride bases (default: fragment_length, i.e. non-overlapping windows). Windows in which more
+    than max_n_fraction of the bases are N or other ambiguous characters are rejected, using a prefix
+    sum of ambiguous-base counts. All start positions are drawn in a single batch.
+    Returns a list of (record name, start offset in the record, sequence bytes).
     """
-    records = list(SeqIO.parse(input_file, "fasta"))
-    sequence = str(records[0].seq).upper()
+    rng = rng if rng is not None else np.random.default_rng()
+    stride = stride or fragment_length
+    index = get_fasta_index(input_file)
+    filter_ambiguous = max_n_fraction < 1.0
+
+    # Candidate windows of every record, numbered across records.
+    if filter_ambiguous:
+        max_ambiguous = int(np.floor(max_n_fraction * fragment_length))
+        record_starts = []
+        for _, sequence in read_records(input_file, index):
+            starts = window_starts(len(sequence), fragment_length, stride)
+            ambiguous_prefix = np.concatenate(([0], np.cumsum(ENCODE_TABLE[sequence] > 3, dtype=np.int64)))
+            record_starts.append(starts[ambiguous_prefix[starts + fragment_length] - ambiguous_prefix[starts] <= max_ambiguous])
+        record_windows = np.array([len(starts) for starts in record_starts], dtype=np.int64)
+    else:
+        record_windows = np.array([count_windows(record.length, fragment_length, stride) for record in index], dtype=np.int64)
+    record_first_window = np.concatenate(([0], np.cumsum(record_windows)))
+    total_windows = int(record_first_window[-1])
 
-    # Compute total number of possible fragments of size fragment_length.
-    total_fragments = len(sequence) // fragment_length
+    # Randomly select n_fragments windows.
+    selected = rng.choice(total_windows, min(n_fragments, total_windows), replace=False)
+    fragment_records = np.searchsorted(record_first_window, selected, side='right') - 1
+    if filter_ambiguous:
+        fragment_starts = np.concatenate(record_starts)[selected] if record_starts else selected
+    else:
+        fragment_starts = (selected - record_first_window[fragment_records]) * stride
 
-    # Randomly select n_fragments.
-    selected_fragments = set()
-    while len(selected_fragments) < min(n_fragments, total_fragments):
-        selected_fragments.add(random.randint(0, total_fragments - 1))
+    # Cut the fragments, reading one record at a time.
+    fragments = [None] * len(selected)
+    for record_idx, (name, sequence) in enumerate(read_records(input_file, index)):
+        for idx in np.flatnonzero(fragment_records == record_idx):
+            start = int(fragment_starts[idx])
+            fragments[idx] = (name, start, sequence[start:start + fragment_length].tobytes())
+    return fragments
 
-    # Save these fragments to new fasta files.
-    for idx, fragment_index in enumerate(selected_fragments):
-        start = fragment_index * fragment_length
-        end = start + fragment_length
+def genome_windows(task):
+    """
+    Returns the number of fragment windows and the length of one genome, from the cached index
+    (see fasta_cache). Runs in a worker process.
+    """
+    input_file, fragment_length, stride = task
+    index = get_fasta_index(input_file)
+    return sum(count_windows(record.length, fragment_length, stride) for record in index), sum(record.length for record in index)
 
-        header = f'>subsample_{idx}'
-        filename = os.path.join(output_dir, f'subsample_{idx}.fasta')
+def compute_quotas(window_counts, lengths, policy='fixed', n_fragments=2500, total_fragments=None):
+    """
+    Number of fragments to draw from each genome, never more than its number of windows.
+    'fixed' takes n_fragments from every genome. 'proportional' splits the target (total_fragments,
+    default n_fragments per genome) in proportion to genome length. 'balanced' splits the target as
+    evenly as possible, giving the share that small genomes cannot fill to the larger ones.
+    """
+    window_counts = np.asarray(window_counts, dtype=np.int64)
+    if policy == 'fixed' or not len(window_counts):
+        return np.minimum(window_counts, n_fragments)
+    target = total_fragments if total_fragments is not None else n_fragments * len(window_counts)
+    target = min(target, int(window_counts.sum()))
 
-        with open(filename, 'w') as f:
-            f.write(header + '\n')
-            f.write(sequence[start:end])
+    if policy == 'proportional':
+        lengths = np.asarray(lengths, dtype=np.float64)
+        shares = target * lengths / lengths.sum() if lengths.sum() else np.zeros(len(lengths))
+        quotas = np.minimum(np.floor(shares).astype(np.int64), window_counts)
+        # Hand out what rounding and capping left over, largest remainders first
+        remaining = target - int(quotas.sum())
+        for genome in np.argsort(-(shares - np.floor(shares)), kind='stable'):
+            if remaining <= 0:
+                break
+            extra = min(remaining, int(window_counts[genome] - quotas[genome]))
+            quotas[genome] += extra
+            remaining -= extra
+        return quotas
 
-def subsample_genomes(input_dir, fragment_length=4000, n_fragments=2500):
-    output_dir = generate_output_directory(input_dir, "subsampled")
+    # Balanced: water-filling over the genomes sorted by capacity
+    quotas = np.zeros(len(window_counts), dtype=np.int64)
+    order = np.argsort(window_counts, kind='stable')
+    remaining = target
+    for position, genome in enumerate(order):
+        share = -(-remaining // (len(order) - position))
+        quotas[genome] = min(window_counts[genome], share)
+        remaining -= quotas[genome]
+    return quotas
+
+def sample_fasta_files(input_file, output_dir, fragment_length, n_fragments, rng=None, stride=None, max_n_fraction=1.0):
+    """
+    This function subsamples the fasta file to produce n_fragments of size fragment_length,
+    each written to its own file. Output files are prefixed with the genome name so fragments
+    of different genomes never collide. Returns the number of fragments written.
+    """
+    genome = fasta_stem(input_file)
+    fragments = select_fragments(input_file, fragment_length, n_fragments, rng, stride, max_n_fraction)
+    for idx, (_, _, sequence) in enumerate(fragments):
+        header = f'>{genome}_subsample_{idx}'
+        filename = os.path.join(output_dir, f'{genome}_subsample_{idx}.fasta')
+
+        with open(filename, 'wb') as f:
+            f.write(header.encode() + b'\n')
+            f.write(sequence)
+    return len(fragments)
+
+def subsample_genome(task):
+    """
+    Subsamples one input file with its own random stream. Runs in a worker process.
+    """
+    input_file, output_dir, fragment_length, n_fragments, seed, output_mode, stride, max_n_fraction = task
+    fasta_file = os.path.basename(input_file)
+    rng = genome_rng(seed, fasta_file)
+    if output_mode == 'shards':
+        # Shards have a single writer in the main process; the worker only returns the fragments
+        genome = fasta_stem(input_file)
+        fragments = select_fragments(input_file, fragment_length, n_fragments, rng, stride, max_n_fraction)
+        return {'input': fasta_file, 'fragments': len(fragments)}, [
+            (f'{genome}_subsample_{idx}', name, start, sequence) for idx, (name, start, sequence) in enumerate(fragments)]
+    n_written = sample_fasta_files(input_file, output_dir, fragment_length, n_fragments, rng, stride, max_n_fraction)
+    return {'input': fasta_file, 'fragments': n_written}, None
+
+def subsample_genomes(input_dir, fragment_length=4000, n_fragments=2500, seed=None, workers=1, output_dir=None,
+                      output_mode='files', shard_size_mb=256, compress=False, stride=None, max_n_fraction=1.0,
+                      quota='fixed', total_fragments=None):
+    """
+    Subsamples every FASTA file in input_dir. Each genome uses a random stream derived from the seed
+    and its file name, so the output does not depend on the number of workers. Finished genomes are
+    recorded in a manifest; rerunning with the same output directory resumes an interrupted run.
+    With output_mode='shards' fragments are appended to large multi-record FASTA shards with an index
+    (see fragment_shards.ShardWriter) instead of being written one file per fragment.
+    The number of fragments per genome follows the quota policy (see compute_quotas); the proportional and
+    balanced quotas are planned from the cached genome lengths before any genome is sampled.
+    """
+    output_dir = output_dir or generate_output_directory(input_dir, "subsampled")
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    completed = read_manifest(output_dir)
+    fasta_files = [f for f in sorted(os.listdir(input_dir)) if is_fasta(f)]
+    if completed:
+        print(f"Resuming: {len(completed)} of {len(fasta_files)} genomes already subsampled in {output_dir}.")
+
     # Subsample each fasta file in the input directory.
-    for fasta_file in os.listdir(input_dir):
-        if fasta_file.endswith('.fasta'):
-            input_file = os.path.join(input_dir, fasta_file)
-            sample_fasta_files(input_file, output_dir, fragment_length, n_fragments)
+    writer = None
+    if output_mode == 'shards':
+        writer = ShardWriter(output_dir, os.path.basename(os.path.normpath(input_dir)), shard_size_mb, compress)
+        shard_states = [entry['shard_state'] for entry in completed.values() if 'shard_state' in entry]
+        if shard_states:
+            writer.resume(shard_states[-1])
+        else:
+            writer.start()
+
+    stride = stride or fragment_length
+    if quota == 'fixed':
+        # select_fragments caps the quota at the windows of each genome, so nothing has to be scanned up front
+        quotas = [n_fragments] * len(fasta_files)
+    else:
+        # On a first run this scans every genome, so the scans run on the worker pool
+        tasks = ((os.path.join(input_dir, fasta_file), fragment_length, stride) for fasta_file in fasta_files)
+        window_counts, lengths = zip(*ordered_map(genome_windows, tasks, workers)) if fasta_files else ((), ())
+        quotas = compute_quotas(window_counts, lengths, quota, n_fragments, total_fragments)
+
+    tasks = ((os.path.join(input_dir, fasta_file), output_dir, fragment_length, int(genome_quota), seed, output_mode, stride, max_n_fraction)
+             for fasta_file, genome_quota in zip(fasta_files, quotas) if fasta_file not in completed)
+    try:
+        for entry, fragments in ordered_map(subsample_genome, tasks, workers):
+            if writer is not None:
+                writer.write_genome(entry['input'], fragments)
+                entry['shard_state'] = writer.state()
+            append_manifest(output_dir, entry)
+    finally:
+        if writer is not None:
+            writer.close()
 
-    print(f'Successfully subsampled genomes, written to {output_dir}')
\ No newline at end of file
+    print(f'Successfully subsampled genomes, written to {output_dir}')
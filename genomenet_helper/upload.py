@@ -1,53 +1,107 @@
 import os
-import subprocess
+import sys
+import json
 from b2sdk.v2 import InMemoryAccountInfo, B2Api
 import getpass
+from appdirs import user_config_dir
 
-def compress_folders(train_folder, test_folder, validation_folder, base_name):
-    archive_name = f"{base_name}.tar.gz"
-    subprocess.run(['tar', '-czf', archive_name, train_folder, test_folder, validation_folder], check=True)
-    return archive_name
+from .fragment_shards import count_fragments
+from .incremental_upload import upload_incremental
+from .stream_upload import (COMPRESS_LEVEL, DEFAULT_PART_SIZE_MB, DEFAULT_UPLOAD_WORKERS, MIN_PART_SIZE,
+                            ArchiveTooLarge, upload_folders)
+
+# Archives larger than this are not uploaded.
+MAX_ARCHIVE_GB = 100
+
+# Credentials come from these environment variables, then from the config file, then from a prompt.
+CREDENTIAL_ENV = {'application_key_id': 'B2_APPLICATION_KEY_ID', 'application_key': 'B2_APPLICATION_KEY',
+                  'bucket': 'B2_BUCKET', 'realm': 'B2_REALM'}
+CONFIG_ENV = 'GENOMENET_HELPER_B2_CONFIG'
+
+def config_path():
+    return os.environ.get(CONFIG_ENV) or os.path.join(user_config_dir('genomenet_helper'), 'b2.json')
+
+def get_credentials(bucket_name=None, realm=None):
+    """
+    Returns the B2 application key ID, application key, bucket name and realm. Arguments take precedence,
+    then the environment (CREDENTIAL_ENV), then the JSON config file (config_path) with the same keys.
+    Missing values are prompted for on a terminal; without one, a missing value is an error.
+    """
+    credentials = {}
+    if os.path.exists(config_path()):
+        with open(config_path()) as f:
+            credentials.update(json.load(f))
+    credentials.update({key: os.environ[env] for key, env in CREDENTIAL_ENV.items() if os.environ.get(env)})
+    credentials.update({key: value for key, value in (('bucket', bucket_name), ('realm', realm)) if value})
+    credentials.setdefault('realm', 'production')
+
+    prompts = [('application_key_id', 'Enter your Backblaze B2 Application Key ID: ', getpass.getpass),
+               ('application_key', 'Enter your Backblaze B2 Application Key: ', getpass.getpass),
+               ('bucket', 'Enter your Backblaze B2 Bucket name: ', input)]
+    for key, prompt, ask in prompts:
+        if not credentials.get(key):
+            if not sys.stdin.isatty():
+                raise ValueError(f"No B2 {key.replace('_', ' ')}: set {CREDENTIAL_ENV[key]} or add '{key}' to {config_path()}")
+            credentials[key] = ask(prompt)
+    return credentials
+
+def open_bucket(bucket_name=None, realm=None):
+    credentials = get_credentials(bucket_name, realm)
+    b2_api = B2Api(InMemoryAccountInfo())
+    b2_api.authorize_account(credentials['realm'], credentials['application_key_id'], credentials['application_key'])
+    return b2_api.get_bucket_by_name(credentials['bucket'])
 
 def get_folder_size_mb(folder_path):
     total_size = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
+    for dirpath, dirnames, filenames in os.walk(folder_path, followlinks=True):
         for f in filenames:
             fp = os.path.join(dirpath, f)
             total_size += os.path.getsize(fp)
     return total_size / (1024 * 1024)
 
-def upload_dataset(train_folder, test_folder, validation_folder):
+def upload_dataset(train_folder, test_folder, validation_folder, workers=os.cpu_count(), upload_workers=DEFAULT_UPLOAD_WORKERS,
+                   part_size_mb=DEFAULT_PART_SIZE_MB, level=COMPRESS_LEVEL, realm=None, bucket_name=None,
+                   incremental=False, dataset=None):
+    """
+    Streams the three folders as one tar.gz archive to a Backblaze B2 bucket: the archive is
+    compressed in parallel blocks with `workers` threads and uploaded in parts of part_size_mb with
+    `upload_workers` parts in flight, without writing it to disk. Running the same upload again
+    after an interruption only sends the missing parts (see stream_upload.LargeFileUpload).
+    realm is the B2 realm or the URL of a B2-compatible server, e.g. for testing; credentials
+    are read as described in get_credentials.
+    With incremental, the files are uploaded as content-addressed objects instead, and only contents
+    that the previous version of the dataset does not have are sent (see incremental_upload).
+    """
     # Assuming the folders are named with a consistent pattern: 'prefix_date'
     base_name = '_'.join(train_folder.split('_')[:-1])
-    date_suffix = train_folder.split('_')[-1]
-
-    # Compress the folders into a single archive
-    archive_name = compress_folders(train_folder, test_folder, validation_folder, base_name)
-    
-    # Check size limit
-    archive_size_gb = get_folder_size_mb(archive_name) / 1024
-    if archive_size_gb > 100:
-        print("The archive exceeds the 100GB size limit and will not be uploaded.")
-        return
+    archive_name = f"{os.path.basename(os.path.normpath(base_name))}.tar.gz"
+    part_size = int(part_size_mb * 1024 * 1024)
+    if part_size < MIN_PART_SIZE:
+        raise ValueError(f"The part size must be at least {MIN_PART_SIZE / (1024 * 1024):.0f} MB")
 
-    # Get credentials from the user
-    application_key_id = getpass.getpass('Enter your Backblaze B2 Application Key ID: ')
-    application_key = getpass.getpass('Enter your Backblaze B2 Application Key: ')
-    bucket_name = input('Enter your Backblaze B2 Bucket name: ')
+    for folder in (train_folder, test_folder, validation_folder):
+        print(f"{folder}: {count_fragments(folder)} sequences, {get_folder_size_mb(folder):.2f} MB")
 
-    info = InMemoryAccountInfo()
-    b2_api = B2Api(info)
-    b2_api.authorize_account("production", application_key_id, application_key)
-    bucket = b2_api.get_bucket_by_name(bucket_name)
+    bucket = open_bucket(bucket_name, realm)
 
-    # Upload the file
-    b2_file = bucket.upload_local_file(
-        local_file=archive_name,
-        file_name=os.path.basename(archive_name)
-    )
+    if incremental:
+        dataset = dataset or os.path.basename(os.path.normpath(base_name))
+        split_folders = {'train': train_folder, 'validation': validation_folder, 'test': test_folder}
+        manifest, new_bytes = upload_incremental(bucket, split_folders, dataset, workers, upload_workers)
+        print(f"Successfully uploaded {dataset}: {new_bytes / (1024 ** 3):.2f} GB of new content, manifest {manifest}")
+        return
+
+    # Compress and upload the folders as a single archive
+    try:
+        size, resumed_parts = upload_folders(bucket, [train_folder, test_folder, validation_folder], archive_name,
+                                             part_size, workers, upload_workers, level, MAX_ARCHIVE_GB * 1024 ** 3)
+    except ArchiveTooLarge:
+        print(f"The archive exceeds the {MAX_ARCHIVE_GB}GB size limit and will not be uploaded.")
+        return
 
-    print(f"Successfully uploaded {archive_name}")
-    print(f"File available at: {b2_file.file_name}")
+    print(f"Successfully uploaded {archive_name} ({size / (1024 ** 3):.2f} GB"
+          + (f", {resumed_parts} parts were already uploaded)" if resumed_parts else ")"))
+    print(f"File available at: {archive_name}")
 
 # This function would be connected to your CLI interface
 # for example as 'genomenet_helper upload --train <train_folder> --test <test_folder> --validation <validation_folder>'
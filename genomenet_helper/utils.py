@@ -1,6 +1,12 @@
 import os
+import json
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
 def generate_output_directory(input_dir, descriptor):
     """
     Given an input directory and a descriptor (e.g., "subsampled"), this function returns an output directory name.
@@ -13,3 +19,76 @@ def generate_output_directory(input_dir, descriptor):
         base_name = "_".join(base_name.split("_")[:-1])
         
     return os.path.join(os.path.dirname(input_dir), f"{base_name}_{descriptor}_{current_date}")
+
+
+def genome_rng(seed, name):
+    """
+    Returns a NumPy random generator for one input genome.
+    The stream is derived from the seed and the file name, so it does not depend on processing order.
+    """
+    digest = hashlib.blake2b(os.path.basename(name).encode('utf-8'), digest_size=16).digest()
+    spawn_key = tuple(int.from_bytes(digest[i:i + 4], 'little') for i in range(0, len(digest), 4))
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+def ordered_map(func, items, workers=1, max_in_flight=None):
+    """
+    Applies func to every item and yields the results in input order.
+    With workers > 1 the calls run in a process pool; at most max_in_flight results
+    (default: twice the number of workers) are pending at any time to keep memory bounded.
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    max_in_flight = max_in_flight or 2 * workers
+    pending = deque()
+    items = iter(items)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+MANIFEST_NAME = '.completed.jsonl'
+
+
+def read_manifest(output_dir):
+    """
+    Returns the completion manifest of an output directory as a dict keyed by input file name.
+    """
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a line cut short by an interruption; that genome is simply redone
+                entries[entry['input']] = entry
+    return entries
+
+
+def append_manifest(output_dir, entry):
+    """
+    Records a finished input genome so an interrupted run can resume after it.
+    """
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def atomic_write(path, data):
+    """
+    Writes data to path through a temporary file, so path is either complete or absent.
+    """
+    temp_path = f"{path}.part"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
@@ -12,6 +12,9 @@ setup(
         'appdirs',
          'pandas',
         'scikit-learn',
+        'joblib',
+        'threadpoolctl',
+        'scipy',
         'matplotlib',
     ],
     entry_points={
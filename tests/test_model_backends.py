@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from genomenet_helper.features import iter_features, stream_features
+from genomenet_helper.kmer_counting import encode_kmers
+from genomenet_helper.model_backends import fit_model, predict_proba
+from genomenet_helper.profile_store import load_profile_store, save_profile_store
+
+KMERS = ['AA', 'AC', 'AG', 'AT', 'CA', 'CC', 'CG', 'CT']
+
+def class_profiles(label, rows, shift, rng):
+    # Both classes count every k-mer; they differ in which half of the k-mers is more frequent
+    weights = np.r_[np.full(4, 1 + shift), np.full(4, 1 - shift)]
+    counts = rng.poisson(20 * weights, size=(rows, len(KMERS)))
+    metadata = pd.DataFrame({'unique_id': [f'{label}_{i}' for i in range(rows)], 'file_name': f'{label}.fasta',
+                             'sample_id': np.arange(rows), 'class': label})
+    return counts, metadata
+
+def write_store(path, counts, metadata):
+    save_profile_store(str(path), sparse.csr_matrix(counts), metadata, encode_kmers(KMERS), 2)
+    return str(path)
+
+@pytest.fixture
+def class_stores(tmp_path):
+    rng = np.random.default_rng(1)
+    return [write_store(tmp_path / f'{label}.npz', *class_profiles(label, 3000, shift, rng))
+            for label, shift in (('a', 0.3), ('b', -0.3))]
+
+def test_iter_features_chunks_profile_stores(class_stores):
+    blocks = list(iter_features(class_stores[:1], KMERS, chunk_rows=700))
+    assert [X.shape[0] for X, _ in blocks] == [700, 700, 700, 700, 200]
+    store = load_profile_store(class_stores[0])
+    assert (sparse.vstack([X for X, _ in blocks]) != store.counts).nnz == 0
+    assert pd.concat([metadata for _, metadata in blocks], ignore_index=True).equals(store.metadata)
+
+@pytest.mark.parametrize('model_type', ['sgd', 'logistic'])
+def test_streamed_fit_predicts_every_class_of_per_class_files(class_stores, model_type):
+    source, metadata = stream_features(class_stores, KMERS, chunk_rows=500)
+    y = (metadata['class'] == 'b').to_numpy().astype(int)
+    model = fit_model(model_type, source, y, np.arange(len(y)), 2)
+
+    rng = np.random.default_rng(2)
+    X_test = sparse.vstack([sparse.csr_matrix(class_profiles(label, 200, shift, rng)[0], dtype=np.float32)
+                            for label, shift in (('a', 0.3), ('b', -0.3))])
+    y_test = np.repeat([0, 1], 200)
+    y_pred = np.argmax(predict_proba(model_type, model, X_test, 2), axis=1)
+    assert set(y_pred) == {0, 1}
+    assert np.mean(y_pred == y_test) > 0.9
@@ -0,0 +1,45 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from genomenet_helper.kmer_counting import encode_kmers
+from genomenet_helper.kmer_harmonization import harmonize_kmer_headers
+from genomenet_helper.model_trainer import training_profile_settings
+from genomenet_helper.profile_store import save_profile_store
+
+KMERS = ['AA', 'AC', 'AG', 'AT']
+METADATA = pd.DataFrame({'unique_id': ['x'], 'file_name': ['x.fasta'], 'sample_id': [0], 'class': ['a']})
+
+def write_store(path, canonical=False, **params):
+    save_profile_store(str(path), sparse.csr_matrix(np.ones((1, len(KMERS)))), METADATA, encode_kmers(KMERS), 2, canonical, params)
+    return str(path)
+
+def made_with(max_subseqs, subsequence_size):
+    return {'max_subseqs': max_subseqs, 'subsequence_size': subsequence_size, 'random_mode': False, 'seed': None}
+
+def test_agreeing_stores_give_their_settings(tmp_path):
+    files = [write_store(tmp_path / f'{name}.npz', True, **dict(made_with(20, 2000), seed=name)) for name in 'ab']
+    assert training_profile_settings(files, KMERS) == (2, True, made_with(20, 2000))
+
+@pytest.mark.parametrize('second', [{'canonical': True, **made_with(20, 2000)}, made_with(10, 2000)])
+def test_conflicting_stores_are_refused(tmp_path, second):
+    files = [write_store(tmp_path / 'a.npz', **made_with(20, 2000)), write_store(tmp_path / 'b.npz', **second)]
+    with pytest.raises(ValueError):
+        training_profile_settings(files, KMERS)
+
+def test_given_settings_override_recorded_ones_with_a_warning(tmp_path, caplog):
+    files = [write_store(tmp_path / 'a.npz', **made_with(20, 2000)), write_store(tmp_path / 'b.npz', **made_with(10, 2000))]
+    with caplog.at_level(logging.WARNING):
+        settings = training_profile_settings(files, KMERS, True, 5, 500)
+    assert settings == (2, True, made_with(5, 500))
+    assert 'override' in caplog.text
+
+def test_harmonized_store_records_the_given_settings(tmp_path):
+    csv_path = str(tmp_path / 'profiles.csv')
+    pd.concat([METADATA, pd.DataFrame([[1, 2]], columns=KMERS[:2])], axis=1).to_csv(csv_path, index=False)
+    store_path = str(tmp_path / 'profiles.npz')
+    harmonize_kmer_headers(csv_path, store_path=store_path, canonical=True, max_subseqs=20, subsequence_size=2000)
+    assert training_profile_settings([store_path, csv_path], KMERS[:2]) == (2, True, made_with(20, 2000))
@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import pytest
+from b2sdk.v2.exception import B2ConnectionError, FileNotPresent
+
+from genomenet_helper.stream_upload import LargeFileUpload
+
+class FakeSession:
+    """
+    Records the B2 calls of a large file upload; upload_part raises the queued errors first.
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.upload_urls = 0
+        self.parts = {}
+        self.finished = None
+        self.raw_api = SimpleNamespace(upload_part=self.upload_part)
+
+    def start_large_file(self, bucket_id, file_name, content_type, file_info):
+        return {'fileId': 'large-file'}
+
+    def get_upload_part_url(self, file_id):
+        self.upload_urls += 1
+        return {'uploadUrl': f'url-{self.upload_urls}', 'authorizationToken': 'token'}
+
+    def upload_part(self, upload_url, token, part_number, content_length, sha1, stream):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.parts[part_number] = (upload_url, stream.read())
+
+    def finish_large_file(self, file_id, sha1s):
+        self.finished = sha1s
+
+def fake_bucket(session):
+    return SimpleNamespace(api=SimpleNamespace(session=session), id_='bucket', list_unfinished_large_files=lambda prefix: [])
+
+def upload(session, data, part_size):
+    upload = LargeFileUpload(fake_bucket(session), 'archive.tar.gz', 'plan', part_size, workers=2, backoff=0)
+    upload.write(data)
+    upload.close()
+
+def test_failed_part_is_retried_on_a_new_upload_url():
+    session = FakeSession([B2ConnectionError('connection reset')])
+    upload(session, b'a' * 10 + b'b' * 10 + b'c' * 5, part_size=10)
+    assert {number: data for number, (_, data) in session.parts.items()} == {1: b'a' * 10, 2: b'b' * 10, 3: b'c' * 5}
+    assert session.upload_urls == 4
+    assert len({url for url, _ in session.parts.values()}) == 3
+    assert len(session.finished) == 3
+
+def test_errors_that_are_not_transient_are_raised():
+    session = FakeSession([FileNotPresent()])
+    with pytest.raises(FileNotPresent):
+        upload(session, b'a' * 20, part_size=10)
+    assert session.finished is None